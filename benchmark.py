@@ -0,0 +1,42 @@
+import sys
+import argparse
+from lib.config import Config
+from lib import benchmark
+
+parser = argparse.ArgumentParser(description="Benchmark virt-dup against synthetic images and a simulated fleet.")
+parser.add_argument('--config', default='virt-dup.yml', help="virt-dup.yml supplying copy and scheduler settings")
+parser.add_argument('--workdir', default='/var/tmp/virt-dup-benchmark', help="where images are built and staged")
+parser.add_argument('--keep', action='store_true', help="keep the workdir afterwards")
+parser.add_argument('--output', default='benchmark-results.json', help="write results here")
+parser.add_argument('--baseline', help="compare with results saved by an earlier run")
+parser.add_argument('--threshold', type=float, default=0.1,
+                    help="fraction a timing or throughput may get worse before it is a regression")
+parser.add_argument('--only', nargs='*', choices=['staging', 'chain_resolution', 'get_file_list',
+                                                  'load_our_snapshot', 'fleet_load', 'scheduler'])
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--size', type=int, default=1024 * 1024 * 1024, help="virtual size of the synthetic disk")
+parser.add_argument('--depth', type=int, default=3, help="images in the synthetic chain")
+parser.add_argument('--fill', type=float, default=0.5, help="fraction of the base image holding data")
+parser.add_argument('--layer-fill', type=float, default=0.05, help="fraction rewritten by each layer above it")
+parser.add_argument('--domains', type=int, default=1000)
+parser.add_argument('--jobs-per-domain', type=int, default=1)
+parser.add_argument('--devices', type=int, default=4, help="storage devices the simulated fleet is spread over")
+parser.add_argument('--snapshots', type=int, default=100, help="snapshots of the domain for load_our_snapshot")
+parser.add_argument('--fleet-driver', choices=['mock', 'test'], default='mock',
+                    help="simulate domains in python, or in libvirt's test:/// driver")
+options = parser.parse_args()
+
+results = benchmark.run(Config(options.config), options)
+benchmark.save(results, options.output)
+for name, metrics in results['results'].items():
+    for key, value in metrics.items():
+        print(f"{name}.{key}: {value}")
+
+if options.baseline is not None:
+    comparison = benchmark.compare(results, benchmark.load(options.baseline), options.threshold)
+    for row in comparison:
+        flag = 'REGRESSION' if row['regression'] else ''
+        print(f"{row['metric']}: {row['baseline']:.6g} -> {row['current']:.6g} ({row['change']:+.1%} worse) {flag}")
+    if any(row['regression'] for row in comparison):
+        sys.exit(1)
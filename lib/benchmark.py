@@ -0,0 +1,417 @@
+import os
+import time
+import json
+import queue
+import random
+import shutil
+import socket
+import platform
+import subprocess
+import statistics
+import xml.etree.ElementTree as ET
+from uuid import uuid4
+from lib import qemu_utils
+from lib.copy_utils import CopyEngine
+from lib.limiter import ResourceLimiter
+from lib.libvirt_utils import SnapshotManager, VirtDupXML
+from lib.scheduler import Scheduler
+
+NAMESPACE = 'https://www.github.com/spencerharmon/virt-dup'
+MiB = 1024 * 1024
+
+
+class MockSnapshot(object):
+    def __init__(self, description):
+        self.xml = f"<domainsnapshot><description>{description}</description></domainsnapshot>"
+
+    def getXMLDesc(self, flags=0):
+        return self.xml
+
+
+class MockDomain(object):
+    '''
+    stands in for a virDomain: enough of it for VirtDupXML, the scheduler and load_our_snapshot.
+    '''
+    def __init__(self, name, uuid, disk_path, jobs, snapshots=()):
+        self.name_ = name
+        self.uuid = uuid
+        self.instance = '<virt-dup:instance xmlns:virt-dup="{ns}">{jobs}</virt-dup:instance>'.format(
+            ns=NAMESPACE,
+            jobs=''.join(f'<virt-dup:job uuid="{jobuuid}" schedule="{schedule}"/>' for jobuuid, schedule in jobs)
+        )
+        self.xml = f"""<domain type='kvm'>
+  <name>{name}</name>
+  <uuid>{uuid}</uuid>
+  <metadata>{self.instance}</metadata>
+  <devices>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2'/>
+      <source file='{disk_path}'/>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+  </devices>
+</domain>"""
+        self.snapshots = [MockSnapshot(description) for description in snapshots]
+
+    def UUIDString(self):
+        return self.uuid
+
+    def name(self):
+        return self.name_
+
+    def XMLDesc(self, flags=0):
+        return self.xml
+
+    def metadata(self, kind, uri, flags=0):
+        # libvirt returns the element without the namespace prefix.
+        return self.instance.replace('virt-dup:', '').replace(f' xmlns:virt-dup="{NAMESPACE}"', '')
+
+    def listAllSnapshots(self, flags=0):
+        return self.snapshots
+
+
+class MockDomXML(object):
+    def __init__(self, domain, jobs):
+        self.domain = domain
+        self.loaded_jobs = jobs
+
+
+class MockCache(object):
+    def __init__(self, entries):
+        self.entries = entries
+        self.generation = 1
+
+    def all_entries(self):
+        return self.entries
+
+
+class MockLibvirtUtils(object):
+    def __init__(self, entries):
+        self.cache = MockCache(entries)
+
+
+class FixedChainSnapshotManager(SnapshotManager):
+    '''
+    a SnapshotManager whose snapshot is a synthetic chain, so get_file_list can run without libvirt.
+    '''
+    def __init__(self, config, domxml, jobuuid, chain):
+        super().__init__(config, domxml, jobuuid)
+        self.chain = chain
+
+    def get_snap_files(self):
+        return {'vda': {'base': self.chain[-1], 'top': self.chain[-1] + '.overlay'}}
+
+
+def timed(function, repeat=1):
+    '''
+    :return: (list of seconds per call, last return value)
+    '''
+    times = []
+    ret = None
+    for n in range(repeat):
+        start = time.perf_counter()
+        ret = function()
+        times.append(time.perf_counter() - start)
+    return times, ret
+
+
+def summary(times):
+    return {'min_seconds': min(times),
+            'median_seconds': statistics.median(times),
+            'max_seconds': max(times)}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def build_chain(directory, size, depth, fill, layer_fill, seed=0):
+    '''
+    builds a synthetic qcow2 backing chain with qemu-img. The base has fill of its 1MiB blocks written with random
+    data, the rest left as holes; each layer above it rewrites layer_fill of the blocks. Layers are written with
+    `qemu-img convert -B`, so each holds only the blocks that differ from the layer below.
+    :param size: virtual size in bytes
+    :param depth: number of images in the chain
+    :return: list of image paths, base first.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    blocks = size // MiB
+    raw = os.path.join(directory, 'work.raw')
+    with open(raw, 'wb') as file:
+        file.truncate(size)
+    chain = []
+    fd = os.open(raw, os.O_WRONLY)
+    try:
+        for layer in range(depth):
+            fraction = fill if layer == 0 else layer_fill
+            for block in rng.sample(range(blocks), int(blocks * fraction)):
+                os.pwrite(fd, rng.getrandbits(8 * MiB).to_bytes(MiB, 'little'), block * MiB)
+            os.fsync(fd)
+            image = os.path.join(directory, f"layer-{layer}.qcow2")
+            command = ["qemu-img", "convert", "-q", "-f", "raw", "-O", "qcow2"]
+            if chain:
+                command += ["-B", chain[-1], "-F", "qcow2"]
+            subprocess.run(command + [raw, image], check=True, capture_output=True)
+            chain.append(image)
+    finally:
+        os.close(fd)
+        os.remove(raw)
+    return chain
+
+
+def mock_fleet(domains, jobs_per_domain, disk_path, schedule='* * * * *', snapshots=0):
+    '''
+    :return: list of DomainCache-style entries for a simulated fleet.
+    '''
+    entries = []
+    for n in range(domains):
+        uuid = str(uuid4())
+        jobs = [(str(uuid4()), schedule) for j in range(jobs_per_domain)]
+        domain = MockDomain(f"bench-{n}", uuid, disk_path, jobs,
+                            [str(uuid4()) for s in range(snapshots)])
+        entries.append({'domain': domain,
+                        'name': domain.name(),
+                        'xml': domain.XMLDesc(),
+                        'disks': [{'dev': 'vda', 'path': disk_path, 'backing': None,
+                                   'jobs': [jobuuid for jobuuid, schedule in jobs]}],
+                        'jobs': {jobuuid: {'uuid': jobuuid, 'schedule': schedule, 'depth': 0}
+                                 for jobuuid, schedule in jobs}})
+    return entries
+
+
+def test_driver_fleet(domains, jobs_per_domain, disk_path, schedule='* * * * *'):
+    '''
+    defines a simulated fleet in libvirt's test:/// driver, which keeps it in memory.
+    :return: (connection, list of virDomain)
+    '''
+    import libvirt
+    conn = libvirt.open('test:///default')
+    ret = []
+    for n in range(domains):
+        jobs = [(str(uuid4()), schedule) for j in range(jobs_per_domain)]
+        mock = MockDomain(f"bench-{n}", str(uuid4()), disk_path, jobs)
+        xml = ET.fromstring(mock.XMLDesc())
+        xml.remove(xml.find('metadata'))
+        xml.attrib['type'] = 'test'
+        ET.SubElement(xml, 'memory').text = '65536'
+        ET.SubElement(ET.SubElement(xml, 'os'), 'type').text = 'hvm'
+        domain = conn.defineXML(ET.tostring(xml).decode())
+        domain.setMetadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT, mock.metadata(None, NAMESPACE), 'virt-dup',
+                           NAMESPACE, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        ret.append(domain)
+    return conn, ret
+
+
+def bench_staging(config, chain, destination, repeat):
+    '''
+    copies the chain the way stage_image does, with the copy settings from virt-dup.yml.
+    '''
+    engine = CopyEngine(config.copy_workers, config.copy_chunk_size, config.sparse, config.checksum,
+                        config.checksum_block_size)
+    files = {source: os.path.join(destination, os.path.basename(source)) for source in chain}
+
+    def copy():
+        os.makedirs(destination, exist_ok=True)
+        ret = engine.copy_files(files)
+        shutil.rmtree(destination)
+        return ret
+
+    times, stats = timed(copy, repeat)
+    copied = sum(stat['bytes'] for stat in stats.values())
+    ret = summary(times)
+    ret['bytes'] = copied
+    ret['throughput_bytes_per_second'] = copied / ret['median_seconds']
+    return ret
+
+
+def clear_info_cache():
+    with qemu_utils._info_lock:
+        qemu_utils._info_cache.clear()
+        qemu_utils._latest_identity.clear()
+
+
+def bench_chain_resolution(chain, repeat):
+    def cold():
+        clear_info_cache()
+        return qemu_utils.backing_chain(chain[-1])
+
+    cold_times, resolved = timed(cold, repeat)
+    warm_times, resolved = timed(lambda: qemu_utils.backing_chain(chain[-1]), repeat)
+    # what a cold resolution cost when every chain went through qemu-img.
+    qemu_img_times, _ = timed(lambda: qemu_utils.img_info(chain[-1], backing_chain=True), repeat)
+    return {'cold_median_seconds': statistics.median(cold_times),
+            'warm_median_seconds': statistics.median(warm_times),
+            'qemu_img_median_seconds': statistics.median(qemu_img_times),
+            'images': len(resolved)}
+
+
+def bench_get_file_list(config, chain, repeat):
+    jobuuid = str(uuid4())
+    domain = MockDomain('bench-files', str(uuid4()), chain[-1], [(jobuuid, '* * * * *')])
+    domxml = MockDomXML(domain, {jobuuid: {'uuid': jobuuid, 'depth': 0}})
+    sm = FixedChainSnapshotManager(config, domxml, jobuuid, chain)
+    times, files = timed(sm.get_file_list, repeat)
+    ret = summary(times)
+    ret['files'] = len(files)
+    return ret
+
+
+def bench_load_our_snapshot(config, snapshots, repeat):
+    jobuuid = str(uuid4())
+    # ours is the last one listed, the worst case.
+    domain = MockDomain('bench-snapshots', str(uuid4()), '/dev/null', [(jobuuid, '* * * * *')],
+                        [str(uuid4()) for n in range(snapshots - 1)] + [jobuuid])
+    sm = SnapshotManager(config, MockDomXML(domain, {jobuuid: {'uuid': jobuuid, 'depth': 0}}), jobuuid)
+    times, snapshot = timed(sm.load_our_snapshot, repeat)
+    ret = summary(times)
+    ret['snapshots'] = snapshots
+    return ret
+
+
+def bench_fleet_load(config, domains, repeat):
+    '''
+    parses the job metadata of every domain, as the domain cache does when it is (re)loaded.
+    :param domains: virDomain or MockDomain objects
+    '''
+    times, parsed = timed(lambda: [VirtDupXML(config, domain).loaded_jobs for domain in domains], repeat)
+    ret = summary(times)
+    ret['domains'] = len(domains)
+    ret['jobs'] = sum(len(jobs) for jobs in parsed)
+    return ret
+
+
+def bench_scheduler(config, entries, workers, devices):
+    '''
+    runs job_monitor's steps over a simulated fleet whose jobs are all due in the same minute, then the
+    dispatcher's ResourceLimiter with jobs finishing as soon as they start. Dispatch latency is from the start of
+    the job_monitor pass which fired a job to the limiter handing it to a worker, so it measures virt-dup's own
+    overhead, not time spent waiting for real jobs.
+    '''
+    scheduler = Scheduler.__new__(Scheduler)
+    scheduler.config = config
+    scheduler.lu = MockLibvirtUtils(entries)
+    scheduler.job_q = queue.Queue()
+    scheduler.jobs = {}
+    scheduler.heap = []
+    now = time.time()
+    ret = {}
+    times, result = timed(lambda: scheduler.refresh_jobs(now))
+    ret['refresh_cold_seconds'] = times[0]
+    times, result = timed(lambda: scheduler.refresh_jobs(now))
+    ret['refresh_warm_seconds'] = times[0]
+    due = max(fire_time for fire_time, priority, jobuuid, kind in scheduler.heap)
+    tick_start = time.perf_counter()
+    scheduler.fire_due_jobs(due)
+    ret['tick_seconds'] = time.perf_counter() - tick_start
+    ret['jobs_fired'] = scheduler.job_q.qsize()
+
+    limiter = ResourceLimiter(config.max_jobs)
+    n = 0
+    while not scheduler.job_q.empty():
+        c = scheduler.job_q.get_nowait()
+        resources = {'devices': {n % devices}, 'backends': set(),
+                     'max_per_device': config.max_jobs_per_device, 'max_per_backend': config.max_jobs_per_backend}
+        limiter.add(c['jobuuid'], c, resources)
+        n += 1
+    latencies = []
+    while limiter.pending:
+        started = limiter.ready(slots=workers)
+        now = time.perf_counter()
+        for jobuuid, c in started:
+            latencies.append(now - tick_start)
+            limiter.release(jobuuid)
+    ret['dispatch_latency_p50_seconds'] = percentile(latencies, 0.5)
+    ret['dispatch_latency_p99_seconds'] = percentile(latencies, 0.99)
+    ret['dispatch_latency_max_seconds'] = max(latencies)
+    return ret
+
+
+def run(config, options):
+    '''
+    :param config: Config. staging_path is pointed into options.workdir.
+    :param options: argparse namespace from benchmark.py
+    :return: results dict, as below. Keys ending in _seconds are better lower, _per_second better higher.
+    {
+        'meta': {'time': 1551669947, 'host': 'kvm01', 'python': '3.7.3', 'options': {...}},
+        'results': {'staging': {'median_seconds': 1.2, 'throughput_bytes_per_second': 894784853.3, ...}, ...}
+    }
+    '''
+    workdir = os.path.abspath(options.workdir)
+    config.staging_path = os.path.join(workdir, 'staging') + '/'
+    selected = set(options.only) if options.only else None
+    results = {}
+
+    def wanted(name):
+        return selected is None or name in selected
+
+    chain = None
+    if wanted('staging') or wanted('chain_resolution') or wanted('get_file_list'):
+        chain = build_chain(os.path.join(workdir, 'images'), options.size, options.depth, options.fill,
+                            options.layer_fill, options.seed)
+    if wanted('staging'):
+        results['staging'] = bench_staging(config, chain, os.path.join(workdir, 'staged'), options.repeat)
+    if wanted('chain_resolution'):
+        results['chain_resolution'] = bench_chain_resolution(chain, options.repeat)
+    if wanted('get_file_list'):
+        results['get_file_list'] = bench_get_file_list(config, chain, options.repeat)
+    if wanted('load_our_snapshot'):
+        results['load_our_snapshot'] = bench_load_our_snapshot(config, options.snapshots, options.repeat)
+    if wanted('fleet_load'):
+        if options.fleet_driver == 'test':
+            conn, domains = test_driver_fleet(options.domains, options.jobs_per_domain, '/dev/null')
+        else:
+            domains = [entry['domain']
+                       for entry in mock_fleet(options.domains, options.jobs_per_domain, '/dev/null')]
+        results['fleet_load'] = bench_fleet_load(config, domains, options.repeat)
+    if wanted('scheduler'):
+        results['scheduler'] = bench_scheduler(config, mock_fleet(options.domains, options.jobs_per_domain,
+                                                                  '/dev/null'),
+                                               config.workers, options.devices)
+    if not options.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {'meta': {'time': int(time.time()),
+                     'host': socket.gethostname(),
+                     'python': platform.python_version(),
+                     'options': vars(options)},
+            'results': results}
+
+
+def compare(results, baseline, threshold=0.1):
+    '''
+    compares each timing and throughput with the baseline's.
+    :param threshold: fraction by which a metric may be worse before it counts as a regression
+    :return: list of dicts, one per metric found in both. {'metric': 'staging.median_seconds', 'baseline': 1.0,
+    'current': 1.3, 'change': 0.3, 'regression': True}
+    '''
+    ret = []
+    for name, metrics in results['results'].items():
+        for key, value in metrics.items():
+            try:
+                old = baseline['results'][name][key]
+            except KeyError:
+                continue
+            if key.endswith('_per_second'):
+                worse = (old - value) / old if old else 0
+            elif key.endswith('_seconds'):
+                worse = (value - old) / old if old else 0
+            else:
+                continue
+            ret.append({'metric': f"{name}.{key}",
+                        'baseline': old,
+                        'current': value,
+                        'change': worse,
+                        'regression': worse > threshold})
+    return ret
+
+
+def load(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def save(results, path):
+    with open(path + '.tmp', 'w') as file:
+        json.dump(results, file, indent=2)
+    os.replace(path + '.tmp', path)
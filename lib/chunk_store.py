@@ -0,0 +1,292 @@
+import os
+import time
+import json
+import fcntl
+import struct
+import sqlite3
+import hashlib
+import logging
+
+READ_SIZE = 8 * 1024 * 1024
+
+
+def _gear_table():
+    # 256 pseudo-random 64 bit values. Derived from sha256 so every store chunks identically.
+    table = []
+    for n in range(256):
+        table.append(struct.unpack('<Q', hashlib.sha256(b'virt-dup gear %d' % n).digest()[:8])[0])
+    return table
+
+
+GEAR = _gear_table()
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+def _mask(bits):
+    # spread the mask bits over the top of the word, where the gear hash mixes best.
+    mask = 0
+    for n in range(bits):
+        mask |= 1 << (63 - n * 3)
+    return mask
+
+
+class FixedChunker(object):
+    '''
+    Cuts files into chunks of a fixed size. With a multiple of the qcow2 cluster size, chunks line up with clusters,
+    so a cluster is deduplicated wherever it sits, in whichever image. Disk images change in place rather than by
+    insertion, so this finds about as much as content-defined chunking, at the speed of sha256 instead of that of
+    a per-byte python loop. The default.
+    '''
+    def __init__(self, size=64 * 1024):
+        self.size = size
+
+    def chunks(self, file):
+        '''
+        :param file: binary file object
+        :return: generator of chunks (bytes-like), in file order.
+        '''
+        while True:
+            data = file.read(READ_SIZE - READ_SIZE % self.size)
+            if not data:
+                return
+            view = memoryview(data)
+            for start in range(0, len(data), self.size):
+                yield view[start:start + self.size]
+
+
+class Chunker(object):
+    '''
+    Content-defined chunking with a gear rolling hash and FastCDC's normalised chunking: a cut point is harder to
+    hit before avg_size and easier after it, which keeps chunk sizes close to the average. Because cut points
+    depend only on nearby content, an insertion only changes the chunks around it.
+    Runs of zeroes (holes in thin images) are cut at max_size without hashing them byte by byte.
+    The boundary search is pure python and does about 15MB/s, so this is only used with chunk-mode: cdc.
+    '''
+    def __init__(self, min_size=16 * 1024, avg_size=64 * 1024, max_size=256 * 1024):
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = max(1, avg_size.bit_length() - 1)
+        self.mask_s = _mask(bits + 1)
+        self.mask_l = _mask(bits - 1)
+        self.zero = bytes(max_size)
+
+    def cut(self, data, start, end):
+        '''
+        :return: index in data at which the chunk starting at start ends. end is the end of available data.
+        '''
+        if end - start <= self.min_size:
+            return end
+        stop = min(end, start + self.max_size)
+        if data[start:stop] == self.zero[:stop - start]:
+            return stop
+        gear = GEAR
+        h = 0
+        i = start + self.min_size
+        normal = min(stop, start + self.avg_size)
+        mask = self.mask_s
+        while i < normal:
+            h = ((h << 1) + gear[data[i]]) & MASK64
+            i += 1
+            if not h & mask:
+                return i
+        mask = self.mask_l
+        while i < stop:
+            h = ((h << 1) + gear[data[i]]) & MASK64
+            i += 1
+            if not h & mask:
+                return i
+        return stop
+
+    def chunks(self, file):
+        '''
+        :param file: binary file object
+        :return: generator of chunk bytes, in file order.
+        '''
+        buf = b''
+        eof = False
+        while True:
+            if not eof and len(buf) < self.max_size:
+                data = file.read(READ_SIZE)
+                if data:
+                    buf += data
+                else:
+                    eof = True
+            if not buf:
+                return
+            start = 0
+            # only cut where a whole max_size window is available, unless the file has ended.
+            while len(buf) - start >= self.max_size or (eof and start < len(buf)):
+                end = self.cut(buf, start, len(buf))
+                yield buf[start:end]
+                start = end
+            buf = buf[start:]
+
+
+class ChunkStore(object):
+    '''
+    Stores files as content-defined chunks, each unique chunk once, under its sha256.
+    Layout:
+        chunks/ab/cd/<sha256>     chunk data
+        manifests/<name>.json     ordered list of [sha256, length] for one stored file
+        index.sqlite              chunk sizes and reference counts, for membership checks and garbage collection
+        lock                      held shared while files are added and exclusively by gc()
+    Several processes may add to the same store; sqlite serialises index updates. gc() waits for files being
+    added, so it never deletes a chunk which add_file() found present and is about to reference.
+    '''
+    def __init__(self, path, chunker=None):
+        self.path = path
+        self.chunker = FixedChunker() if chunker is None else chunker
+        os.makedirs(os.path.join(self.path, 'chunks'), exist_ok=True)
+        os.makedirs(os.path.join(self.path, 'manifests'), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.path, 'index.sqlite'), timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, size INTEGER, refs INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS manifests (name TEXT PRIMARY KEY, created INTEGER)')
+        self.db.commit()
+        self.lock = open(os.path.join(self.path, 'lock'), 'a')
+
+    def chunk_path(self, digest):
+        return os.path.join(self.path, 'chunks', digest[0:2], digest[2:4], digest)
+
+    def manifest_path(self, name):
+        return os.path.join(self.path, 'manifests', name + '.json')
+
+    def has_chunk(self, digest):
+        return self.db.execute('SELECT 1 FROM chunks WHERE hash = ?', (digest,)).fetchone() is not None
+
+    def add_file(self, source, name):
+        '''
+        chunks source and stores any chunks the store doesn't have yet.
+        :param source: file to store
+        :param name: manifest name. May contain '/' to group manifests, e.g. by job.
+        :return: dict as below.
+        {
+            'bytes': 10737418240,
+            'chunks': 163840,
+            'new_chunks': 2048,
+            'new_bytes': 134217728,
+            'seconds': 95.1
+        }
+        '''
+        start = time.time()
+        manifest = []
+        stats = {'bytes': 0, 'chunks': 0, 'new_chunks': 0, 'new_bytes': 0}
+        # digests of all-zero chunks by length; holes are most of a thin image.
+        zeroes = {}
+        fcntl.flock(self.lock, fcntl.LOCK_SH)
+        try:
+            with open(source, 'rb') as file:
+                for chunk in self.chunker.chunks(file):
+                    length = len(chunk)
+                    if length not in zeroes:
+                        zeroes[length] = (bytes(length), hashlib.sha256(bytes(length)).hexdigest())
+                    if chunk == zeroes[length][0]:
+                        digest = zeroes[length][1]
+                    else:
+                        digest = hashlib.sha256(chunk).hexdigest()
+                    manifest.append([digest, length])
+                    stats['bytes'] += length
+                    stats['chunks'] += 1
+                    if not self.has_chunk(digest) and not os.path.exists(self.chunk_path(digest)):
+                        self.write_chunk(digest, chunk)
+                        stats['new_chunks'] += 1
+                        stats['new_bytes'] += length
+            self.write_manifest(name, manifest)
+        finally:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+        stats['seconds'] = time.time() - start
+        logging.info(f"Stored {source} as {name}: {stats['chunks']} chunks, {stats['new_chunks']} new "
+                     f"({stats['new_bytes']} of {stats['bytes']} bytes)")
+        return stats
+
+    def write_chunk(self, digest, chunk):
+        pathname = self.chunk_path(digest)
+        os.makedirs(os.path.dirname(pathname), exist_ok=True)
+        tmp = f"{pathname}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as file:
+            file.write(chunk)
+        os.replace(tmp, pathname)
+
+    def write_manifest(self, name, manifest):
+        '''
+        writes the manifest and takes a reference on each of its chunks. Replacing a manifest releases the
+        references of the old one.
+        '''
+        pathname = self.manifest_path(name)
+        os.makedirs(os.path.dirname(pathname), exist_ok=True)
+        with self.db:
+            if self.db.execute('SELECT 1 FROM manifests WHERE name = ?', (name,)).fetchone() is not None:
+                self._release(self.read_manifest(name))
+            for digest, length in manifest:
+                self.db.execute('INSERT INTO chunks (hash, size, refs) VALUES (?, ?, 1) '
+                                'ON CONFLICT(hash) DO UPDATE SET refs = refs + 1', (digest, length))
+            self.db.execute('INSERT OR REPLACE INTO manifests (name, created) VALUES (?, ?)',
+                            (name, int(time.time())))
+            with open(pathname + '.tmp', 'w') as file:
+                json.dump(manifest, file)
+            os.replace(pathname + '.tmp', pathname)
+
+    def read_manifest(self, name):
+        with open(self.manifest_path(name)) as file:
+            return json.load(file)
+
+    def _release(self, manifest):
+        for digest, length in manifest:
+            self.db.execute('UPDATE chunks SET refs = refs - 1 WHERE hash = ?', (digest,))
+
+    def remove_manifest(self, name):
+        '''
+        forgets a stored file. Its chunks are deleted by gc() once nothing else references them.
+        '''
+        with self.db:
+            self._release(self.read_manifest(name))
+            self.db.execute('DELETE FROM manifests WHERE name = ?', (name,))
+        os.remove(self.manifest_path(name))
+
+    def manifests(self, prefix=''):
+        '''
+        :return: names of the stored files whose name starts with prefix, e.g. '<job uuid>/'.
+        '''
+        rows = self.db.execute('SELECT name FROM manifests WHERE substr(name, 1, ?) = ? ORDER BY name',
+                               (len(prefix), prefix)).fetchall()
+        return [row[0] for row in rows]
+
+    def restore(self, name, dest):
+        '''
+        reassembles a stored file. All-zero chunks are left as holes.
+        '''
+        with open(dest, 'wb') as out:
+            for digest, length in self.read_manifest(name):
+                with open(self.chunk_path(digest), 'rb') as file:
+                    chunk = file.read()
+                if chunk == bytes(length):
+                    out.seek(length, os.SEEK_CUR)
+                else:
+                    out.write(chunk)
+            out.truncate()
+
+    def gc(self):
+        '''
+        deletes chunks no manifest references. Waits for files being added.
+        :return: (chunks removed, bytes freed)
+        '''
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            with self.db:
+                unreferenced = self.db.execute('SELECT hash, size FROM chunks WHERE refs <= 0').fetchall()
+                self.db.execute('DELETE FROM chunks WHERE refs <= 0')
+            freed = 0
+            for digest, size in unreferenced:
+                try:
+                    os.remove(self.chunk_path(digest))
+                    freed += size
+                except FileNotFoundError:
+                    pass
+        finally:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+        logging.info(f"Chunk store gc removed {len(unreferenced)} chunks, {freed} bytes.")
+        return len(unreferenced), freed
+
+    def close(self):
+        self.db.close()
+        self.lock.close()
@@ -0,0 +1,199 @@
+import os
+import time
+import zlib
+import struct
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from lib.exceptions.pipeline_exceptions import MissingDependency, UnknownCodec, BadFrame
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+# Framed, seekable block format written by compress_file:
+#
+#     header   MAGIC, version (B), codec id (B), block size (Q), raw file size (Q)
+#     blocks   each block compressed on its own
+#     index    one INDEX_ENTRY per block: offset of the compressed block, its compressed length. A compressed
+#              length of 0 means the block is all zeroes and was not stored.
+#     trailer  offset of the index (Q), number of blocks (Q), MAGIC
+#
+# Every block but the last is block size bytes of the original file, so block n starts at n * block size and
+# any block can be found and decompressed on its own, by any number of threads.
+MAGIC = b'VDBZ'
+VERSION = 1
+HEADER = struct.Struct('<4sBBQQ')
+INDEX_ENTRY = struct.Struct('<QQ')
+TRAILER = struct.Struct('<QQ4s')
+SUFFIX = '.vdz'
+
+
+def _zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data, size):
+    return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+
+
+def _lz4_compress(data, level):
+    '''
+    levels map onto lz4's modes the way the lz4 command line's do: 3 to 12 use high compression mode at that
+    level, 1 and 2 the default fast mode, and 0 or less fast mode with acceleration -level (faster, and worse).
+    '''
+    if level >= 3:
+        return lz4.block.compress(data, mode='high_compression', compression=min(level, 12), store_size=False)
+    if level >= 1:
+        return lz4.block.compress(data, mode='default', store_size=False)
+    return lz4.block.compress(data, mode='fast', acceleration=max(-level, 1), store_size=False)
+
+
+def _lz4_decompress(data, size):
+    return lz4.block.decompress(data, uncompressed_size=size)
+
+
+def _zlib_compress(data, level):
+    # compression-level is shared with zstd, whose levels go up to 22; zlib's stop at 9.
+    return zlib.compress(data, min(max(level, 0), 9))
+
+
+def _zlib_decompress(data, size):
+    return zlib.decompress(data)
+
+
+# name: (id, module, compress, decompress)
+CODECS = {
+    'zstd': (1, 'zstandard', _zstd_compress, _zstd_decompress),
+    'lz4': (2, 'lz4', _lz4_compress, _lz4_decompress),
+    'zlib': (3, 'zlib', _zlib_compress, _zlib_decompress),
+}
+
+
+def codec_available(name):
+    return name == 'zlib' or (name == 'zstd' and zstandard is not None) or (name == 'lz4' and lz4 is not None)
+
+
+def _codec(name):
+    if name not in CODECS.keys():
+        raise UnknownCodec(name)
+    if not codec_available(name):
+        raise MissingDependency(name, CODECS[name][1])
+    return CODECS[name]
+
+
+def _codec_by_id(codec_id):
+    for name, codec in CODECS.items():
+        if codec[0] == codec_id:
+            return name, _codec(name)
+    raise UnknownCodec(codec_id)
+
+
+def compress_file(source, dest, codec='zstd', level=3, block_size=4 * 1024 * 1024, threads=4):
+    '''
+    compresses source into dest in the framed block format above, compressing blocks on a thread pool.
+    zstandard, lz4 and zlib all release the GIL while compressing.
+    :return: dict of statistics, as below.
+    {
+        'codec': 'zstd',
+        'level': 3,
+        'bytes_in': 10737418240,
+        'bytes_out': 2147483648,
+        'ratio': 5.0,
+        'seconds': 21.4,
+        'throughput': 501736151.4
+    }
+    '''
+    codec_id, module, compress, decompress = _codec(codec)
+    start = time.time()
+    size = os.path.getsize(source)
+    count = (size + block_size - 1) // block_size
+    zero = bytes(block_size)
+
+    def compress_block(n):
+        with open(source, 'rb') as file:
+            file.seek(n * block_size)
+            data = file.read(block_size)
+        if data == zero[:len(data)]:
+            return b''
+        return compress(data, level)
+
+    index = []
+    with open(dest, 'wb') as out, ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        out.write(HEADER.pack(MAGIC, VERSION, codec_id, block_size, size))
+        offset = HEADER.size
+        # keep a bounded number of blocks in flight and write them in order.
+        window = max(1, threads) * 2
+        futures = [pool.submit(compress_block, n) for n in range(min(window, count))]
+        for n in range(count):
+            data = futures[n].result()
+            futures[n] = None
+            if n + window < count:
+                futures.append(pool.submit(compress_block, n + window))
+            out.write(data)
+            index.append((offset, len(data)))
+            offset += len(data)
+        for entry in index:
+            out.write(INDEX_ENTRY.pack(*entry))
+        out.write(TRAILER.pack(offset, count, MAGIC))
+    bytes_out = os.path.getsize(dest)
+    seconds = max(time.time() - start, 1e-9)
+    stats = {'codec': codec,
+             'level': level,
+             'bytes_in': size,
+             'bytes_out': bytes_out,
+             'ratio': size / bytes_out if bytes_out else 0,
+             'seconds': seconds,
+             'throughput': size / seconds}
+    logging.info(f"Compressed {source} with {codec} level {level}: ratio {stats['ratio']:.2f}, "
+                 f"{stats['throughput'] / 1024 / 1024:.1f} MiB/s")
+    return stats
+
+
+def read_index(source):
+    '''
+    :return: (codec name, block size, raw size, list of (offset, compressed length))
+    '''
+    with open(source, 'rb') as file:
+        magic, version, codec_id, block_size, size = HEADER.unpack(file.read(HEADER.size))
+        file.seek(-TRAILER.size, os.SEEK_END)
+        index_offset, count, trailer_magic = TRAILER.unpack(file.read(TRAILER.size))
+        if magic != MAGIC or trailer_magic != MAGIC or version != VERSION:
+            raise BadFrame(source)
+        file.seek(index_offset)
+        raw = file.read(count * INDEX_ENTRY.size)
+    name, codec = _codec_by_id(codec_id)
+    return name, block_size, size, [INDEX_ENTRY.unpack_from(raw, n * INDEX_ENTRY.size) for n in range(count)]
+
+
+def decompress_file(source, dest, threads=4):
+    '''
+    restores a file written by compress_file, decompressing blocks in parallel. All-zero blocks are left as
+    holes in dest.
+    '''
+    name, block_size, size, index = read_index(source)
+    decompress = CODECS[name][3]
+
+    def decompress_block(n):
+        offset, length = index[n]
+        if length == 0:
+            return
+        raw_length = min(block_size, size - n * block_size)
+        with open(source, 'rb') as file:
+            file.seek(offset)
+            data = decompress(file.read(length), raw_length)
+        fd = os.open(dest, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, n * block_size)
+        finally:
+            os.close(fd)
+
+    with open(dest, 'wb') as file:
+        file.truncate(size)
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        for future in [pool.submit(decompress_block, n) for n in range(len(index))]:
+            future.result()
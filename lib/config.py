@@ -12,6 +12,9 @@ class Config(object):
         self.libvirt_uri = "qemu+tcp://localhost/system"
         self.libvirt_flags = 0 #cannot be None
         self.libvirt_connection_type_socket = False
+        self.libvirt_keepalive_interval = 5
+        self.libvirt_keepalive_count = 3
+        self.libvirt_reconnect_attempts = 8
 
         self.parse(path)
 
@@ -38,6 +41,18 @@ class Config(object):
             self.libvirt_connection_type_socket = config['libvirt-socket']
         except:
             pass
+        try:
+            self.libvirt_keepalive_interval = int(config['libvirt-keepalive-interval'])
+        except:
+            pass
+        try:
+            self.libvirt_keepalive_count = int(config['libvirt-keepalive-count'])
+        except:
+            pass
+        try:
+            self.libvirt_reconnect_attempts = int(config['libvirt-reconnect-attempts'])
+        except:
+            pass
         try:
             self.staging_path = config['staging-path']
         except:
@@ -50,6 +65,154 @@ class Config(object):
             self.default_schedule = config['default-schedule']
         except:
             self.default_schedule = "0 0 * * *"
+        try:
+            self.job_refresh_interval = int(config['job-refresh-interval'])
+        except:
+            self.job_refresh_interval = 600
+        try:
+            self.workers = int(config['workers'])
+        except:
+            self.workers = 4
+        try:
+            self.max_jobs = int(config['max-jobs'])
+        except:
+            self.max_jobs = 0
+        try:
+            self.max_jobs_per_device = int(config['max-jobs-per-device'])
+        except:
+            self.max_jobs_per_device = 2
+        try:
+            self.max_jobs_per_backend = int(config['max-jobs-per-backend'])
+        except:
+            self.max_jobs_per_backend = 0
+        try:
+            self.backup_mode = config['backup-mode']
+        except:
+            self.backup_mode = 'staging'
+        try:
+            self.stream_backend = config['stream-backend']
+        except:
+            self.stream_backend = None
+        try:
+            self.stream_stages = list(config['stream-stages'])
+        except:
+            self.stream_stages = ['checksum', 'compress']
+        try:
+            self.compression_level = int(config['compression-level'])
+        except:
+            self.compression_level = 6
+        try:
+            self.chunk_store = config['chunk-store']
+        except:
+            self.chunk_store = None
+        try:
+            self.chunk_mode = config['chunk-mode']
+        except:
+            self.chunk_mode = 'fixed'
+        try:
+            self.chunk_size = int(config['chunk-size'])
+        except:
+            self.chunk_size = 64 * 1024
+        try:
+            self.chunk_store_retention = int(config['chunk-store-retention'])
+        except:
+            self.chunk_store_retention = 0
+        try:
+            self.staging_compression = config['staging-compression']
+        except:
+            self.staging_compression = 'none'
+        try:
+            self.compression_threads = int(config['compression-threads'])
+        except:
+            self.compression_threads = 4
+        try:
+            self.compression_block_size = int(config['compression-block-size'])
+        except:
+            self.compression_block_size = 4 * 1024 * 1024
+        try:
+            self.encryption_key_file = config['encryption-key-file']
+        except:
+            self.encryption_key_file = None
+        try:
+            self.copy_workers = int(config['copy-workers'])
+        except:
+            self.copy_workers = 4
+        try:
+            self.copy_chunk_size = int(config['copy-chunk-size'])
+        except:
+            self.copy_chunk_size = 256 * 1024 * 1024
+        try:
+            self.sparse = bool(config['sparse'])
+        except:
+            self.sparse = True
+        try:
+            self.metrics_textfile = config['metrics-textfile']
+        except:
+            self.metrics_textfile = None
+        try:
+            self.metrics_listen = config['metrics-listen']
+        except:
+            self.metrics_listen = None
+        try:
+            self.copy_bandwidth = int(config['copy-bandwidth'])
+        except:
+            self.copy_bandwidth = 0
+        try:
+            self.copy_iops = int(config['copy-iops'])
+        except:
+            self.copy_iops = 0
+        try:
+            self.host_copy_bandwidth = int(config['host-copy-bandwidth'])
+        except:
+            self.host_copy_bandwidth = 0
+        try:
+            self.host_copy_iops = int(config['host-copy-iops'])
+        except:
+            self.host_copy_iops = 0
+        try:
+            self.commit_bandwidth = int(config['commit-bandwidth'])
+        except:
+            self.commit_bandwidth = 0
+        try:
+            self.host_commit_bandwidth = int(config['host-commit-bandwidth'])
+        except:
+            self.host_commit_bandwidth = 0
+        try:
+            self.adaptive_throttle = bool(config['adaptive-throttle'])
+        except:
+            self.adaptive_throttle = False
+        try:
+            self.adaptive_max_await = float(config['adaptive-max-await'])
+        except:
+            self.adaptive_max_await = 20.0
+        try:
+            self.adaptive_max_queue_depth = int(config['adaptive-max-queue-depth'])
+        except:
+            self.adaptive_max_queue_depth = 8
+        try:
+            self.overlay_path = config['overlay-path']
+        except:
+            self.overlay_path = None
+        try:
+            self.overlay_min_free = int(config['overlay-min-free'])
+        except:
+            self.overlay_min_free = 1024 * 1024 * 1024
+        try:
+            self.offline_backup = bool(config['offline-backup'])
+        except:
+            self.offline_backup = True
+        try:
+            self.reflink = bool(config['reflink'])
+        except:
+            self.reflink = False
+        try:
+            self.checksum = config['checksum']
+        except:
+            self.checksum = 'none'
+        try:
+            self.checksum_block_size = int(config['checksum-block-size'])
+        except:
+            self.checksum_block_size = 4 * 1024 * 1024
 
         logging.info(f"Loaded options from virt-dup.yml: {config}")
 
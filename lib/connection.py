@@ -0,0 +1,173 @@
+import libvirt
+import threading
+import logging
+import time
+import os
+from lib import event_utils
+from lib.exceptions.libvirt_exceptions import OpenFailed
+
+_lock = threading.Lock()
+# connection key: ManagedConnection
+_pool = {}
+
+
+def _forget_inherited_connections():
+    '''
+    runs in the child after a fork. The parent's connections belong to the parent: they're dropped without being
+    closed, as closing them would talk to libvirtd on the parent's socket. virt-dup spawns its processes, so this
+    only matters to code forking on its own.
+    '''
+    global _lock
+    _lock = threading.Lock()
+    _pool.clear()
+
+
+os.register_at_fork(after_in_child=_forget_inherited_connections)
+
+
+def connection_key(config):
+    '''
+    connections are shared by everything in a process using the same uri and credentials.
+    '''
+    return (config.libvirt_connection_type_socket,
+            config.libvirt_uri,
+            config.libvirt_user,
+            config.libvirt_pw,
+            config.libvirt_flags)
+
+
+def get_connection(config):
+    '''
+    :param config: Config
+    :return: this process's ManagedConnection for config's uri and credentials, opened on first use.
+    Give it back with release_connection().
+    '''
+    key = connection_key(config)
+    with _lock:
+        managed = _pool.get(key)
+        if managed is None:
+            managed = ManagedConnection(config)
+            _pool[key] = managed
+        managed.refs += 1
+    return managed
+
+
+def release_connection(managed):
+    '''
+    closes the connection once nothing in this process uses it any more. To keep a connection over a config
+    reload, get the new one before releasing the old one.
+    '''
+    with _lock:
+        managed.refs -= 1
+        if managed.refs <= 0:
+            if _pool.get(managed.key) is managed:
+                _pool.pop(managed.key)
+            managed.close()
+
+
+class ManagedConnection(object):
+    '''
+    A libvirt connection with keepalive which reopens itself, with exponential backoff, when libvirtd goes away.
+    Use the conn attribute rather than holding on to the virConnect object. Listeners added with add_listener
+    are called with the new virConnect after a reconnect so they can re-register events and drop stale objects.
+    '''
+    def __init__(self, config):
+        self.key = connection_key(config)
+        self.refs = 0
+        self.uri = config.libvirt_uri
+        self.user = config.libvirt_user
+        self.pw = config.libvirt_pw
+        self.flags = config.libvirt_flags
+        self.socket = config.libvirt_connection_type_socket
+        self.keepalive_interval = config.libvirt_keepalive_interval
+        self.keepalive_count = config.libvirt_keepalive_count
+        self.reconnect_attempts = config.libvirt_reconnect_attempts
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.closed = False
+        self._conn = None
+        self._conn = self.connect()
+
+    def _auth_callback(self, credentials, user_data):
+        for credential in credentials:
+            if credential[0] == libvirt.VIR_CRED_AUTHNAME:
+                credential[4] = self.user
+            elif credential[0] == libvirt.VIR_CRED_PASSPHRASE:
+                credential[4] = self.pw
+            else:
+                return -1
+        return 0
+
+    def open(self):
+        # connections only deliver events and keepalives if the event loop exists before they're opened.
+        event_utils.start_event_loop()
+        auth = [[libvirt.VIR_CRED_AUTHNAME, libvirt.VIR_CRED_PASSPHRASE], self._auth_callback, None]
+        if self.socket:
+            conn = libvirt.open('qemu:///system')
+        else:
+            conn = libvirt.openAuth(self.uri, auth, self.flags)
+        if conn is None:
+            raise OpenFailed(self.uri)
+        if self.keepalive_interval > 0:
+            conn.setKeepAlive(self.keepalive_interval, self.keepalive_count)
+        conn.registerCloseCallback(self._close_callback, None)
+        return conn
+
+    def connect(self):
+        '''
+        opens the connection, retrying with exponential backoff.
+        :return: virConnect
+        '''
+        delay = 1
+        for attempt in range(self.reconnect_attempts):
+            try:
+                return self.open()
+            except (libvirt.libvirtError, OpenFailed) as e:
+                if attempt == self.reconnect_attempts - 1:
+                    raise OpenFailed(self.uri)
+                logging.warning(f"Connecting to {self.uri} failed ({e}). Retrying in {delay}s.")
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+        raise OpenFailed(self.uri)
+
+    def _close_callback(self, conn, reason, opaque):
+        logging.warning(f"Connection to {self.uri} closed, reason {reason}. Reconnecting on next use.")
+
+    @property
+    def conn(self):
+        reconnected = None
+        with self.lock:
+            if self.closed:
+                raise OpenFailed(self.uri)
+            try:
+                alive = self._conn.isAlive()
+            except libvirt.libvirtError:
+                alive = False
+            if not alive:
+                try:
+                    self._conn.close()
+                except libvirt.libvirtError:
+                    pass
+                self._conn = reconnected = self.connect()
+            conn = self._conn
+        if reconnected is not None:
+            logging.info(f"Reconnected to {self.uri}.")
+            for listener in list(self.listeners):
+                listener(reconnected)
+        return conn
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            try:
+                self._conn.unregisterCloseCallback()
+                self._conn.close()
+            except libvirt.libvirtError:
+                pass
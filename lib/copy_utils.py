@@ -0,0 +1,448 @@
+import os
+import errno
+import time
+import logging
+import fcntl
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lib.exceptions.pipeline_exceptions import MissingDependency
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# errors from copy_file_range/sendfile which mean "not supported here", not "copy failed".
+FALLBACK_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+# FICLONE from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# errors from FICLONE which mean the filesystems can't share extents between these two files.
+REFLINK_ERRNOS = FALLBACK_ERRNOS + (errno.ENOTTY, errno.EBADF, errno.EPERM)
+
+
+def new_hash(algorithm):
+    '''
+    :param algorithm: 'blake3' or any hashlib algorithm name
+    :return: hash object
+    '''
+    if algorithm == 'blake3':
+        if blake3 is None:
+            raise MissingDependency('checksum', 'blake3')
+        return blake3.blake3()
+    return hashlib.new(algorithm)
+
+
+def tree_digest(algorithm, blocks):
+    '''
+    the whole-file digest is the hash of the concatenated block digests, so it can be computed from block digests
+    which were produced out of order, by several threads.
+    :param blocks: list of hex block digests, in file order
+    '''
+    digest = new_hash(algorithm)
+    for block in blocks:
+        digest.update(bytes.fromhex(block))
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=64)
+def zero_digest(algorithm, length):
+    '''
+    digest of length zero bytes, for the holes skipped by sparse copies. Nearly every hole is block_size long, so
+    this is cached rather than hashing megabytes of zeros for each one.
+    '''
+    digest = new_hash(algorithm)
+    digest.update(bytes(length))
+    return digest.hexdigest()
+
+
+def file_checksum(path, algorithm='sha256', block_size=4 * 1024 * 1024):
+    '''
+    reads path and checksums it the same way CopyEngine does while copying.
+    :return: dict as below.
+    {
+        'algorithm': 'sha256',
+        'block_size': 4194304,
+        'digest': '9f86d08...',
+        'blocks': ['2c26b46...', ...]
+    }
+    '''
+    blocks = []
+    with open(path, 'rb') as file:
+        while True:
+            buf = file.read(block_size)
+            if not buf:
+                break
+            digest = new_hash(algorithm)
+            digest.update(buf)
+            blocks.append(digest.hexdigest())
+    return {'algorithm': algorithm, 'block_size': block_size, 'digest': tree_digest(algorithm, blocks),
+            'blocks': blocks}
+
+
+def update_checksum(path, checksum, indexes):
+    '''
+    re-reads only the given blocks of path, e.g. the header block after a qemu-img rebase -u rewrote the backing
+    file name. Falls back to reading the whole file if its size no longer matches the checksum.
+    :param checksum: dict from file_checksum() or CopyEngine
+    :param indexes: block numbers to re-read
+    :return: updated checksum dict
+    '''
+    algorithm = checksum['algorithm']
+    block_size = checksum['block_size']
+    size = os.path.getsize(path)
+    if (size + block_size - 1) // block_size != len(checksum['blocks']):
+        return file_checksum(path, algorithm, block_size)
+    blocks = list(checksum['blocks'])
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for n in indexes:
+            if n < len(blocks):
+                digest = new_hash(algorithm)
+                digest.update(os.pread(fd, block_size, n * block_size))
+                blocks[n] = digest.hexdigest()
+    finally:
+        os.close(fd)
+    return {'algorithm': algorithm, 'block_size': block_size, 'digest': tree_digest(algorithm, blocks),
+            'blocks': blocks}
+
+
+def align_extents(extents, block_size, size):
+    '''
+    widens data extents to whole blocks and merges the ones which then touch, so every block is either read
+    whole or not at all.
+    :return: list of (offset, length) tuples
+    '''
+    aligned = []
+    for start, length in extents:
+        start, end = start - start % block_size, min(size, -(-(start + length) // block_size) * block_size)
+        if aligned and start <= aligned[-1][0] + aligned[-1][1]:
+            aligned[-1] = (aligned[-1][0], max(end, aligned[-1][0] + aligned[-1][1]) - aligned[-1][0])
+        else:
+            aligned.append((start, end - start))
+    return aligned
+
+
+def split_ranges(size, chunk_size):
+    '''
+    splits a file of the given size into (offset, length) byte ranges no longer than chunk_size.
+    An empty file still gets one empty range so it is created at the destination.
+    :param size: file size in bytes
+    :param chunk_size: maximum length of a range in bytes
+    :return: list of (offset, length) tuples
+    '''
+    if size == 0:
+        return [(0, 0)]
+    return [(offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size)]
+
+
+def split_extents(extents, chunk_size):
+    '''
+    same as split_ranges, but for a list of (offset, length) data extents as returned by data_extents.
+    :return: list of (offset, length) tuples
+    '''
+    ranges = []
+    for start, length in extents:
+        ranges.extend((start + offset, piece) for offset, piece in split_ranges(length, chunk_size) if piece)
+    return ranges
+
+
+def data_extents(path):
+    '''
+    finds the allocated regions of a file using SEEK_DATA/SEEK_HOLE, so holes in thin-provisioned images
+    don't have to be read or written. Filesystems which don't support SEEK_DATA report the whole file as data.
+    :param path: file to inspect
+    :return: list of (offset, length) tuples, in file order
+    '''
+    extents = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if not hasattr(os, 'SEEK_DATA'):
+            return [(0, size)] if size else []
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # nothing but hole from offset to the end of the file.
+                    break
+                if e.errno in FALLBACK_ERRNOS:
+                    return [(0, size)]
+                raise e
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            extents.append((start, end - start))
+            offset = end
+    finally:
+        os.close(fd)
+    return extents
+
+
+def reflink(source, dest):
+    '''
+    clones source to dest with the FICLONE ioctl. The clone shares source's extents (btrfs, XFS with reflink=1,
+    bcachefs, ...), so it takes next to no time or space regardless of the file's size. dest is replaced.
+    Raises OSError if the filesystem can't; see REFLINK_ERRNOS.
+    '''
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def copy_range(source, dest, offset, length, throttle=None):
+    '''
+    copies length bytes at offset from source to the same offset in dest, which must already exist.
+    Each call opens its own file descriptors so ranges of one file can be copied from several threads.
+    Tries copy_file_range first (in-kernel, reflink-aware on some filesystems), then sendfile, then
+    plain pread/pwrite.
+    :param throttle: lib.throttle.Throttle. The range is copied in pieces, each let through by the throttle.
+    :return: number of bytes copied
+    '''
+    copied = 0
+    pieces = [(offset, length)] if throttle is None else \
+        [(offset + start, piece) for start, piece in split_ranges(length, throttle.piece_size)]
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dest, os.O_WRONLY)
+        try:
+            for start, piece in pieces:
+                if throttle is not None:
+                    throttle.acquire(piece)
+                done = _copy_file_range(src_fd, dst_fd, start, piece)
+                if done < piece:
+                    done += _sendfile(src_fd, dst_fd, start + done, piece - done)
+                if done < piece:
+                    done += _pread_pwrite(src_fd, dst_fd, start + done, piece - done)
+                copied += done
+                if done < piece:
+                    break
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    return copied
+
+
+def copy_range_hashed(source, dest, offset, length, algorithm, block_size, sparse=True, throttle=None):
+    '''
+    copies a block-aligned range with pread/pwrite, hashing each block of block_size bytes on the way, so the
+    data is only read once. All-zero blocks aren't written when sparse is set; the destination already has a
+    hole there.
+    :return: (bytes copied, {block number: hex digest})
+    '''
+    copied = 0
+    digests = {}
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dest, os.O_WRONLY)
+        try:
+            while copied < length:
+                if throttle is not None:
+                    throttle.acquire(min(block_size, length - copied))
+                buf = os.pread(src_fd, min(block_size, length - copied), offset + copied)
+                if not buf:
+                    break
+                digest = new_hash(algorithm)
+                digest.update(buf)
+                digests[(offset + copied) // block_size] = digest.hexdigest()
+                if not sparse or buf.count(0) != len(buf):
+                    os.pwrite(dst_fd, buf, offset + copied)
+                copied += len(buf)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    return copied, digests
+
+
+def _copy_file_range(src_fd, dst_fd, offset, length):
+    if not hasattr(os, 'copy_file_range'):
+        return 0
+    copied = 0
+    while copied < length:
+        try:
+            n = os.copy_file_range(src_fd, dst_fd, length - copied, offset + copied, offset + copied)
+        except OSError as e:
+            if e.errno in FALLBACK_ERRNOS:
+                break
+            raise e
+        if n == 0:
+            # source shorter than expected (file shrank) or kernel refused silently.
+            break
+        copied += n
+    return copied
+
+
+def _sendfile(src_fd, dst_fd, offset, length):
+    if not hasattr(os, 'sendfile'):
+        return 0
+    copied = 0
+    # sendfile writes at the destination's file position, which is private to this descriptor.
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while copied < length:
+        try:
+            n = os.sendfile(dst_fd, src_fd, offset + copied, length - copied)
+        except OSError as e:
+            if e.errno in FALLBACK_ERRNOS:
+                break
+            raise e
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def _pread_pwrite(src_fd, dst_fd, offset, length, bufsize=8 * 1024 * 1024):
+    copied = 0
+    while copied < length:
+        buf = os.pread(src_fd, min(bufsize, length - copied), offset + copied)
+        if not buf:
+            break
+        os.pwrite(dst_fd, buf, offset + copied)
+        copied += len(buf)
+    return copied
+
+
+class CopyEngine(object):
+    '''
+    Copies many files at once, and large files as several byte ranges at once, on a thread pool.
+    The kernel does the copying (copy_file_range/sendfile) so the GIL is released and the number of
+    workers, not python, decides how hard the storage is driven.
+    When sparse is set, only the allocated extents of each file are copied and holes are kept in the
+    destination, so thin-provisioned images cost their allocated size rather than their apparent size.
+    When checksum names an algorithm, ranges are copied through user space instead and every block_size block is
+    hashed as it passes, giving block and whole-file checksums without reading the file again.
+    A throttle (lib.throttle.Throttle) limits the rate at which all ranges together are read.
+    With reflink set, each file is first cloned with FICLONE, and only copied if that isn't supported between
+    the two filesystems. Clones aren't read, so they aren't checksummed.
+    '''
+    def __init__(self, workers=4, chunk_size=256 * 1024 * 1024, sparse=True, checksum=None,
+                 block_size=4 * 1024 * 1024, throttle=None, reflink=False):
+        self.workers = max(1, int(workers))
+        self.throttle = throttle
+        self.reflink = reflink
+        # (source st_dev, destination st_dev) pairs FICLONE failed between.
+        self.no_reflink = set()
+        self.block_size = max(1, int(block_size))
+        self.chunk_size = max(1, int(chunk_size))
+        self.sparse = sparse
+        self.checksum = None if checksum in (None, 'none') else checksum
+        if self.checksum is not None:
+            # ranges have to start on block boundaries for blocks to be hashed whole.
+            self.chunk_size = -(-self.chunk_size // self.block_size) * self.block_size
+            new_hash(self.checksum)
+
+    def copy_files(self, files):
+        '''
+        :param files: dict. '/source/path': '/destination/path'
+        :return: dict of per-file statistics, keyed by source path, as below:
+        {
+            '/images/vm01.qcow2': {
+                'dest': '/var/lib/virt-dup/<job>/vda-1551669947-0.qcow2',
+                'bytes': 10737418240,
+                'size': 42949672960,
+                'seconds': 12.5,
+                'throughput': 858993459.2,
+                'checksum': file_checksum() style dict, or None if checksums are off or the file was cloned,
+                'reflinked': False
+            }
+        }
+        '''
+        stats = {}
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='copy') as pool:
+            for source, dest in files.items():
+                size = os.path.getsize(source)
+                start = time.time()
+                if self.try_reflink(source, dest):
+                    stats[source] = {'dest': dest, 'bytes': 0, 'size': size, 'start': start, 'end': time.time(),
+                                     'blocks': {}, 'reflinked': True}
+                    continue
+                # create (and size) the destination before any range is written to it. Whatever isn't
+                # written afterwards stays a hole.
+                with open(dest, 'wb') as file:
+                    file.truncate(size)
+                stats[source] = {'dest': dest, 'bytes': 0, 'size': size, 'start': start, 'end': start, 'blocks': {},
+                                 'reflinked': False}
+                if self.sparse and self.checksum is not None:
+                    ranges = split_extents(align_extents(data_extents(source), self.block_size, size),
+                                           self.chunk_size)
+                elif self.sparse:
+                    ranges = split_extents(data_extents(source), self.chunk_size)
+                else:
+                    ranges = split_ranges(size, self.chunk_size)
+                for offset, length in ranges:
+                    if self.checksum is not None:
+                        future = pool.submit(copy_range_hashed, source, dest, offset, length, self.checksum,
+                                             self.block_size, self.sparse, self.throttle)
+                    else:
+                        future = pool.submit(copy_range, source, dest, offset, length, self.throttle)
+                    futures[future] = source
+            # a file's end time is when its last range finishes.
+            for future in as_completed(futures):
+                source = futures[future]
+                if self.checksum is not None:
+                    copied, blocks = future.result()
+                    stats[source]['blocks'].update(blocks)
+                else:
+                    copied = future.result()
+                stats[source]['bytes'] += copied
+                stats[source]['end'] = time.time()
+
+        ret = {}
+        for source, info in stats.items():
+            seconds = max(info['end'] - info['start'], 1e-9)
+            ret[source] = {'dest': info['dest'],
+                           'bytes': info['bytes'],
+                           'size': info['size'],
+                           'seconds': seconds,
+                           'throughput': info['bytes'] / seconds,
+                           'checksum': None if info['reflinked'] else self.file_checksum(info['size'], info['blocks']),
+                           'reflinked': info['reflinked']}
+            if info['reflinked']:
+                logging.info(f"Cloned {source} to {info['dest']} in {seconds:.2f}s")
+                continue
+            logging.info(f"Copied {source} to {info['dest']}: {info['bytes']} of {info['size']} bytes "
+                         f"in {seconds:.2f}s "
+                         f"({ret[source]['throughput'] / 1024 / 1024:.1f} MiB/s)")
+        return ret
+
+    def try_reflink(self, source, dest):
+        '''
+        :return: True if dest is now a clone of source.
+        '''
+        if not self.reflink:
+            return False
+        devices = (os.stat(source).st_dev, os.stat(os.path.dirname(os.path.abspath(dest))).st_dev)
+        if devices in self.no_reflink:
+            return False
+        try:
+            reflink(source, dest)
+            return True
+        except OSError as e:
+            if e.errno not in REFLINK_ERRNOS:
+                raise e
+            logging.info(f"Cannot clone {source} to {dest} ({os.strerror(e.errno)}); copying instead.")
+            self.no_reflink.add(devices)
+            return False
+
+    def file_checksum(self, size, blocks):
+        '''
+        assembles the block digests collected while copying. Blocks which were never read are holes.
+        '''
+        if self.checksum is None:
+            return None
+        ordered = []
+        for n in range((size + self.block_size - 1) // self.block_size):
+            if n not in blocks:
+                blocks[n] = zero_digest(self.checksum, min(self.block_size, size - n * self.block_size))
+            ordered.append(blocks[n])
+        return {'algorithm': self.checksum, 'block_size': self.block_size,
+                'digest': tree_digest(self.checksum, ordered), 'blocks': ordered}
@@ -0,0 +1,153 @@
+import libvirt
+import threading
+import logging
+import os
+from lib.exceptions.libvirt_exceptions import EventLoopInherited
+
+_event_loop_running = False
+# set in a child forked while the event loop was running: the registered implementation still holds the parent's
+# watches and keepalive timers, so the child must not run it.
+_event_loop_inherited = False
+_lock = threading.Lock()
+_block_job_waiters = {}
+
+
+def _after_fork_in_child():
+    global _lock, _event_loop_running, _event_loop_inherited, _block_job_waiters
+    _lock = threading.Lock()
+    _event_loop_inherited = _event_loop_inherited or _event_loop_running
+    _event_loop_running = False
+    _block_job_waiters = {}
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def start_event_loop():
+    '''
+    registers libvirt's default event loop implementation and runs it in a daemon thread.
+    Connections only deliver events if this is called before they are opened. Safe to call more than once.
+    :raises EventLoopInherited: in a process forked from one running the event loop. Spawn it instead.
+    '''
+    global _event_loop_running
+    with _lock:
+        if _event_loop_inherited:
+            raise EventLoopInherited(os.getpid())
+        if _event_loop_running:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        _event_loop_running = True
+        thread = threading.Thread(target=_run_event_loop, name='libvirt-events', daemon=True)
+        thread.start()
+
+
+def _run_event_loop():
+    while True:
+        try:
+            libvirt.virEventRunDefaultImpl()
+        except libvirt.libvirtError as e:
+            logging.warning(f"libvirt event loop error: {e}")
+
+
+def block_job_waiter(conn):
+    '''
+    :param conn: libvirt connection
+    :return: the BlockJobWaiter for this connection, created on first use.
+    '''
+    start_event_loop()
+    with _lock:
+        key = id(conn)
+        if key not in _block_job_waiters:
+            _block_job_waiters[key] = BlockJobWaiter(conn)
+        return _block_job_waiters[key]
+
+
+class BlockJobWaiter(object):
+    '''
+    Waits for libvirt block jobs to change state using VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2 events instead of polling
+    blockJobInfo. One callback registration per connection serves every disk of every domain on it.
+    Call expect() before starting a job so an event arriving before wait() isn't lost.
+    '''
+    def __init__(self, conn, recheck=30):
+        '''
+        :param conn: libvirt connection
+        :param recheck: seconds between blockJobInfo checks while waiting, in case an event went missing.
+        '''
+        self.conn = conn
+        self.recheck = recheck
+        self.lock = threading.Lock()
+        # (domain uuid, disk target): {'event': threading.Event, 'status': int or None}
+        self.waiting = {}
+        self.callback_id = conn.domainEventRegisterAny(
+            None,
+            libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2,
+            self._callback,
+            None
+        )
+
+    def _callback(self, conn, dom, disk, job_type, status, opaque):
+        with self.lock:
+            waiter = self.waiting.get((dom.UUIDString(), disk))
+        if waiter is not None:
+            waiter['status'] = status
+            waiter['event'].set()
+
+    def expect(self, domain, disk):
+        '''
+        start listening for events for a block job on disk which is about to be started.
+        :param domain: libvirt domain
+        :param disk: target dev name, e.g. 'vda'
+        '''
+        with self.lock:
+            self.waiting[(domain.UUIDString(), disk)] = {'event': threading.Event(), 'status': None}
+
+    def wait(self, domain, disk, timeout=None):
+        '''
+        blocks until the block job on disk reports a state change.
+        :param domain: libvirt domain
+        :param disk: target dev name
+        :param timeout: seconds to wait in total. None waits forever.
+        :return: libvirt.VIR_DOMAIN_BLOCK_JOB_READY, _COMPLETED, _FAILED or _CANCELED, or None on timeout.
+        '''
+        key = (domain.UUIDString(), disk)
+        with self.lock:
+            if key not in self.waiting:
+                self.waiting[key] = {'event': threading.Event(), 'status': None}
+            waiter = self.waiting[key]
+        waited = 0
+        try:
+            while True:
+                interval = self.recheck if timeout is None else min(self.recheck, timeout - waited)
+                if waiter['event'].wait(max(interval, 0)):
+                    return waiter['status']
+                waited += interval
+                # no event yet. Make sure the job isn't already finished or synchronised.
+                status = self.job_state(domain, disk)
+                if status is not None:
+                    return status
+                if timeout is not None and waited >= timeout:
+                    return None
+        finally:
+            with self.lock:
+                self.waiting.pop(key, None)
+
+    def job_state(self, domain, disk):
+        '''
+        :return: READY if the job has caught up, FAILED if it is gone or can't be queried, None if it is still
+        running.
+        '''
+        try:
+            info = domain.blockJobInfo(disk, 0)
+        except libvirt.libvirtError:
+            return libvirt.VIR_DOMAIN_BLOCK_JOB_FAILED
+        if not info:
+            return libvirt.VIR_DOMAIN_BLOCK_JOB_FAILED
+        if info['cur'] == info['end']:
+            return libvirt.VIR_DOMAIN_BLOCK_JOB_READY
+        return None
+
+    def close(self):
+        try:
+            self.conn.domainEventDeregisterAny(self.callback_id)
+        except libvirt.libvirtError:
+            pass
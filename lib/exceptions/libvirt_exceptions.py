@@ -17,6 +17,15 @@ class OpenFailed(LibvirtException):
         logging.warning(self.description)
 
 
+class EventLoopInherited(LibvirtException):
+    code = 500
+
+    def __init__(self, pid):
+        self.description = f"Process {pid} was forked from one running the libvirt event loop and can't run its " \
+                           f"own. Start it with the spawn method."
+        logging.warning(self.description)
+
+
 class VirtDupXMLException(LibvirtException):
     code = 500
 
@@ -51,3 +60,13 @@ class DiskPivotException(SnapshotManagerException):
     def __init__(self, jobuuid, disk, message):
         self.description = f'Job:{jobuuid}, Disk {disk}, {message}'
         logging.warning(self.description)
+
+class OverlaySpaceException(SnapshotManagerException):
+    def __init__(self, jobuuid, path, free, needed):
+        self.description = f"Job:{jobuuid}, {path} has {free} bytes free for snapshot overlays, {needed} needed."
+        logging.warning(self.description)
+
+class BackupUnsupported(SnapshotManagerException):
+    def __init__(self, jobuuid, message):
+        self.description = f"Job:{jobuuid}, pull mode backups are not possible: {message}"
+        logging.warning(self.description)
@@ -0,0 +1,39 @@
+import logging
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(module)s %(threadName)s %(funcName)s "%(message)s"')
+
+
+class PipelineException(Exception):
+    def __init__(self):
+        self.description = "Generic backup pipeline exception."
+        logging.warning(self.description)
+
+class UnknownStage(PipelineException):
+    def __init__(self, name):
+        self.description = f"Unknown pipeline stage: {name}"
+        logging.warning(self.description)
+
+class UnknownBackend(PipelineException):
+    def __init__(self, url):
+        self.description = f"No backend for {url}"
+        logging.warning(self.description)
+
+class MissingDependency(PipelineException):
+    def __init__(self, stage, module):
+        self.description = f"Pipeline stage {stage} needs the python module {module}, which is not installed."
+        logging.warning(self.description)
+
+class BadKey(PipelineException):
+    def __init__(self, filename, reason):
+        self.description = f"Encryption key {filename} can't be used: {reason}"
+        logging.warning(self.description)
+
+class UnknownCodec(PipelineException):
+    def __init__(self, codec):
+        self.description = f"Unknown compression codec: {codec}"
+        logging.warning(self.description)
+
+class BadFrame(PipelineException):
+    def __init__(self, filename):
+        self.description = f"{filename} is not a virt-dup compressed image."
+        logging.warning(self.description)
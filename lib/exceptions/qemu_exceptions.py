@@ -12,3 +12,33 @@ class BlockCommitException(QemuException):
     def __init__(self, stderr):
         self.description = f"`qemu-img commit ...` gave the following error: {stderr}"
         logging.warning(self.description)
+
+class ImageCreateException(QemuException):
+    def __init__(self, stderr):
+        self.description = f"`qemu-img create ...` gave the following error: {stderr}"
+        logging.warning(self.description)
+
+class RebaseException(QemuException):
+    def __init__(self, stderr):
+        self.description = f"`qemu-img rebase ...` gave the following error: {stderr}"
+        logging.warning(self.description)
+
+class BackingChainException(QemuException):
+    def __init__(self, filename, message):
+        self.description = f"Cannot resolve backing chain of {filename}: {message}"
+        logging.warning(self.description)
+
+class ImageLockException(QemuException):
+    def __init__(self, filename, message):
+        self.description = f"Cannot lock {filename}, it is probably in use: {message}"
+        logging.warning(self.description)
+
+class NBDServerException(QemuException):
+    def __init__(self, name, message):
+        self.description = f"NBD export of {name} failed: {message}"
+        logging.warning(self.description)
+
+class ImageInfoException(QemuException):
+    def __init__(self, stderr):
+        self.description = f"`qemu-img info ...` gave the following error: {stderr}"
+        logging.warning(self.description)
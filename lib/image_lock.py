@@ -0,0 +1,68 @@
+import os
+import fcntl
+import struct
+import logging
+from lib.exceptions.qemu_exceptions import ImageLockException
+
+# qemu (2.10 and later) coordinates access to an image with fcntl locks on single bytes of the file: a user locks
+# byte 100 + n for each permission bit n it holds and byte 200 + n for each one it won't share with others, and
+# refuses to open an image if a conflicting lock is held. A write lock over both ranges therefore keeps every qemu,
+# and so the domain, from opening the image, and can only be taken while nothing has it open.
+LOCK_START = 100
+LOCK_LENGTH = 200
+
+# open file description locks belong to the file descriptor, not the process, so closing some other descriptor of
+# the same image (e.g. a copy reading it) doesn't drop them as it would a plain posix lock. F_OFD_SETLK is 37 on
+# linux; python only names it from 3.9 on.
+F_OFD_SETLK = getattr(fcntl, 'F_OFD_SETLK', 37)
+
+
+def _flock(kind, start, length):
+    # struct flock: l_type, l_whence, l_start, l_len, l_pid (must be 0 for ofd locks), padded to 32 bytes.
+    return struct.pack('hhqqi4x', kind, os.SEEK_SET, start, length, 0)
+
+
+class ImageLock(object):
+    '''
+    holds qemu's image locks on a set of images so no domain can open them, e.g. while a shut off domain's images
+    are copied without a snapshot. Starting a domain using a locked image fails with "Failed to get ... lock".
+    Locks are released by release(), or when the process exits.
+    '''
+    def __init__(self, paths):
+        self.paths = list(paths)
+        # path: fd
+        self.fds = {}
+
+    def acquire(self):
+        '''
+        locks every image, or none of them.
+        :raises ImageLockException: if an image is in use, e.g. by a running domain.
+        '''
+        try:
+            for path in self.paths:
+                # a write lock needs a descriptor open for writing; nothing is written.
+                fd = os.open(path, os.O_RDWR)
+                self.fds[path] = fd
+                try:
+                    fcntl.fcntl(fd, F_OFD_SETLK, _flock(fcntl.F_WRLCK, LOCK_START, LOCK_LENGTH))
+                except OSError as e:
+                    raise ImageLockException(path, e.strerror)
+        except:
+            self.release()
+            raise
+        logging.debug(f"Locked images {self.paths}")
+
+    def release(self):
+        for path, fd in self.fds.items():
+            try:
+                fcntl.fcntl(fd, F_OFD_SETLK, _flock(fcntl.F_UNLCK, LOCK_START, LOCK_LENGTH))
+            finally:
+                os.close(fd)
+        self.fds = {}
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
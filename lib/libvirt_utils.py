@@ -1,79 +1,226 @@
 import libvirt
-from lib.exceptions.libvirt_exceptions import OpenFailed, \
-    JobNotFound, NoSnapshot, DiskPivotException, SnapshotExists, LibvirtException
+from lib.exceptions.libvirt_exceptions import \
+    JobNotFound, NoSnapshot, DiskPivotException, SnapshotExists, LibvirtException, OverlaySpaceException, \
+    BackupUnsupported
 from lib import qemu_utils
+from lib import event_utils
+from lib import connection
+from lib.copy_utils import CopyEngine, update_checksum, file_checksum
+from lib import pipeline
+from lib import nbd_backup
+from lib import compression
+from lib.chunk_store import ChunkStore, Chunker, FixedChunker
+from lib import shared_backing
+from lib.metrics import JobMetrics
+from lib import throttle
+from lib.image_lock import ImageLock
+from lib.exceptions.qemu_exceptions import ImageLockException
 import xml.etree.ElementTree as ET
 import uuid
 import os
-import shutil
 import time
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 
 class LibvirtUtils(object):
     def __init__(self, config):
         self.config = config
-        self.user = config.libvirt_user
-        self.pw = config.libvirt_pw
-        auth = [[libvirt.VIR_CRED_AUTHNAME, libvirt.VIR_CRED_PASSPHRASE], self._auth_callback, None]
-        if config.libvirt_connection_type_socket:
-            self.conn = libvirt.open('qemu:///system')
-        else:
-            self.conn = libvirt.openAuth(config.libvirt_uri, auth, config.libvirt_flags)
-        if self.conn is None:
-            raise OpenFailed(config.libvirt_uri)
-
-        self.domainnames = {}
-        self.domainuuids = {}
-        self.domain_disks = {}
-        self.get_updated_domain_info()
-
-    def _auth_callback(self, credentials, user_data):
-        for credential in credentials:
-            if credential[0] == libvirt.VIR_CRED_AUTHNAME:
-                credential[4] = self.user
-            elif credential[0] == libvirt.VIR_CRED_PASSPHRASE:
-                credential[4] = self.pw
-            else:
-                return -1
-        return 0
+        # shared with anything else in this process using the same uri and credentials.
+        self.connection = connection.get_connection(config)
+        self.cache = DomainCache(self.config, self.connection)
+
+    @property
+    def conn(self):
+        return self.connection.conn
 
     def shutdown_callback(self):
-        self.conn.close()
+        self.cache.close()
+        connection.release_connection(self.connection)
 
     def get_updated_domain_info(self):
+        '''
+        re-reads every domain. Normally unnecessary since libvirt events keep the cache current.
+        '''
+        self.cache.load_all()
+
+    def domain_search(self, str):
+        entry = self.cache.lookup(str)
+        if entry is not None:
+            return entry['domain']
+
+    def snapshot(self, dom):
+        pass
+
+
+class DomainCache(object):
+    '''
+    Parsed domains, disks and jobs keyed by domain uuid. libvirt lifecycle, device and metadata change events
+    mark entries stale, and a stale entry is re-parsed the next time it's used, so lookups of unchanged domains
+    don't make any libvirt calls. generation is bumped by every event so consumers can tell when to re-read.
+    Everything is re-read and events re-registered when the connection is re-established.
+    '''
+    def __init__(self, config, managed_connection):
+        self.config = config
+        self.connection = managed_connection
+        self.lock = threading.RLock()
+        # uuid: {'domain': virDomain, 'name': str, 'xml': VirtDupXML, 'disks': disk_summary(), 'jobs': {}}
+        self.entries = {}
+        self.names = {}
+        # uuid: virDomain for entries which need re-parsing
+        self.stale = {}
+        self.generation = 0
+        self.callback_ids = []
+        self.registered_conn = None
+        self.register_events(self.connection.conn)
+        self.connection.add_listener(self._reconnected)
+        self.load_all()
+
+    def register_events(self, conn):
+        events = {
+            libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE: self._lifecycle_callback,
+            libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED: self._device_callback,
+            libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED: self._device_callback,
+            libvirt.VIR_DOMAIN_EVENT_ID_METADATA_CHANGE: self._metadata_callback,
+        }
+        self.registered_conn = conn
+        self.callback_ids = []
         try:
-            for domain in self.conn.listAllDomains(0):
-                self.domainnames[domain.name()] = domain
-                self.domain_disks[domain.name()] = VirtDupXML(self.config, domain).disk_summary()
-                self.domainuuids[domain.UUIDString()] = domain
+            for event_id, callback in events.items():
+                self.callback_ids.append(conn.domainEventRegisterAny(None, event_id, callback, None))
         except libvirt.libvirtError as e:
             raise LibvirtException(e.err)
 
-    def domain_search(self, str):
-        self.get_updated_domain_info()
+    def _reconnected(self, conn):
+        # callbacks and domain objects belonged to the old connection.
+        self.register_events(conn)
+        self.load_all()
 
-        for uuid in self.domainuuids:
-            if uuid == str:
-                return self.domainuuids[str]
+    def _lifecycle_callback(self, conn, dom, event, detail, opaque):
+        if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            self.remove(dom.UUIDString())
+        else:
+            # starting or stopping swaps between live and inactive xml, which can differ.
+            self.invalidate(dom)
 
-        for name in self.domainnames:
-            if name == str:
-                return self.domainnames[str]
+    def _device_callback(self, conn, dom, dev_alias, opaque):
+        self.invalidate(dom)
 
-    def snapshot(self, dom):
-        pass
+    def _metadata_callback(self, conn, dom, mtype, nsuri, opaque):
+        self.invalidate(dom)
+
+    def invalidate(self, dom):
+        with self.lock:
+            self.stale[dom.UUIDString()] = dom
+            self.generation += 1
+
+    def remove(self, uuid):
+        with self.lock:
+            entry = self.entries.pop(uuid, None)
+            if entry is not None and self.names.get(entry['name']) == uuid:
+                self.names.pop(entry['name'])
+            self.stale.pop(uuid, None)
+            self.generation += 1
+
+    def load_all(self):
+        try:
+            domains = self.connection.conn.listAllDomains(0)
+        except libvirt.libvirtError as e:
+            raise LibvirtException(e.err)
+        with self.lock:
+            self.entries = {}
+            self.names = {}
+            self.stale = {}
+            for domain in domains:
+                self.load(domain)
+            self.generation += 1
+
+    def load(self, domain):
+        try:
+            uuid = domain.UUIDString()
+            xml = VirtDupXML(self.config, domain)
+            entry = {'domain': domain,
+                     'name': domain.name(),
+                     'xml': xml,
+                     'disks': xml.disk_summary(),
+                     'jobs': xml.loaded_jobs}
+        except libvirt.libvirtError as e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                # undefined before we got to it.
+                self.remove(domain.UUIDString())
+                return None
+            raise LibvirtException(e.err)
+        with self.lock:
+            old = self.entries.get(uuid)
+            if old is not None and self.names.get(old['name']) == uuid:
+                self.names.pop(old['name'])
+            self.entries[uuid] = entry
+            self.names[entry['name']] = uuid
+        return entry
+
+    def refresh_stale(self):
+        with self.lock:
+            stale = self.stale
+            self.stale = {}
+        for domain in stale.values():
+            self.load(domain)
+
+    def lookup(self, str):
+        '''
+        :param str: domain uuid or name
+        :return: cache entry, or None.
+        '''
+        self.refresh_stale()
+        with self.lock:
+            if str in self.entries:
+                return self.entries[str]
+            if str in self.names:
+                return self.entries[self.names[str]]
+
+    def all_entries(self):
+        self.refresh_stale()
+        with self.lock:
+            return list(self.entries.values())
+
+    def close(self):
+        self.connection.remove_listener(self._reconnected)
+        for callback_id in self.callback_ids:
+            try:
+                self.registered_conn.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError:
+                pass
+        self.callback_ids = []
 
 
 class SnapshotManager(object):
     '''
     correlates metadata, takes snapshots, and otherwise makes things ready for copying offsite via duplicity
     '''
-    def __init__(self, config, domxml, jobuuid):
+    def __init__(self, config, domxml, jobuuid, shared=None, host_limits=None):
+        '''
+        :param shared: backing files used by more than one domain, from shared_backing.shared_backing_files().
+        These are staged once into a shared area instead of into each job's staging directory.
+        :param host_limits: (bandwidth, iops, commit) limits shared by every worker on the host, see
+        worker.WorkerPool.
+        '''
         self.config = config
         self.domxml = domxml
         self.job = self.domxml.loaded_jobs[jobuuid]
+        self.shared = {} if shared is None else shared
+        self.host_limits = host_limits
         self.job_staging_path = self.get_staging_path()
+        # per-phase timings and per-disk values of this run, reported to the dispatcher by the worker.
+        self.metrics = JobMetrics()
+        # when this run's overlays were created, for their lifetime.
+        self.snapshot_time = None
+        # disks whose overlay has been committed and removed, so a retried block_commit leaves them alone.
+        self.committed = set()
+        # disks being committed now, which share the job's commit bandwidth.
+        self.committing = set()
+        self.commit_bandwidth = 0
 
     def get_staging_path(self):
         path = f"{self.config.staging_path}{self.job['uuid']}/"
@@ -81,26 +228,536 @@ class SnapshotManager(object):
         os.makedirs(path, exist_ok=True)
         return path
 
+    def run(self, kind='full'):
+        '''
+        entry point for scheduled jobs.
+        :param kind: 'full' or 'incremental'
+        '''
+        mode = self.job.get('mode', self.config.backup_mode)
+        if mode == 'pull':
+            self.pull_backup(incremental=kind == 'incremental')
+        elif kind == 'incremental':
+            self.incremental_backup()
+        elif mode == 'stream':
+            self.stream_image()
+        elif self.offline_enabled() and not self.domxml.domain.isActive() and self.offline_image():
+            logging.info(f"Job {self.job['uuid']} backed up shut off domain {self.domxml.domain.name()} offline.")
+        else:
+            self.stage_image()
+
+    def offline_enabled(self):
+        '''
+        :return: whether shut off domains are backed up with offline_image(): the job's offline attribute if it
+        has one, otherwise offline-backup from virt-dup.yml.
+        '''
+        if 'offline' in self.job.keys():
+            return str(self.job['offline']).lower() in ('true', 'yes', '1')
+        return self.config.offline_backup
+
     def stage_image(self, staging=True):
-        self.create_snapshot()
+        with self.metrics.phase('snapshot'):
+            self.create_snapshot()
         files = self.get_file_list()
-        print(files)
+        logging.info(f"Job {self.job['uuid']} files: {files}")
         if staging:
-            #todo: fork copy to staging threads
+            disks = self.get_snap_files()
+            chains = {disk: qemu_utils.backing_chain(info['base']) for disk, info in disks.items()}
+            staging_run = self.stage_files(files, disks)
+        self.commit_snapshot()
+        if staging:
+            self.finish_staging(files, disks, chains, staging_run)
+
+    def offline_image(self):
+        '''
+        fast path for a shut off domain: its images are copied as they are, with no snapshot, overlay or commit.
+        They are held with qemu's own image locks meanwhile, so the domain can't be started (and write to them)
+        until the copy is done; a start attempt fails with a lock error.
+        :return: False, having done nothing, if the domain is running or its images are in use.
+        '''
+        disks = {disk['dev_name']: {'base': disk['path'], 'top': None}
+                 for disk in self.domxml.disk_summary() if disk['backup-enabled']}
+        files = self.get_file_list(disks)
+        logging.info(f"Job {self.job['uuid']} files: {files}")
+        chains = {disk: qemu_utils.backing_chain(info['base']) for disk, info in disks.items()}
+        lock = ImageLock(files.keys())
+        try:
+            lock.acquire()
+        except ImageLockException:
+            return False
+        try:
+            # the domain may have been started before the lock was taken.
+            if self.domxml.domain.isActive():
+                return False
+            staging_run = self.stage_files(files, disks)
+        finally:
+            lock.release()
+        self.finish_staging(files, disks, chains, staging_run)
+        return True
+
+    def stage_files(self, files, disks):
+        '''
+        copies (or clones, or reuses) a job's files into its staging directory and relinks the staged chains. The
+        files must not change meanwhile.
+        :param files: from get_file_list()
+        :param disks: from get_snap_files()
+        :return: dict for finish_staging(), as below.
+        {
+            'record': {'vda': ['vda-1551669947-0.qcow2']},
+            'staged': {'/images/vm01.qcow2': 'vda-1551669947-0.qcow2'},
+            'local': {'/images/vm01.qcow2': 'vda-1551669947-0.qcow2'},
+            'checksums': {'/images/vm01.qcow2': {...}},
+            'reflinked': [],
+            'engine': <CopyEngine>
+        }
+        '''
+        record = {}
+        local = dict(files)
+        engine = CopyEngine(self.config.copy_workers, self.config.copy_chunk_size, self.config.sparse,
+                            self.config.checksum, self.config.checksum_block_size,
+                            throttle.job_throttle(self.config, self.job, files.keys(), self.host_limits),
+                            self.config.reflink)
+        # staged names relative to the job's staging directory
+        staged = {}
+        checksums = {}
+        # shared copies, base first. Each is backed by the shared copy below it, or at the base of the staged chain
+        # keeps its original backing file. A file above one staged privately is staged privately too.
+        shared_copies = {}
+        for disk in disks:
+            chain = [source for source, dest in files.items() if dest.startswith(f"{disk}-")]
+            for seq, source in enumerate(chain):
+                if source not in self.shared:
+                    continue
+                if seq == 0:
+                    below = None
+                elif chain[seq - 1] in shared_copies:
+                    below = shared_copies[chain[seq - 1]]
+                else:
+                    continue
+                pathname = shared_backing.stage_shared(self.config, engine, source, self.shared, below)
+                if pathname is not None:
+                    shared_copies[source] = pathname
+                    staged[source] = os.path.relpath(pathname, self.job_staging_path)
+                    checksums[source] = shared_backing.shared_checksum(pathname)
+                    local.pop(source)
+        # unchanged backing files staged by an earlier run of this job are referenced, not copied again.
+        reused = self.reusable_staged_files(files, local, disks)
+        cache = self.load_staging_cache()
+        for source in reused.keys():
+            local.pop(source)
+            checksums[source] = cache[source].get('checksum')
+        with self.metrics.phase('staging'):
+            results = engine.copy_files({source: os.path.join(self.job_staging_path, dest)
+                                         for source, dest in local.items()})
+        # clones weren't read, so they're checksummed in finish_staging(), once the sources are released.
+        reflinked = [source for source, result in results.items() if result['reflinked']]
+        for source, result in results.items():
+            checksums[source] = result['checksum']
+            disk = files[source].split('-')[0]
+            if result['reflinked']:
+                self.metrics.add('bytes_reflinked', result['size'], disk)
+            else:
+                self.metrics.add('bytes_copied', result['bytes'], disk)
+            self.metrics.add('copy_seconds', result['seconds'], disk)
+        for disk in disks:
+            seconds = self.metrics.values.get(('copy_seconds', disk), 0)
+            if seconds:
+                self.metrics.set('throughput_bytes_per_second',
+                                 self.metrics.values.get(('bytes_copied', disk), 0) / seconds, disk)
+        staged.update(reused)
+        staged.update(local)
+        relinked = []
+        with self.metrics.phase('relink'):
+            for disk in disks:
+                record[disk] = [staged[source] for source, dest in files.items()
+                                if dest.startswith(f"{disk}-")]
+                relinked += self.relink_staged_chain(record[disk], skip=reused.values())
+        for source, name in local.items():
+            if name in relinked and checksums[source] is not None:
+                # the backing file name lives in the first cluster, so only the first block changed.
+                checksums[source] = update_checksum(os.path.join(self.job_staging_path, name),
+                                                    checksums[source], [0])
+        return {'record': record, 'staged': staged, 'local': local, 'checksums': checksums,
+                'reflinked': reflinked, 'engine': engine}
+
+    def finish_staging(self, files, disks, chains, staging_run):
+        '''
+        the part of staging which no longer needs the source files: checksums of clones, the staging cache and
+        manifest, and chunking, compression or the chain record.
+        :param chains: disk: qemu_utils.backing_chain() of its base, taken while the files were still there
+        :param staging_run: from stage_files()
+        '''
+        local = staging_run['local']
+        checksums = staging_run['checksums']
+        engine = staging_run['engine']
+        if engine.checksum is not None:
+            with self.metrics.phase('checksum'):
+                for source in staging_run['reflinked']:
+                    checksums[source] = file_checksum(os.path.join(self.job_staging_path, local[source]),
+                                                      engine.checksum, engine.block_size)
+        self.update_staging_cache(files, local, checksums, disks)
+        self.write_manifest(files, staging_run['staged'], checksums, chains)
+        # Shared copies are left alone; other jobs' chains point at them.
+        self.store_staged(local.values(), staging_run['record'])
+
+    def store_staged(self, names, record):
+        '''
+        moves this run's staged images into the chunk store or compresses them, if so configured. Otherwise they
+        stay as they are and record becomes the chain record.
+        :param names: staged file names written by this run
+        :param record: chain record for the run, see load_chain_record()
+        '''
+        codec = self.job.get('compression', self.config.staging_compression)
+        # chunked or compressed images can't be rebased onto, so there's nothing for incrementals to build on.
+        if self.config.chunk_store is not None:
+            with self.metrics.phase('chunk_store'):
+                self.store_chunks(names)
+        elif codec != 'none':
+            with self.metrics.phase('compress'):
+                self.compress_staged(names, codec)
+        else:
+            self.save_chain_record(record)
+
+    def store_chunks(self, names):
+        '''
+        moves staged images into the chunk store. Each image becomes the manifest <job uuid>/<staged name>.
+        Runs of the job beyond its retention are then removed from the store, and unreferenced chunks deleted.
+        :param names: staged file names
+        '''
+        chunker = Chunker() if self.config.chunk_mode == 'cdc' else FixedChunker(self.config.chunk_size)
+        store = ChunkStore(self.config.chunk_store, chunker)
+        try:
+            for name in names:
+                pathname = os.path.join(self.job_staging_path, name)
+                store.add_file(pathname, f"{self.job['uuid']}/{name}")
+                os.remove(pathname)
+            self.prune_chunk_store(store)
+        finally:
+            store.close()
+
+    def prune_chunk_store(self, store):
+        '''
+        removes the job's stored runs beyond the newest full_retention (or chunk-store-retention), then runs gc.
+        A run is the set of images staged with the same timestamp, e.g. vda-1551669947-0.qcow2 and
+        vdb-1551669947-inc.qcow2.
+        '''
+        retention = int(self.job.get('full_retention', self.config.chunk_store_retention))
+        if retention <= 0:
+            return
+        prefix = f"{self.job['uuid']}/"
+        runs = {}
+        for name in store.manifests(prefix):
+            runs.setdefault(name[len(prefix):].split('-')[1], []).append(name)
+        for run in sorted(runs.keys(), key=int)[:-retention]:
+            for name in runs[run]:
+                store.remove_manifest(name)
+            logging.info(f"Removed run {run} of job {self.job['uuid']} from the chunk store.")
+        with self.metrics.phase('chunk_gc'):
+            store.gc()
+
+    def compress_staged(self, names, codec):
+        '''
+        replaces staged images with block-compressed .vdz files and appends the job's compression ratio and
+        throughput to compression-stats.jsonl in the job's staging directory.
+        :param names: staged file names
+        :param codec: zstd, lz4 or zlib
+        '''
+        level = int(self.job.get('compression_level', self.config.compression_level))
+        threads = int(self.job.get('compression_threads', self.config.compression_threads))
+        run = {'time': int(time.time()), 'codec': codec, 'level': level, 'threads': threads,
+               'bytes_in': 0, 'bytes_out': 0, 'seconds': 0}
+        for name in names:
+            pathname = os.path.join(self.job_staging_path, name)
+            stats = compression.compress_file(pathname, pathname + compression.SUFFIX, codec, level,
+                                              self.config.compression_block_size, threads)
+            os.remove(pathname)
+            for key in ('bytes_in', 'bytes_out', 'seconds'):
+                run[key] += stats[key]
+        run['ratio'] = run['bytes_in'] / run['bytes_out'] if run['bytes_out'] else 0
+        run['throughput'] = run['bytes_in'] / run['seconds'] if run['seconds'] else 0
+        logging.info(f"Job {self.job['uuid']} compression: ratio {run['ratio']:.2f}, "
+                     f"{run['throughput'] / 1024 / 1024:.1f} MiB/s")
+        with open(os.path.join(self.job_staging_path, 'compression-stats.jsonl'), 'a') as file:
+            file.write(json.dumps(run) + '\n')
+
+    def stream_image(self):
+        '''
+        streams the frozen images through the configured pipeline stages straight to the job's backend,
+        bypassing the staging area. The snapshot is committed as soon as the last image has been read.
+        An index of what was written is stored with the images.
+        '''
+        backend = pipeline.open_backend(self.backend_url(), self.job['uuid'])
+        with self.metrics.phase('snapshot'):
+            self.create_snapshot()
+        try:
+            disks = list(self.get_snap_files().keys())
+            files = self.get_file_list()
+            with self.metrics.phase('stream'):
+                results = pipeline.Pipeline(
+                    self.config, backend,
+                    throttle=throttle.job_throttle(self.config, self.job, files.keys(), self.host_limits)
+                ).stream_files(files)
+            for source, result in results.items():
+                self.metrics.add('bytes_copied', result['bytes_read'], files[source].split('-')[0])
+        finally:
+            self.commit_snapshot()
+        index = {}
+        for disk in disks:
+            index[disk] = [results[source] for source, dest in files.items() if dest.startswith(f"{disk}-")]
+        writer = backend.open(f"index-{int(time.time())}.json")
+        writer.write(json.dumps(index, indent=2).encode())
+        writer.close()
+
+    def backend_url(self):
+        '''
+        :return: the first of the job's backends, or stream-backend from virt-dup.yml.
+        '''
+        backends = self.job.get('backends', '').replace(',', ' ').split()
+        if backends:
+            return backends[0]
+        return self.config.stream_backend
+
+    def commit_snapshot(self):
+        with self.metrics.phase('commit'):
+            while True:
+                try:
+                    self.block_commit()
+                    break
+                except DiskPivotException:
+                    # restart block commit if disk pivot fails.
+                    self.metrics.add('pivot_retries', 1)
+                except Exception as e:
+                    raise e
+
+    def relink_staged_chain(self, chain, skip=()):
+        '''
+        staged copies still name the original images as their backing files. Point each staged image at the
+        staged copy below it instead, so the staged chain is self-contained. Shared copies outside the job's
+        staging directory are relinked by stage_shared.
+        :param chain: list of staged file names for one disk, base first.
+        :param skip: names which are already linked, e.g. copies reused from an earlier run.
+        :return: list of the names which were rebased.
+        '''
+        relinked = []
+        for seq in range(1, len(chain)):
+            if os.path.dirname(chain[seq]) != '' or chain[seq] in skip:
+                continue
+            qemu_utils.rebase(os.path.join(self.job_staging_path, chain[seq]), chain[seq - 1], unsafe=True)
+            relinked.append(chain[seq])
+        return relinked
+
+    def load_staging_cache(self):
+        '''
+        the staging cache remembers, for each source file this job has staged, the source's identity, the staged
+        copy's name and identity, and the checksum of the staged copy taken while it was copied.
+        :return: dict as below.
+        {
+            '/images/base.qcow2': {
+                'identity': [inode, mtime_ns, size],
+                'name': 'vda-1551669947-0.qcow2',
+                'staged_identity': [inode, mtime_ns, size],
+                'checksum': {'algorithm': 'sha256', 'block_size': 4194304, 'digest': '9f86d08...', 'blocks': [...]}
+            }
+        }
+        '''
+        try:
+            with open(os.path.join(self.job_staging_path, 'staging-cache.json')) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def reusable_staged_files(self, files, candidates, disks):
+        '''
+        finds backing files which haven't changed since an earlier run staged them, and whose staged copy is
+        still intact. Chains are walked from the base and stop at the first file which has to be staged again,
+        since the copies above it name the old copy of it as their backing file.
+        :param files: get_file_list() result
+        :param candidates: sources which would otherwise be copied into the job's staging directory
+        :param disks: get_snap_files() result, or the disks of a shut off domain, see offline_image()
+        :return: dict. '/source/path': 'previously-staged-name'
+        '''
+        cache = self.load_staging_cache()
+        ret = {}
+        for disk in disks:
             for source, dest in files.items():
-                pathname = f"{self.config.staging_path}/{self.job['uuid']}/{dest}"
-                shutil.copyfile(source, pathname)
-                # todo: sometimes extra slashes. Bash doesn't care, but it doesn't look nice.
-                print(pathname)
-        while True:
-            try:
-                self.block_commit()
-                break
-            except DiskPivotException:
-                # restart block commit if disk pivot fails.
-                pass
-            except Exception as e:
-                raise e
+                if not dest.startswith(f"{disk}-"):
+                    continue
+                entry = cache.get(source)
+                if source not in candidates or entry is None:
+                    break
+                try:
+                    unchanged = list(qemu_utils.file_identity(source)[1:]) == entry['identity'] and \
+                        list(qemu_utils.file_identity(os.path.join(self.job_staging_path, entry['name']))[1:]) == \
+                        entry['staged_identity']
+                except OSError:
+                    unchanged = False
+                if not unchanged:
+                    break
+                ret[source] = entry['name']
+        return ret
+
+    def update_staging_cache(self, files, copied, checksums, disks):
+        '''
+        records the files staged by this run. The top of each chain changes every run, so it isn't recorded.
+        :param files: get_file_list() result
+        :param copied: sources copied into the job's staging directory by this run
+        :param checksums: dict. '/source/path': checksum of the staged copy
+        :param disks: get_snap_files() result, taken while the snapshot existed
+        '''
+        cache = self.load_staging_cache()
+        for disk in disks:
+            chain = [source for source, dest in files.items() if dest.startswith(f"{disk}-")]
+            for source in chain[:-1]:
+                if source not in copied:
+                    continue
+                pathname = os.path.join(self.job_staging_path, files[source])
+                cache[source] = {'identity': list(qemu_utils.file_identity(source)[1:]),
+                                 'name': files[source],
+                                 'staged_identity': list(qemu_utils.file_identity(pathname)[1:]),
+                                 'checksum': checksums.get(source)}
+        path = os.path.join(self.job_staging_path, 'staging-cache.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(cache, file)
+        os.replace(path + '.tmp', path)
+
+    def write_manifest(self, files, staged, checksums, chains):
+        '''
+        writes manifest-<time>.json to the job's staging directory, describing the staged images of this run so
+        they can be verified and restored without reading them again. Images which are later compressed or moved
+        into the chunk store are described as they were staged.
+        {
+            'job': '<job uuid>',
+            'domain': 'vm01',
+            'time': 1551669947,
+            'disks': {
+                'vda': [
+                    {
+                        'seq': 0,
+                        'source': '/images/base.qcow2',
+                        'name': 'vda-1551669947-0.qcow2',
+                        'backing': None,
+                        'format': 'qcow2',
+                        'size': 1073741824,
+                        'virtual_size': 42949672960,
+                        'checksum': {'algorithm': 'sha256', 'block_size': 4194304, 'digest': '...', 'blocks': [...]}
+                    }
+                ]
+            }
+        }
+        :param files: get_file_list() result
+        :param staged: dict. '/source/path': staged name, relative to the job's staging directory
+        :param checksums: dict. '/source/path': checksum dict or None
+        :param chains: dict. 'vda': BackingChain of the frozen image, resolved while the snapshot existed
+        '''
+        now = int(time.time())
+        manifest = {'job': self.job['uuid'], 'domain': self.domxml.domain.name(), 'time': now, 'disks': {}}
+        for disk, chain in chains.items():
+            entries = []
+            for source, dest in files.items():
+                if not dest.startswith(f"{disk}-"):
+                    continue
+                img = chain.by_filename.get(source, {})
+                entries.append({'seq': len(entries),
+                                'source': source,
+                                'name': staged[source],
+                                'backing': entries[-1]['name'] if entries else None,
+                                'format': img.get('format'),
+                                'size': os.path.getsize(os.path.join(self.job_staging_path, staged[source])),
+                                'virtual_size': img.get('virtual-size'),
+                                'checksum': checksums.get(source)})
+            manifest['disks'][disk] = entries
+        path = os.path.join(self.job_staging_path, f"manifest-{now}.json")
+        with open(path + '.tmp', 'w') as file:
+            json.dump(manifest, file)
+        os.replace(path + '.tmp', path)
+        logging.info(f"Wrote {path}")
+
+    def load_chain_record(self):
+        '''
+        the chain record lists the staged files making up the latest backup of each disk for this job. Incremental
+        backups are layered on the last entry.
+        :return: dict. {'vda': ['vda-1551669947-0.qcow2', 'vda-1551756347-inc.qcow2']}
+        '''
+        try:
+            with open(os.path.join(self.job_staging_path, 'chain.json')) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_chain_record(self, record):
+        path = os.path.join(self.job_staging_path, 'chain.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(record, file)
+        os.replace(path + '.tmp', path)
+
+    def chain_is_staged(self, chain):
+        if not chain:
+            return False
+        return all(os.path.exists(os.path.join(self.job_staging_path, name)) for name in chain)
+
+    def load_checkpoint_record(self):
+        '''
+        the checkpoint record names the libvirt checkpoint taken by the last pull mode backup of this job, along with
+        the chain record it was taken for. Changes since the checkpoint can only be layered on that chain.
+        :return: dict or None. {'name': 'virt-dup-<job uuid>-1551669947', 'chain': {'vda': [...]}}
+        '''
+        try:
+            with open(os.path.join(self.job_staging_path, 'checkpoint.json')) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def save_checkpoint_record(self, name, record):
+        path = os.path.join(self.job_staging_path, 'checkpoint.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump({'name': name, 'chain': record}, file)
+        os.replace(path + '.tmp', path)
+
+    def delete_checkpoint(self, name):
+        '''
+        removes a checkpoint, with its dirty bitmaps, if it still exists.
+        '''
+        try:
+            self.domxml.domain.checkpointLookupByName(name).delete()
+        except libvirt.libvirtError as e:
+            logging.info(f"Job {self.job['uuid']} could not delete checkpoint {name}: {e}")
+
+    def gen_checkpoint_xml(self, name):
+        '''
+        https://libvirt.org/formatcheckpoint.html
+        :return: string containing xml data for a libvirt checkpoint of the job's disks
+        '''
+        xml = ET.Element('domaincheckpoint')
+        ET.SubElement(xml, 'name').text = name
+        ET.SubElement(xml, 'description').text = self.job['uuid']
+        disks = ET.SubElement(xml, 'disks')
+        for disk in self.domxml.disk_summary():
+            ET.SubElement(disks, 'disk', {'name': disk['dev_name'],
+                                          'checkpoint': 'bitmap' if disk['backup-enabled'] else 'no'})
+        return ET.tostring(xml).decode()
+
+    def gen_backup_xml(self, socket, incremental=None):
+        '''
+        https://libvirt.org/formatbackup.html
+        :param socket: unix socket for libvirt to serve the disks on. Each is exported under its dev name.
+        :param incremental: checkpoint to export changes since, as the dirty bitmap virt-dup-<dev name>
+        :return: string containing xml data for a pull mode libvirt backup
+        '''
+        xml = ET.Element('domainbackup', {'mode': 'pull'})
+        if incremental is not None:
+            ET.SubElement(xml, 'incremental').text = incremental
+        ET.SubElement(xml, 'server', {'transport': 'unix', 'socket': socket})
+        disks = ET.SubElement(xml, 'disks')
+        for disk in self.domxml.disk_summary():
+            if disk['backup-enabled']:
+                attributes = {'name': disk['dev_name'], 'backup': 'yes', 'type': 'file',
+                              'exportname': disk['dev_name']}
+                if incremental is not None:
+                    attributes['exportbitmap'] = f"virt-dup-{disk['dev_name']}"
+                disk_e = ET.SubElement(disks, 'disk', attributes)
+                ET.SubElement(disk_e, 'scratch', {'file': self.overlay_file(disk, '.virt-dup-scratch')})
+            else:
+                ET.SubElement(disks, 'disk', {'name': disk['dev_name'], 'backup': 'no'})
+        return ET.tostring(xml).decode()
 
     def gen_snapshot_xml(self):
         '''
@@ -127,12 +784,43 @@ class SnapshotManager(object):
                     attributes['snapshot'] = 'no'
                 disk_e = ET.Element('disk', attributes)
                 if disk['backup-enabled']:
-                    source = ET.Element('source', {'file': disk['path'] + '.virt-dup-snap'})
+                    source = ET.Element('source', {'file': self.overlay_file(disk)})
                     disk_e.append(source)
                 disks.append(disk_e)
 
         return ET.tostring(xml).decode()
 
+    def overlay_file(self, disk, suffix='.virt-dup-snap'):
+        '''
+        where the snapshot overlay of a disk goes: next to the image, or in the job's or virt-dup.yml's
+        overlay_path. Relocated overlays are named after the domain and device, so overlays of images with the
+        same file name, of this or other domains, can share the directory.
+        :param disk: disk_summary() entry
+        :param suffix: '.virt-dup-scratch' for the scratch file of a pull mode backup, which goes in the same place
+        '''
+        directory = self.job.get('overlay_path', self.config.overlay_path)
+        if directory is None:
+            return disk['path'] + suffix
+        name = f"{self.domxml.domain.UUIDString()}-{disk['dev_name']}-{os.path.basename(disk['path'])}"
+        return os.path.join(directory, name + suffix)
+
+    def check_overlay_space(self):
+        '''
+        makes sure every filesystem which will hold overlays has overlay-min-free bytes free for each of them.
+        '''
+        needed = {}
+        for disk in self.domxml.disk_summary():
+            if disk['backup-enabled']:
+                directory = os.path.dirname(self.overlay_file(disk))
+                os.makedirs(directory, exist_ok=True)
+                device = os.stat(directory).st_dev
+                needed.setdefault(device, [directory, 0])[1] += self.config.overlay_min_free
+        for directory, size in needed.values():
+            st = os.statvfs(directory)
+            free = st.f_bavail * st.f_frsize
+            if free < size:
+                raise OverlaySpaceException(self.job['uuid'], directory, free, size)
+
     def create_snapshot(self):
         '''
         Checks for existing snapshot for this job (raises error if snapshot exists).
@@ -160,61 +848,36 @@ class SnapshotManager(object):
             pass
         else:
             raise SnapshotExists(self.job['uuid'])
+        self.check_overlay_space()
         self.domxml.domain.snapshotCreateXML(
             self.gen_snapshot_xml(),
             libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY)
+        self.snapshot_time = time.time()
         self.load_our_snapshot()
 
-    def get_file_list(self):
+    def get_file_list(self, disks=None):
         """
         Handles enumeration of files for backup after snapshots are made and destination file naming
         Parses disk image data to determine sequence. Establishes depth rules.
         File names are the dev name of the disk image, then epoch time (all in job run should match), then sequence
         number.
 
+        :param disks: as from get_snap_files(), which is used if it's not given
         :return: Dict. Paths to copy. format is: '/source/path': 'destination.filename'
         E.g:
         {'/var/lib/libvirt/images/vm01.cow2': 'vda-1551669947-0.cow2'}
         """
-        disks = self.get_snap_files()
+        if disks is None:
+            disks = self.get_snap_files()
         timestamp = str(int(time.time()))
         ret = {}
         for disk, info in disks.items():
-            img_info = qemu_utils.img_info(info['base'])
-            cur = info['base']
-            chain = {}
-            # first build an accurate chain of any external snapshots
-            # may need to loop through more than once in case the list items come back in an unexpected order.
-            while True:
-                found_base = False
-                for img in img_info:
-
-                    if img['filename'] == cur:
-                        # format is base: top to we have easy access to the targeted image, and can count down for depth.
-                        try:
-                            chain[img['backing-filename']] = cur
-                            cur = img['backing-filename']
-                        except KeyError:
-                            #no backing file means base image
-                            chain['base'] = cur
-                            found_base = True
-                if found_base:
-                    break
-            # then generate filenames and filter out any backing files outside our depth.
-            if self.job['depth'] <= 0:
-                excl = abs(self.job['depth'])
-            else:
-                excl = len(img_info) - self.job['depth']
-            for seq in range(len(img_info)):
-                if seq == 0:
-                    key = chain['base']
-                else:
-                    key = chain[key]
-                if seq >= excl:
-                    ret[key] = f"{disk}-{timestamp}-{seq}.qcow2"
+            chain = qemu_utils.backing_chain(info['base'])
+            # generate filenames and filter out any backing files outside our depth.
+            for seq, filename in chain.select(self.job['depth']):
+                ret[filename] = f"{disk}-{timestamp}-{seq}.qcow2"
 
         return ret
-        # todo: info file in staging directory to keep image metadata with the backed-up images
 
     def load_our_snapshot(self):
         ret = None
@@ -250,32 +913,144 @@ class SnapshotManager(object):
         https://libvirt.org/html/libvirt-libvirt-domain.html#virDomainBlockCommitFlags
         Block copy sounds like a pretty good option, but it doesn't work in the case that there's an
         existing snapshot since the whole disk ends up consolodated in a new file. Maybe useful in a restore, though.
+        All disks are committed at once. Each is pivoted and its overlay removed as soon as its own commit is
+        ready, so the overlays live about as long as the slowest disk's commit. Disks committed by an earlier
+        attempt (see commit_snapshot) are skipped. The job's commit bandwidth is split between the disks
+        committing at once; see commit_speed().
         :return:
         '''
-        for disk, info in self.get_snap_files().items():
-            #todo: thread for wait on job to finish. BIG BOTTLENECK
-            if self.domxml.domain.state()[0] == libvirt.VIR_DOMAIN_RUNNING:
-                self.domxml.domain.blockCommit(
-                    disk,
-                    info['base'],
-                    info['top'],
-                    0,
-                    libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE |
-                    libvirt.VIR_DOMAIN_BLOCK_COMMIT_RELATIVE
-                )
-                self.pivot_disk(disk, info['base'])
-            else:
-                # libvirt as of 5.0.0 cannot block commit a volume on a domain that isn't running. Use QEMU instead
-                #todo: starting a domain while performing a block-commit with qemu would be bad. How to prevent this?
-                # This is especially true becauseof the updateDeviceFlags operation, since the
-                qemu_utils.block_commit(info['top'], base=info['base'])
+        self.commit_bandwidth = throttle.job_limit(self.config.commit_bandwidth, self.job, 'commit_bandwidth')
+        pending = {disk: info for disk, info in self.get_snap_files().items() if disk not in self.committed}
+        running = self.domxml.domain.state()[0] == libvirt.VIR_DOMAIN_RUNNING
+        self.committing = set(pending.keys())
+        budget = self.commit_budget()
+        for _ in pending:
+            budget.enter()
+        speed = self.commit_speed()
+        errors = []
+        if running:
+            flags = libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE | libvirt.VIR_DOMAIN_BLOCK_COMMIT_RELATIVE
+            if speed:
+                flags |= libvirt.VIR_DOMAIN_BLOCK_COMMIT_BANDWIDTH_BYTES
+            for disk, info in list(pending.items()):
+                # listen before starting the job so a fast job's ready event isn't missed.
+                self.block_job_waiter().expect(self.domxml.domain, disk)
+                try:
+                    with self.metrics.phase('block_commit', disk):
+                        self.domxml.domain.blockCommit(
+                            disk,
+                            info['base'],
+                            info['top'],
+                            speed,
+                            flags
+                        )
+                except libvirt.libvirtError:
+                    # e.g. the domain was shut down. The disks already started still get pivoted.
+                    pending.pop(disk)
+                    self.committing.discard(disk)
+                    budget.leave()
+                    errors.append(DiskPivotException(self.job['uuid'], disk, "Libvirt block commit error."))
+        with ThreadPoolExecutor(max_workers=max(1, len(pending)), thread_name_prefix='commit') as pool:
+            futures = [pool.submit(self.finish_commit, disk, info, running, speed)
+                       for disk, info in pending.items()]
+        errors += [future.exception() for future in futures if future.exception() is not None]
+        # anything but a failed pivot is fatal; a failed pivot is retried by commit_snapshot.
+        for e in sorted(errors, key=lambda e: isinstance(e, DiskPivotException)):
+            raise e
+
+        #remove snapshot metadata
+        self.load_our_snapshot().delete(libvirt.VIR_DOMAIN_SNAPSHOT_DELETE_METADATA_ONLY)
+        self.committed = set()
 
-                # have to inform libvirt of the changes,
-                self.pivot_disk(disk, info['base'], qemu_commit=True)
+    def finish_commit(self, disk, info, running, speed):
+        '''
+        waits for one disk's commit and pivots it, or commits it with qemu-img if the domain isn't running, then
+        removes its overlay. Runs on block_commit's thread pool.
+        :param speed: bandwidth the commit was started at
+        '''
+        try:
+            self._finish_commit(disk, info, running, speed)
+        finally:
+            # the job's other disks get its bandwidth, and the host's other commits their share of the host's.
+            self.committing.discard(disk)
+            self.commit_budget().leave()
 
-        #remove snapshot data/metadata
+    def _finish_commit(self, disk, info, running, speed):
+        if running:
+            adjuster = self.adapt_commit_speed(disk, info['base'], speed)
+            try:
+                self.pivot_disk(disk, info['base'])
+            finally:
+                if adjuster is not None:
+                    adjuster.set()
+        else:
+            # libvirt as of 5.0.0 cannot block commit a volume on a domain that isn't running. Use QEMU instead
+            #todo: starting a domain while performing a block-commit with qemu would be bad. How to prevent this?
+            # This is especially true becauseof the updateDeviceFlags operation, since the
+            # (offline_image() avoids all this for domains already shut off when their job starts.)
+            with self.metrics.phase('block_commit', disk):
+                # qemu-img can't change its rate once started, so take the share of the disks committing now.
+                qemu_utils.block_commit(info['top'], base=info['base'], r=self.commit_speed() or None)
+
+            # have to inform libvirt of the changes,
+            self.pivot_disk(disk, info['base'], qemu_commit=True)
+        self.committed.add(disk)
+        #remove snapshot data
         os.remove(info['top'])
-        self.load_our_snapshot().delete(libvirt.VIR_DOMAIN_SNAPSHOT_DELETE_METADATA_ONLY)
+        if self.snapshot_time is not None:
+            self.metrics.set('overlay_lifetime_seconds', time.time() - self.snapshot_time, disk)
+
+    def commit_budget(self):
+        '''
+        :return: the host's throttle.CommitBudget, or an unlimited one of this job's own if there's no worker pool.
+        '''
+        if self.host_limits is None or len(self.host_limits) < 3:
+            self.host_limits = tuple(self.host_limits or (None, None)) + (throttle.CommitBudget(0),)
+        return self.host_limits[2]
+
+    def commit_speed(self):
+        '''
+        :return: bandwidth for each of the job's block commits now: the job's commit bandwidth split evenly between
+        its disks still committing, and at most their share of the host's. 0 means unlimited.
+        '''
+        speeds = [self.commit_budget().share()]
+        if self.commit_bandwidth:
+            speeds.append(max(self.commit_bandwidth // max(len(self.committing), 1), 1))
+        speeds = [speed for speed in speeds if speed]
+        return min(speeds) if speeds else 0
+
+    def adapt_commit_speed(self, dev, base, speed, interval=2):
+        '''
+        keeps a running commit at commit_speed(), which changes as other disks start and finish committing, from a
+        thread, until the returned event is set. In adaptive mode the speed is also lowered while the device holding base
+        is busy.
+        :param speed: bandwidth the commit was started at
+        :return: threading.Event, or None if the commit isn't limited.
+        '''
+        if not speed:
+            return None
+        adaptive = throttle.adaptive_backoff(self.config, [base])
+        stop = threading.Event()
+
+        def adjust():
+            current = speed
+            while not stop.wait(interval):
+                target = self.commit_speed()
+                new_speed = target
+                if adaptive is not None and target:
+                    adaptive.update()
+                    new_speed = max(int(target * adaptive.factor()), target // 20, 1)
+                if new_speed != current:
+                    try:
+                        self.domxml.domain.blockJobSetSpeed(dev, new_speed,
+                                                            libvirt.VIR_DOMAIN_BLOCK_JOB_SPEED_BANDWIDTH_BYTES)
+                        current = new_speed
+                    except libvirt.libvirtError:
+                        # the job finished or was pivoted.
+                        return
+
+        threading.Thread(target=adjust, name=f"commit-speed-{dev}", daemon=True).start()
+        return stop
 
     def pivot_disk(self, dev, base, qemu_commit=False):
         '''
@@ -302,26 +1077,30 @@ class SnapshotManager(object):
                     libvirt.VIR_DOMAIN_AFFECT_CONFIG
                 )
         elif self.domxml.domain.state()[0] == libvirt.VIR_DOMAIN_RUNNING:
-            # make sure that block job is finished
-            while True:
-                time.sleep(1)
-                try:
-                    status = self.domxml.domain.blockJobInfo(dev, 0)
-                    if status['cur'] == status['end']:
-                        self.domxml.domain.blockJobAbort(dev, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
-                        break
-                except libvirt.libvirtError:
-                    #libvirt error raised when domain shut down after previous test
-                    raise DiskPivotException(self.job['uuid'], dev, "Libvirt blockjob error.")
+            # wait for the active commit to reach the ready state, then pivot straight away.
+            with self.metrics.phase('pivot_wait', dev):
+                status = self.block_job_waiter().wait(self.domxml.domain, dev)
+            if status != libvirt.VIR_DOMAIN_BLOCK_JOB_READY:
+                # failed or cancelled, e.g. when the domain is shut down mid-commit.
+                raise DiskPivotException(self.job['uuid'], dev, f"Block job ended with status {status}.")
+            try:
+                self.domxml.domain.blockJobAbort(dev, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+            except libvirt.libvirtError:
+                #libvirt error raised when domain shut down after previous test
+                raise DiskPivotException(self.job['uuid'], dev, "Libvirt blockjob error.")
         else:
             # not a qemu commit and domain not running. raise error.
             raise DiskPivotException(self.job['uuid'], dev, "Domain not running after libvirt block commit.")
 
+    def block_job_waiter(self):
+        return event_utils.block_job_waiter(self.domxml.domain.connect())
+
     def get_snap_files(self):
         '''
         in order to make sure that we leave things the way we found them with respect to snapshots (and don't
         cavalierly block-commit over someone's shared backing image), get_snap_files looks through the snapshot xml
-        for the correct paths to provide to block_commit.
+        for the correct paths to provide to block_commit. The top comes from the snapshot, so overlays relocated to
+        an overlay_path are found wherever they were put.
         :return: multilevel dict with parent nodes representing the dev name of the disks snapshotted by this job
         and child nodes for the top and base disk image paths, as below:
 
@@ -353,19 +1132,151 @@ class SnapshotManager(object):
                 ret[snapdisk.attrib['name']] = {'base': base, 'top': top}
         return ret
 
+    def pull_backup(self, incremental=False):
+        '''
+        backs the job's disks up with libvirt's backup api in pull mode instead of a snapshot: libvirt exports a
+        point in time view of each disk over nbd while the guest keeps writing to its own images (qemu saves the
+        old contents of clusters overwritten meanwhile to a scratch file), and the exports are read into new images
+        in the staging area. There's no overlay, so nothing to commit or pivot afterwards.
+        Every run also takes a checkpoint, so an incremental run reads only the clusters written since the last
+        run, into an image backed by that run's.
+        Needs libvirt and libvirt-python 6.0 or later and the libnbd python bindings. Shut off domains can't be
+        exported, so they're backed up by offline_image(), or stage_image() if that's disabled.
+        :param incremental: copy only the changes since the last pull mode backup, if there is one to build on.
+        '''
+        domain = self.domxml.domain
+        if not hasattr(domain, 'backupBegin'):
+            raise BackupUnsupported(self.job['uuid'], f"libvirt-python {libvirt.getVersion()} has no backupBegin")
+        nbd_backup.require_nbd()
+        if not domain.isActive():
+            logging.info(f"Domain {domain.name()} is shut off, job {self.job['uuid']} can't pull its disks.")
+            if not (self.offline_enabled() and self.offline_image()):
+                self.stage_image()
+            return
+        disks = [disk for disk in self.domxml.disk_summary() if disk['backup-enabled']]
+        record = self.load_chain_record()
+        previous = self.load_checkpoint_record()
+        if previous is not None:
+            try:
+                domain.checkpointLookupByName(previous['name'])
+            except libvirt.libvirtError:
+                previous = None
+        if incremental and (previous is None or previous['chain'] != record or
+                            not all(self.chain_is_staged(record.get(disk['dev_name'])) for disk in disks)):
+            logging.info(f"No checkpoint to build on for job {self.job['uuid']}. Running full backup.")
+            incremental = False
+        timestamp = str(int(time.time()))
+        checkpoint = f"virt-dup-{self.job['uuid']}-{timestamp}"
+        # qemu creates the socket, so it goes where qemu writes the scratch files.
+        socket = os.path.join(os.path.dirname(self.overlay_file(disks[0], '.virt-dup-scratch')),
+                              f"virt-dup-{self.job['uuid']}.sock")
+        self.check_overlay_space()
+        with self.metrics.phase('backup_begin'):
+            domain.backupBegin(self.gen_backup_xml(socket, previous['name'] if incremental else None),
+                               self.gen_checkpoint_xml(checkpoint), 0)
+        names = []
+        done = False
+        try:
+            for disk in disks:
+                dev = disk['dev_name']
+                pathname = os.path.join(self.job_staging_path, f"{dev}-{timestamp}-{'inc' if incremental else 0}.qcow2")
+                if incremental:
+                    qemu_utils.create_overlay(pathname, record[dev][-1])
+                else:
+                    qemu_utils.create_image(pathname, nbd_backup.export_size(socket, dev))
+                names.append(os.path.basename(pathname))
+                with self.metrics.phase('pull', dev):
+                    result = nbd_backup.copy_export(
+                        socket, dev, pathname, self.config.copy_workers,
+                        bitmap=f"virt-dup-{dev}" if incremental else None,
+                        throttle=throttle.job_throttle(self.config, self.job, [disk['path']], self.host_limits))
+                self.metrics.set('bytes_copied', result['bytes'], dev)
+                if result['seconds']:
+                    self.metrics.set('throughput_bytes_per_second', result['bytes'] / result['seconds'], dev)
+                record[dev] = record[dev] + names[-1:] if incremental else names[-1:]
+            done = True
+        finally:
+            # ends the backup job; libvirt stops the export and removes the scratch files.
+            domain.abortJob()
+            if not done:
+                self.delete_checkpoint(checkpoint)
+                for name in names:
+                    os.remove(os.path.join(self.job_staging_path, name))
+        # only the newest checkpoint is needed. Older ones cost the guest a bitmap update on every write.
+        if previous is not None:
+            self.delete_checkpoint(previous['name'])
+        self.save_checkpoint_record(checkpoint, record)
+        self.write_manifest(*self.chain_files({disk['dev_name']: disk['path'] for disk in disks}, record, names))
+        self.store_staged(names, record)
+
+    def chain_files(self, sources, record, names):
+        '''
+        describes each disk's chain of staged images, base first, the way write_manifest() wants it, for runs which
+        write their images without CopyEngine: pull mode and incremental runs. The image written by this run has
+        the disk as its source; those staged by earlier runs are their own source. The new images are checksummed
+        here, since they weren't hashed on the way.
+        :param sources: dict. 'vda': path of the disk (or frozen image) the run read
+        :param record: chain record including this run's images
+        :param names: the images written by this run
+        :return: (files, staged, checksums, chains) for write_manifest()
+        '''
+        files, staged, checksums, chains = {}, {}, {}, {}
+        algorithm = None if self.config.checksum in (None, 'none') else self.config.checksum
+        for dev, path in sources.items():
+            images = []
+            for seq, name in enumerate(record[dev]):
+                pathname = os.path.join(self.job_staging_path, name)
+                source = path if name in names else os.path.normpath(pathname)
+                # write_manifest() tells disks apart by this prefix; shared copies' names don't have it.
+                files[source] = f"{dev}-{seq}"
+                staged[source] = name
+                images.append(dict(qemu_utils.image_info(pathname), filename=source))
+                if name in names and algorithm is not None:
+                    with self.metrics.phase('checksum', dev):
+                        checksums[source] = file_checksum(pathname, algorithm, self.config.checksum_block_size)
+            # BackingChain lists the top first.
+            chains[dev] = qemu_utils.BackingChain(images[::-1])
+        return files, staged, checksums, chains
+
     def incremental_backup(self):
         '''
         creates a differential image from the most recent backup chain for this job. creates a full
         snapshot as in create_snapshot(), then creates an empty image based on the snapshot, then rebases
-        the new image on the most recent in the backup chain. This is a much more expensive process than
-        full backups, but most backup software can do it, so there you go.
+        the new image on the most recent in the backup chain. Rebase writes only the clusters which differ
+        between the two, so the new image holds just the changes since the last backup.
         https://kashyapc.fedorapeople.org/virt/img-diff-test.txt
+        Rebase reads the whole disk and the whole previous backup to compare them, so this reads as much as a full
+        backup. pull_backup() finds the changes with a checkpoint instead and reads only those.
 
-        NOTE: duplicity has an incremental backup feature. Need to determine if this will work for VM
-        incrementals given two fulls. Rebase may not be necessary.
+        Falls back to a full backup if any disk has no staged backup to build on. Writes a manifest of each
+        disk's staged chain, with checksums of the new images if checksum is set.
         :return:
         '''
-        self.domxml.domain.blockrebase()
+        record = self.load_chain_record()
+        for disk in self.domxml.disk_summary():
+            if disk['backup-enabled'] and not self.chain_is_staged(record.get(disk['dev_name'])):
+                logging.info(f"No staged backup of {disk['dev_name']} for job {self.job['uuid']}. Running full backup.")
+                self.stage_image()
+                return
+        with self.metrics.phase('snapshot'):
+            self.create_snapshot()
+        timestamp = str(int(time.time()))
+        sources = {}
+        names = []
+        for disk, info in self.get_snap_files().items():
+            name = f"{disk}-{timestamp}-inc.qcow2"
+            pathname = os.path.join(self.job_staging_path, name)
+            # the overlay starts out backed by the frozen image, then is moved onto the previous backup.
+            with self.metrics.phase('diff', disk):
+                qemu_utils.create_overlay(pathname, info['base'])
+                qemu_utils.rebase(pathname, record[disk][-1])
+            self.metrics.set('bytes_copied', os.path.getsize(pathname), disk)
+            record[disk].append(name)
+            sources[disk] = info['base']
+            names.append(name)
+        self.commit_snapshot()
+        self.write_manifest(*self.chain_files(sources, record, names))
+        self.save_chain_record(record)
 
 
 class VirtDupXML(object):
@@ -403,6 +1314,22 @@ class VirtDupXML(object):
 
         return disks
 
+    def backing_files(self, disk):
+        '''
+        reads a disk's backing chain from the <backingStore> elements libvirt adds to domain xml.
+        :param disk: disk element
+        :return: list of backing file paths, nearest first, or None if libvirt didn't report the chain.
+        '''
+        node = disk.find('backingStore')
+        if node is None:
+            return None
+        chain = []
+        # an empty <backingStore/> ends the chain.
+        while node is not None and node.find('source') is not None:
+            chain.append(node.find('source').attrib.get('file'))
+            node = node.find('backingStore')
+        return chain
+
     def get_metadata_element(self):
         '''
         Creates metadata element if none exists; returns one if it's there.
@@ -464,7 +1391,8 @@ class VirtDupXML(object):
             else:
                 jobs[uuid]['depth'] = self.config.depth
             if 'schedule' not in jobs[uuid].keys():
-                jobs[uuid]['schedule'] = self.config.default_schedule
+                # add_job writes full_schedule.
+                jobs[uuid]['schedule'] = jobs[uuid].get('full_schedule', self.config.default_schedule)
             if job.find('dev') is None:
                 jobs[job.attrib['uuid']]['dev_names'] = self.disk_list
             else:
@@ -513,6 +1441,50 @@ class VirtDupXML(object):
             job_attributes['depth'] = kwargs['depth']
         except:
             pass
+        try:
+            job_attributes['mode'] = kwargs['mode']
+        except:
+            pass
+        try:
+            job_attributes['compression'] = kwargs['compression']
+        except:
+            pass
+        try:
+            job_attributes['compression_level'] = kwargs['compression_level']
+        except:
+            pass
+        try:
+            job_attributes['compression_threads'] = kwargs['compression_threads']
+        except:
+            pass
+        try:
+            job_attributes['max_jobs_per_device'] = kwargs['max_jobs_per_device']
+        except:
+            pass
+        try:
+            job_attributes['max_jobs_per_backend'] = kwargs['max_jobs_per_backend']
+        except:
+            pass
+        try:
+            job_attributes['copy_bandwidth'] = kwargs['copy_bandwidth']
+        except:
+            pass
+        try:
+            job_attributes['copy_iops'] = kwargs['copy_iops']
+        except:
+            pass
+        try:
+            job_attributes['commit_bandwidth'] = kwargs['commit_bandwidth']
+        except:
+            pass
+        try:
+            job_attributes['overlay_path'] = kwargs['overlay_path']
+        except:
+            pass
+        try:
+            job_attributes['offline'] = str(kwargs['offline'])
+        except:
+            pass
 
         job_element = ET.Element('job', job_attributes)
 
@@ -571,6 +1543,7 @@ class VirtDupXML(object):
             {
                 'dev_name': vda
                 'path': '/etc/libvirt/qemu/vda.qcow2',
+                'backing': ['/etc/libvirt/qemu/base.qcow2'],
                 'backed-up': True,
                 'target': ['rsync://backupserver//backups']
                 'schedule': None
@@ -600,6 +1573,7 @@ class VirtDupXML(object):
                     dev_name = disk.find('target').attrib['dev']
                     dev_info = {'path': path,
                                 'dev_name': dev_name,
+                                'backing': self.backing_files(disk),
                                 'backup-enabled': False,
                                 'jobs': []}
                     for jobuuid, jobinfo in self.loaded_jobs.items():
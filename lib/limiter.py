@@ -0,0 +1,124 @@
+import os
+import logging
+from collections import deque
+
+
+def job_resources(config, entry, jobuuid):
+    '''
+    works out what a job will contend for: the block devices/filesystems of its images (by st_dev) and its
+    backends, along with any per-job limits set in the job xml.
+    :param config: Config
+    :param entry: DomainCache entry of the job's domain
+    :param jobuuid:
+    :return: dict as below. A limit of 0 means unlimited.
+    {
+        'devices': {2049, 2065},
+        'backends': {'rsync://backupserver//backups'},
+        'max_per_device': 2,
+        'max_per_backend': 0
+    }
+    '''
+    job = entry['jobs'][jobuuid]
+    devices = set()
+    for disk in entry['disks']:
+        if jobuuid in disk['jobs']:
+            try:
+                devices.add(os.stat(disk['path']).st_dev)
+            except OSError:
+                logging.warning(f"Cannot stat {disk['path']} for job {jobuuid}.")
+    backends = set(job.get('backends', '').replace(',', ' ').split())
+    ret = {'devices': devices,
+           'backends': backends,
+           'max_per_device': config.max_jobs_per_device,
+           'max_per_backend': config.max_jobs_per_backend}
+    # job xml may only tighten the global limits.
+    for key, attribute in (('max_per_device', 'max_jobs_per_device'), ('max_per_backend', 'max_jobs_per_backend')):
+        if attribute in job.keys():
+            try:
+                limit = int(job[attribute])
+            except (TypeError, ValueError):
+                logging.warning(f"Ignoring {attribute}={job[attribute]!r} of job {jobuuid}, it isn't a number.")
+                continue
+            if limit > 0:
+                ret[key] = limit if ret[key] == 0 else min(ret[key], limit)
+    return ret
+
+
+class ResourceLimiter(object):
+    '''
+    Decides which queued jobs may start, given a global limit on running jobs and limits per storage device and
+    per backend. Jobs are considered oldest first, and a job which has to wait holds its place in line for its
+    devices and backends: younger jobs sharing any of them wait behind it, so no job can be starved. Younger jobs
+    on other storage still start straight away.
+    '''
+    def __init__(self, max_jobs=0):
+        '''
+        :param max_jobs: maximum number of running jobs. 0 means unlimited.
+        '''
+        self.max_jobs = max_jobs
+        self.pending = deque()
+        # jobuuid: resources
+        self.running = {}
+
+    def add(self, jobuuid, item, resources):
+        '''
+        queues a job. A job which is already queued, e.g. because cron slots keep firing while its previous run is
+        still going, isn't queued again: the queued run keeps its place and becomes a full one if either is.
+        :param item: the job message, with its 'kind'
+        '''
+        for i, (queued, queued_item, queued_resources) in enumerate(self.pending):
+            if queued == jobuuid:
+                if queued_item.get('kind') == 'full' and item.get('kind') != 'full':
+                    item = dict(item, kind='full')
+                self.pending[i] = (jobuuid, item, resources)
+                return
+        self.pending.append((jobuuid, item, resources))
+
+    def release(self, jobuuid):
+        self.running.pop(jobuuid, None)
+
+    def count(self, kind, key):
+        return sum(1 for resources in self.running.values() if key in resources[kind])
+
+    def admissible(self, jobuuid, resources):
+        if jobuuid in self.running:
+            # the previous run of this job is still going.
+            return False
+        for kind, limit in (('devices', resources['max_per_device']), ('backends', resources['max_per_backend'])):
+            if limit > 0 and any(self.count(kind, key) >= limit for key in resources[kind]):
+                return False
+        return True
+
+    def ready(self, slots=None):
+        '''
+        removes and returns the queued jobs which may start now, and counts them as running.
+        :param slots: start at most this many jobs, e.g. the number of idle workers. None means no limit.
+        :return: list of (jobuuid, item) tuples
+        '''
+        ret = []
+        waiting = deque()
+        held = {'devices': set(), 'backends': set(), 'jobs': set()}
+        while self.pending:
+            jobuuid, item, resources = self.pending.popleft()
+            full = self.max_jobs > 0 and len(self.running) >= self.max_jobs
+            if full or (slots is not None and len(ret) >= slots):
+                waiting.append((jobuuid, item, resources))
+                continue
+            if jobuuid in held['jobs'] or jobuuid in self.running:
+                # waiting on its own previous run, not on its storage, so it doesn't hold anyone else up.
+                held['jobs'].add(jobuuid)
+                waiting.append((jobuuid, item, resources))
+                continue
+            blocked = held['devices'] & resources['devices'] or \
+                held['backends'] & resources['backends'] or \
+                not self.admissible(jobuuid, resources)
+            if blocked:
+                held['jobs'].add(jobuuid)
+                held['devices'] |= resources['devices']
+                held['backends'] |= resources['backends']
+                waiting.append((jobuuid, item, resources))
+            else:
+                self.running[jobuuid] = resources
+                ret.append((jobuuid, item))
+        self.pending = waiting
+        return ret
@@ -0,0 +1,176 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# job values which also accumulate into a <name>_total counter across runs.
+COUNTED = ('bytes_copied', 'pivot_retries')
+
+
+class JobMetrics(object):
+    '''
+    collects the timings and values of one job run inside a worker. Everything is keyed by name and disk (None for
+    the whole job), and sent to the dispatcher with the job's 'done' message as as_dict().
+    '''
+    def __init__(self):
+        # (phase, disk): seconds
+        self.phases = {}
+        # (name, disk): value
+        self.values = {}
+
+    @contextmanager
+    def phase(self, name, disk=None):
+        '''
+        times the body of a with statement. A phase entered more than once, e.g. block_commit after a pivot retry,
+        adds up.
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            key = (name, disk)
+            self.phases[key] = self.phases.get(key, 0) + time.time() - start
+
+    def set(self, name, value, disk=None):
+        self.values[(name, disk)] = value
+
+    def add(self, name, value, disk=None):
+        self.values[(name, disk)] = self.values.get((name, disk), 0) + value
+
+    def as_dict(self):
+        '''
+        :return: picklable dict as below.
+        {
+            'phases': [['snapshot', None, 0.4], ['pivot_wait', 'vda', 12.1]],
+            'values': [['bytes_copied', 'vda', 10737418240], ['pivot_retries', None, 1]]
+        }
+        '''
+        return {'phases': [[name, disk, seconds] for (name, disk), seconds in self.phases.items()],
+                'values': [[name, disk, value] for (name, disk), value in self.values.items()]}
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels.keys(), escaped)) + '}'
+
+
+class Registry(object):
+    '''
+    Gauges and counters in the prometheus text exposition format. Metric names are prefixed with virt_dup_.
+    The dispatcher owns the registry; workers report into it through their 'done' messages and job_monitor
+    through 'monitor' messages on job_q.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name: {'type': 'gauge', 'help': '...', 'samples': {(('job', '<uuid>'),): value}}
+        self.metrics = {}
+
+    def _sample(self, kind, name, help, labels):
+        metric = self.metrics.setdefault('virt_dup_' + name, {'type': kind, 'help': help, 'samples': {}})
+        return metric['samples'], tuple(sorted(labels.items()))
+
+    def gauge(self, name, help, value, **labels):
+        with self.lock:
+            samples, key = self._sample('gauge', name, help, labels)
+            samples[key] = value
+
+    def counter(self, name, help, value=1, **labels):
+        with self.lock:
+            samples, key = self._sample('counter', name, help, labels)
+            samples[key] = samples.get(key, 0) + value
+
+    def record_job(self, message):
+        '''
+        records a worker's 'done' message.
+        '''
+        job = message['jobuuid']
+        self.counter('jobs_total', 'Job runs finished.', kind=message['kind'], ok=str(message['ok']).lower())
+        self.gauge('job_duration_seconds', 'Duration of the last run of the job.', message['seconds'],
+                   job=job, kind=message['kind'])
+        self.gauge('job_last_finished_timestamp_seconds', 'When the last run of the job finished.', time.time(),
+                   job=job)
+        metrics = message.get('metrics') or {'phases': [], 'values': []}
+        for phase, disk, seconds in metrics['phases']:
+            labels = {'job': job, 'phase': phase}
+            if disk is not None:
+                labels['disk'] = disk
+            self.gauge('job_phase_seconds', 'Time spent in each phase of the last run of the job.', seconds,
+                       **labels)
+            self.counter('phase_seconds_total', 'Time spent in each phase by all jobs.', seconds, phase=phase)
+        for name, disk, value in metrics['values']:
+            labels = {'job': job}
+            if disk is not None:
+                labels['disk'] = disk
+            description = name.replace('_', ' ').capitalize()
+            self.gauge('job_' + name, f"{description} in the last run of the job.", value, **labels)
+            if name in COUNTED:
+                self.counter(name + '_total', f"{description} by all jobs.", value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, metric in sorted(self.metrics.items()):
+                lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} {metric['type']}")
+                for key, value in sorted(metric['samples'].items()):
+                    lines.append(f"{name}{_labels(dict(key))} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+class Exporter(object):
+    '''
+    publishes a Registry as a prometheus textfile (for node_exporter's textfile collector) and/or on a local http
+    endpoint, depending on metrics-textfile and metrics-listen in virt-dup.yml.
+    '''
+    def __init__(self, config, registry):
+        self.registry = registry
+        self.textfile = config.metrics_textfile
+        self.server = None
+        if config.metrics_listen is not None:
+            host, port = config.metrics_listen.rsplit(':', 1)
+            self.server = ThreadingHTTPServer((host, int(port)), self.handler())
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+            logging.info(f"Serving metrics on http://{config.metrics_listen}/metrics")
+
+    def handler(self):
+        registry = self.registry
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MetricsHandler
+
+    def write(self):
+        if self.textfile is None:
+            return
+        # node_exporter may read the file at any time, so replace it whole.
+        tmp = f"{self.textfile}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w') as file:
+                file.write(self.registry.render())
+            os.replace(tmp, self.textfile)
+        except OSError as e:
+            logging.warning(f"Cannot write metrics to {self.textfile}: {e}")
+
+    def close(self):
+        self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,196 @@
+import os
+import time
+import logging
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from lib.exceptions.pipeline_exceptions import MissingDependency
+from lib.exceptions.qemu_exceptions import NBDServerException
+
+try:
+    import nbd
+except ImportError:
+    nbd = None
+
+ALLOCATION = 'base:allocation'
+# bit set in a dirty bitmap's block status for clusters written since the bitmap was created.
+DIRTY = 1
+# largest read or write sent to an nbd server. Servers needn't accept more than 32MiB.
+PIECE_SIZE = 4 * 1024 * 1024
+# block status is asked for at most this much at a time.
+STATUS_SIZE = 1024 * 1024 * 1024
+ZEROS = bytes(PIECE_SIZE)
+
+
+def require_nbd():
+    if nbd is None:
+        raise MissingDependency('pull', 'nbd')
+
+
+def bitmap_context(bitmap):
+    return f"qemu:dirty-bitmap:{bitmap}"
+
+
+def connect(socket, export, meta_contexts=()):
+    '''
+    :return: libnbd handle connected to export on the unix socket
+    '''
+    require_nbd()
+    handle = nbd.NBD()
+    for context in meta_contexts:
+        handle.add_meta_context(context)
+    handle.set_export_name(export)
+    handle.connect_unix(socket)
+    return handle
+
+
+def export_size(socket, export):
+    handle = connect(socket, export)
+    try:
+        return handle.get_size()
+    finally:
+        handle.shutdown()
+
+
+def extents(handle, context, offset=0, length=None):
+    '''
+    walks the block status of an export for one meta context, which the handle must have been connected with.
+    :return: list of (offset, length, flags) covering offset to offset + length (or the end of the export).
+    '''
+    end = handle.get_size() if length is None else offset + length
+    ret = []
+    while offset < end:
+        found = []
+
+        def callback(metacontext, start, entries, err):
+            if metacontext == context:
+                position = start
+                for i in range(0, len(entries) - 1, 2):
+                    found.append((position, entries[i], entries[i + 1]))
+                    position += entries[i]
+            return 0
+
+        handle.block_status(min(end - offset, STATUS_SIZE), offset, callback)
+        if not found:
+            raise NBDServerException(context, f"no block status at offset {offset}")
+        for start, size, flags in found:
+            size = min(size, end - start)
+            if size > 0:
+                ret.append((start, size, flags))
+        offset = min(end, found[-1][0] + found[-1][1])
+    return ret
+
+
+def plan(handle, bitmap=None):
+    '''
+    works out what to copy from an export into a new image.
+    :param bitmap: name of the exported dirty bitmap for an incremental copy into an image backed by the previous
+    one: only dirty clusters are copied, and dirty clusters which now read as zeros are zeroed. Without it,
+    everything allocated is copied into an image with no backing file.
+    :return: list of (offset, length, zero) pieces of at most PIECE_SIZE bytes.
+    '''
+    if bitmap is None:
+        wanted = [(0, handle.get_size())]
+    else:
+        wanted = [(offset, length) for offset, length, flags in extents(handle, bitmap_context(bitmap))
+                  if flags & DIRTY]
+    ret = []
+    for offset, length in wanted:
+        for start, size, flags in extents(handle, ALLOCATION, offset, length):
+            zero = bool(flags & nbd.STATE_ZERO)
+            # a new image without a backing file reads as zeros already.
+            if zero and bitmap is None:
+                continue
+            for piece in range(start, start + size, PIECE_SIZE):
+                ret.append((piece, min(PIECE_SIZE, start + size - piece), zero))
+    return ret
+
+
+@contextmanager
+def serve_image(pathname, connections, fmt='qcow2'):
+    '''
+    serves an image for writing with qemu-nbd on a private unix socket, for up to connections clients at once.
+    :return: the socket's path, while in the with statement.
+    '''
+    directory = tempfile.mkdtemp(prefix='virt-dup-nbd-')
+    socket = os.path.join(directory, 'nbd.sock')
+    process = subprocess.Popen(['qemu-nbd', '--socket', socket, '--format', fmt, '--shared', str(connections),
+                                '--persistent', '--discard', 'unmap', pathname],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        deadline = time.monotonic() + 30
+        while not os.path.exists(socket):
+            if process.poll() is not None:
+                raise NBDServerException(pathname, process.stderr.read().decode(errors='replace'))
+            if time.monotonic() > deadline:
+                raise NBDServerException(pathname, "qemu-nbd didn't start listening")
+            time.sleep(0.05)
+        yield socket
+    finally:
+        process.terminate()
+        process.wait()
+        process.stderr.close()
+        if os.path.exists(socket):
+            os.remove(socket)
+        os.rmdir(directory)
+
+
+def copy_pieces(source_socket, export, target_socket, pieces, throttle=None):
+    '''
+    copies pieces from plan() over a connection of its own to each side. Data pieces which turn out to hold only
+    zeros are written as zeros, leaving the target sparse.
+    :return: (bytes written, bytes zeroed)
+    '''
+    source = connect(source_socket, export)
+    target = connect(target_socket, '')
+    written = zeroed = 0
+    try:
+        for offset, length, zero in pieces:
+            if not zero:
+                if throttle is not None:
+                    throttle.acquire(length)
+                data = source.pread(length, offset)
+                if data != ZEROS[:length]:
+                    target.pwrite(data, offset)
+                    written += length
+                    continue
+            target.zero(length, offset)
+            zeroed += length
+        target.flush()
+    finally:
+        source.shutdown()
+        target.shutdown()
+    return written, zeroed
+
+
+def copy_export(socket, export, pathname, workers=4, bitmap=None, throttle=None):
+    '''
+    copies an nbd export (e.g. a disk exported by a pull mode libvirt backup, or a local `qemu-nbd` export of an
+    image) into an existing qcow2 image, over workers connections in parallel.
+    :param socket: unix socket the export is served on
+    :param pathname: image to write. It must be at least as large as the export, and should be new: see plan().
+    :param bitmap: dirty bitmap to read only changed clusters with, see plan()
+    :return: dict. {'bytes': 10737418240, 'zeroed': 1048576, 'seconds': 60.2}
+    '''
+    start = time.time()
+    handle = connect(socket, export, [ALLOCATION] if bitmap is None else [ALLOCATION, bitmap_context(bitmap)])
+    try:
+        pieces = plan(handle, bitmap)
+    finally:
+        handle.shutdown()
+    logging.debug(f"{len(pieces)} pieces to copy from nbd export {export} into {pathname}")
+    # contiguous shares, so each worker reads its part of the disk sequentially.
+    size = -(-len(pieces) // workers)
+    shares = [pieces[i:i + size] for i in range(0, len(pieces), size)] if pieces else []
+    written = zeroed = 0
+    if shares:
+        with serve_image(pathname, len(shares)) as target_socket:
+            with ThreadPoolExecutor(max_workers=len(shares)) as pool:
+                futures = [pool.submit(copy_pieces, socket, export, target_socket, share, throttle)
+                           for share in shares]
+                for future in futures:
+                    result = future.result()
+                    written += result[0]
+                    zeroed += result[1]
+    return {'bytes': written, 'zeroed': zeroed, 'seconds': time.time() - start}
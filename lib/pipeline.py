@@ -0,0 +1,264 @@
+import os
+import time
+import zlib
+import logging
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from lib.exceptions.pipeline_exceptions import UnknownStage, UnknownBackend, MissingDependency, BadKey
+from lib.copy_utils import new_hash
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+READ_SIZE = 4 * 1024 * 1024
+
+
+class ChecksumStage(object):
+    '''
+    passes data through unchanged and records a digest of it, with virt-dup.yml's checksum algorithm. Pipelines
+    leave it out when that is none.
+    '''
+    name = 'checksum'
+    suffix = ''
+
+    def __init__(self, config):
+        self.algorithm = config.checksum
+        self.hash = new_hash(self.algorithm)
+
+    def process(self, data):
+        self.hash.update(data)
+        return data
+
+    def finish(self):
+        return b''
+
+    def info(self):
+        return {'algorithm': self.algorithm, 'digest': self.hash.hexdigest()}
+
+
+class CompressStage(object):
+    '''
+    gzip-compatible stream compression.
+    '''
+    name = 'compress'
+    suffix = '.gz'
+
+    def __init__(self, config):
+        # compression-level is shared with the staging codecs, whose levels go higher (zstd's to 22) than
+        # zlib's 0-9.
+        self.level = min(max(int(config.compression_level), 0), 9)
+        # wbits 31 gives a gzip header, so the output can be read with gunzip.
+        self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def process(self, data):
+        self.bytes_in += len(data)
+        out = self.compressor.compress(data)
+        self.bytes_out += len(out)
+        return out
+
+    def finish(self):
+        out = self.compressor.flush()
+        self.bytes_out += len(out)
+        return out
+
+    def info(self):
+        return {'level': self.level, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+
+class EncryptStage(object):
+    '''
+    AES-256-GCM. The output is a 12 byte nonce, the ciphertext, then the 16 byte authentication tag.
+    The key is read from the file named by encryption-key-file and must be 32 bytes.
+    '''
+    name = 'encrypt'
+    suffix = '.aes'
+
+    def __init__(self, config):
+        if Cipher is None:
+            raise MissingDependency(self.name, 'cryptography')
+        if not config.encryption_key_file:
+            raise BadKey(config.encryption_key_file, "encryption-key-file isn't set")
+        try:
+            with open(config.encryption_key_file, 'rb') as file:
+                key = file.read(33)
+        except OSError as e:
+            raise BadKey(config.encryption_key_file, e.strerror)
+        if len(key) != 32:
+            # AES accepts 16 and 24 byte keys too, which would silently give weaker encryption than documented.
+            raise BadKey(config.encryption_key_file, "it must hold exactly 32 bytes")
+        self.nonce = os.urandom(12)
+        self.encryptor = Cipher(algorithms.AES(key), modes.GCM(self.nonce)).encryptor()
+        self.started = False
+
+    def process(self, data):
+        out = self.encryptor.update(data)
+        if not self.started:
+            self.started = True
+            out = self.nonce + out
+        return out
+
+    def finish(self):
+        out = self.encryptor.finalize() + self.encryptor.tag
+        if not self.started:
+            self.started = True
+            out = self.nonce + out
+        return out
+
+    def info(self):
+        return {'cipher': 'aes-256-gcm'}
+
+
+STAGES = {
+    'checksum': ChecksumStage,
+    'compress': CompressStage,
+    'encrypt': EncryptStage,
+}
+
+
+class LocalDirectoryBackend(object):
+    '''
+    writes backup objects to a local directory. Objects are written under a temporary name and renamed when
+    closed, so a partially written object is never mistaken for a complete one.
+    '''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def open(self, name):
+        return LocalDirectoryWriter(os.path.join(self.path, name))
+
+
+class LocalDirectoryWriter(object):
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.file = open(pathname + '.part', 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.pathname + '.part', self.pathname)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.pathname + '.part')
+
+
+BACKENDS = {
+    'file': LocalDirectoryBackend,
+    '': LocalDirectoryBackend,
+}
+
+
+def open_backend(url, jobuuid):
+    '''
+    :param url: backend url, e.g. file:///var/backups/virt-dup. A plain path is a local directory.
+    :param jobuuid: each job gets its own directory/prefix in the backend.
+    :return: backend object with an open(name) method returning a writer.
+    '''
+    if url is None:
+        raise UnknownBackend(url)
+    parsed = urlparse(url)
+    try:
+        backend = BACKENDS[parsed.scheme]
+    except KeyError:
+        raise UnknownBackend(url)
+    return backend(os.path.join(parsed.path, jobuuid))
+
+
+class Pipeline(object):
+    '''
+    Reads each source file once, passes it through the configured stages in order and writes the result straight
+    to a backend, without a copy in the staging area. Files are streamed concurrently on a thread pool; zlib,
+    hashlib and the ciphers release the GIL on large buffers.
+    '''
+    def __init__(self, config, backend, stages=None, workers=None, throttle=None):
+        '''
+        :param throttle: lib.throttle.Throttle limiting the rate sources are read at, or None.
+        '''
+        self.config = config
+        self.throttle = throttle
+        self.backend = backend
+        self.stage_names = config.stream_stages if stages is None else stages
+        for name in self.stage_names:
+            if name not in STAGES.keys():
+                raise UnknownStage(name)
+        if config.checksum in (None, 'none'):
+            self.stage_names = [name for name in self.stage_names if name != 'checksum']
+        if 'encrypt' in self.stage_names:
+            # a missing or bad key fails the job before anything is read or written.
+            EncryptStage(config)
+        self.workers = config.copy_workers if workers is None else workers
+
+    def object_name(self, name):
+        return name + ''.join(STAGES[stage].suffix for stage in self.stage_names)
+
+    def stream_file(self, source, name):
+        '''
+        :param source: path to read
+        :param name: object name before stage suffixes are added
+        :return: dict describing what was written, as below.
+        {
+            'source': '/images/vm01.qcow2',
+            'object': 'vda-1551669947-0.qcow2.gz',
+            'bytes_read': 10737418240,
+            'bytes_written': 3435973836,
+            'seconds': 40.2,
+            'stages': {'checksum': {...}, 'compress': {...}}
+        }
+        '''
+        stages = [STAGES[stage](self.config) for stage in self.stage_names]
+        object_name = self.object_name(name)
+        writer = self.backend.open(object_name)
+        start = time.time()
+        bytes_read = 0
+        bytes_written = 0
+        try:
+            with open(source, 'rb') as file:
+                while True:
+                    if self.throttle is not None:
+                        self.throttle.acquire(READ_SIZE)
+                    data = file.read(READ_SIZE)
+                    if not data:
+                        break
+                    bytes_read += len(data)
+                    for stage in stages:
+                        data = stage.process(data)
+                    writer.write(data)
+                    bytes_written += len(data)
+            # flush each stage's tail through the stages after it.
+            for i, stage in enumerate(stages):
+                data = stage.finish()
+                for later in stages[i + 1:]:
+                    data = later.process(data)
+                writer.write(data)
+                bytes_written += len(data)
+        except BaseException as e:
+            writer.abort()
+            raise e
+        writer.close()
+        seconds = max(time.time() - start, 1e-9)
+        logging.info(f"Streamed {source} to {object_name}: {bytes_read} bytes read, {bytes_written} written "
+                     f"in {seconds:.2f}s ({bytes_read / seconds / 1024 / 1024:.1f} MiB/s)")
+        return {'source': source,
+                'object': object_name,
+                'bytes_read': bytes_read,
+                'bytes_written': bytes_written,
+                'seconds': seconds,
+                'stages': {stage.name: stage.info() for stage in stages}}
+
+    def stream_files(self, files):
+        '''
+        :param files: dict. '/source/path': 'object-name'
+        :return: dict of stream_file results keyed by source path.
+        '''
+        with ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix='stream') as pool:
+            futures = {source: pool.submit(self.stream_file, source, name) for source, name in files.items()}
+            return {source: future.result() for source, future in futures.items()}
@@ -0,0 +1,192 @@
+import os
+import re
+import struct
+
+# https://gitlab.com/qemu-project/qemu/-/blob/master/docs/interop/qcow2.txt
+MAGIC = b'QFI\xfb'
+# version 2 header, common to both versions
+HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+# version 3 additions: incompatible, compatible and autoclear features, refcount_order, header_length
+HEADER_V3 = struct.Struct('>QQQII')
+EXTENSION = struct.Struct('>II')
+BITMAP_EXTENSION = struct.Struct('>IIQQ')
+BITMAP_ENTRY = struct.Struct('>QIIBBHI')
+
+EXT_END = 0
+EXT_BACKING_FORMAT = 0xe2792aca
+EXT_FEATURE_NAMES = 0x6803f857
+EXT_BITMAPS = 0x23852875
+EXT_ENCRYPTION = 0x0537be77
+EXT_DATA_FILE = 0x44415441
+
+INCOMPAT_DIRTY = 1 << 0
+INCOMPAT_CORRUPT = 1 << 1
+INCOMPAT_DATA_FILE = 1 << 2
+INCOMPAT_COMPRESSION = 1 << 3
+INCOMPAT_EXTL2 = 1 << 4
+KNOWN_INCOMPAT = INCOMPAT_DIRTY | INCOMPAT_CORRUPT | INCOMPAT_DATA_FILE | INCOMPAT_COMPRESSION | INCOMPAT_EXTL2
+COMPAT_LAZY_REFCOUNTS = 1 << 0
+
+BITMAP_IN_USE = 1 << 0
+BITMAP_AUTO = 1 << 1
+
+# backing file names qemu would hand to a protocol driver (json:{...}, nbd://, ...) rather than open as a file.
+PROTOCOL = re.compile(r'^[A-Za-z0-9+.-]+:')
+
+
+class Header(object):
+    '''
+    the fields of a qcow2 header which virt-dup cares about, read straight from the file.
+    '''
+    def __init__(self, version, cluster_bits, size, crypt_method, l1_size, l1_table_offset, nb_snapshots,
+                 incompatible_features=0, compatible_features=0, refcount_order=4, compression_type=0):
+        self.version = version
+        self.cluster_size = 1 << cluster_bits
+        self.size = size
+        self.crypt_method = crypt_method
+        self.l1_size = l1_size
+        self.l1_table_offset = l1_table_offset
+        self.nb_snapshots = nb_snapshots
+        self.incompatible_features = incompatible_features
+        self.compatible_features = compatible_features
+        self.refcount_order = refcount_order
+        self.compression_type = compression_type
+        self.backing_file = None
+        self.backing_format = None
+        # [{'name': 'virt-dup-vda', 'granularity': 65536, 'flags': ['auto']}]
+        self.bitmaps = None
+        # extension types found, for telling what this reader doesn't support
+        self.extensions = set()
+
+
+def _pread(fd, length, offset):
+    data = os.pread(fd, length, offset)
+    if len(data) != length:
+        raise ValueError(f"short read at offset {offset}")
+    return data
+
+
+def _read_bitmaps(fd, data):
+    count, _, directory_size, directory_offset = BITMAP_EXTENSION.unpack_from(data)
+    directory = _pread(fd, directory_size, directory_offset)
+    bitmaps = []
+    position = 0
+    for _ in range(count):
+        _, _, flags, _, granularity_bits, name_size, extra_size = BITMAP_ENTRY.unpack_from(directory, position)
+        start = position + BITMAP_ENTRY.size + extra_size
+        names = []
+        if flags & BITMAP_IN_USE:
+            names.append('in-use')
+        if flags & BITMAP_AUTO:
+            names.append('auto')
+        bitmaps.append({'flags': names,
+                        'name': directory[start:start + name_size].decode(),
+                        'granularity': 1 << granularity_bits})
+        # entries are padded to a multiple of 8 bytes
+        position = (start + name_size + 7) & ~7
+    return bitmaps
+
+
+def read_header(filename):
+    '''
+    parses the header and header extensions of a qcow2 image.
+    :return: Header, or None if filename isn't a qcow2 image.
+    :raises ValueError: if the header is truncated or malformed.
+    '''
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        data = os.pread(fd, HEADER.size + HEADER_V3.size + 1, 0)
+        if len(data) < HEADER.size or data[:4] != MAGIC:
+            return None
+        (_, version, backing_file_offset, backing_file_size, cluster_bits, size, crypt_method, l1_size,
+         l1_table_offset, _, _, nb_snapshots, _) = HEADER.unpack_from(data)
+        if version == 2:
+            header = Header(version, cluster_bits, size, crypt_method, l1_size, l1_table_offset, nb_snapshots)
+            header_length = HEADER.size
+        elif version == 3:
+            if len(data) < HEADER.size + HEADER_V3.size:
+                raise ValueError("truncated version 3 header")
+            incompatible, compatible, _, refcount_order, header_length = HEADER_V3.unpack_from(data, HEADER.size)
+            compression_type = data[HEADER.size + HEADER_V3.size] if header_length > 104 else 0
+            header = Header(version, cluster_bits, size, crypt_method, l1_size, l1_table_offset, nb_snapshots,
+                            incompatible, compatible, refcount_order, compression_type)
+        else:
+            raise ValueError(f"unknown qcow2 version {version}")
+        if not 9 <= cluster_bits <= 21:
+            raise ValueError(f"bad cluster_bits {cluster_bits}")
+        # extensions follow the header, up to the end of the first cluster.
+        offset = header_length
+        end = backing_file_offset if backing_file_offset else header.cluster_size
+        while offset + EXTENSION.size <= end:
+            kind, length = EXTENSION.unpack(_pread(fd, EXTENSION.size, offset))
+            if kind == EXT_END:
+                break
+            header.extensions.add(kind)
+            data = _pread(fd, length, offset + EXTENSION.size)
+            if kind == EXT_BACKING_FORMAT:
+                header.backing_format = data.decode()
+            elif kind == EXT_BITMAPS:
+                header.bitmaps = _read_bitmaps(fd, data)
+            offset += EXTENSION.size + ((length + 7) & ~7)
+        if backing_file_offset:
+            header.backing_file = _pread(fd, backing_file_size, backing_file_offset).decode()
+        return header
+    finally:
+        os.close(fd)
+
+
+def full_backing_filename(filename, backing):
+    '''
+    resolves a backing file name the way qemu does: relative to the directory of the image naming it.
+    '''
+    if os.path.isabs(backing) or '/' not in filename:
+        return backing
+    return filename[:filename.rindex('/') + 1] + backing
+
+
+def info(filename):
+    '''
+    the `qemu-img info --output=json` result for a qcow2 image, without running qemu-img.
+    :return: dict as from qemu_utils.img_info(filename, backing_chain=False), or None for images this doesn't
+    describe the way qemu-img would: other formats, encryption, internal snapshots, external data files, unknown
+    features and backing files that aren't plain files. Use qemu-img for those.
+    '''
+    try:
+        header = read_header(filename)
+    except (OSError, ValueError, UnicodeDecodeError, struct.error):
+        return None
+    if header is None or header.crypt_method or header.nb_snapshots:
+        return None
+    if header.incompatible_features & (~KNOWN_INCOMPAT | INCOMPAT_DATA_FILE):
+        return None
+    if header.extensions & {EXT_ENCRYPTION, EXT_DATA_FILE}:
+        return None
+    if header.backing_file is not None and PROTOCOL.match(header.backing_file):
+        return None
+    st = os.stat(filename)
+    ret = {'virtual-size': header.size,
+           'filename': filename,
+           'cluster-size': header.cluster_size,
+           'format': 'qcow2',
+           'actual-size': st.st_blocks * 512,
+           'dirty-flag': bool(header.incompatible_features & INCOMPAT_DIRTY)}
+    if header.backing_file is not None:
+        ret['backing-filename'] = header.backing_file
+        ret['full-backing-filename'] = full_backing_filename(filename, header.backing_file)
+        if header.backing_format is not None:
+            ret['backing-filename-format'] = header.backing_format
+    if header.version == 2:
+        data = {'compat': '0.10',
+                'compression-type': 'zlib',
+                'refcount-bits': 16}
+    else:
+        data = {'compat': '1.1',
+                'compression-type': 'zstd' if header.compression_type == 1 else 'zlib',
+                'lazy-refcounts': bool(header.compatible_features & COMPAT_LAZY_REFCOUNTS),
+                'refcount-bits': 1 << header.refcount_order,
+                'corrupt': bool(header.incompatible_features & INCOMPAT_CORRUPT),
+                'extended-l2': bool(header.incompatible_features & INCOMPAT_EXTL2)}
+        if header.bitmaps is not None:
+            data['bitmaps'] = header.bitmaps
+    ret['format-specific'] = {'type': 'qcow2', 'data': data}
+    return ret
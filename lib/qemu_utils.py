@@ -1,9 +1,21 @@
-from lib.exceptions.qemu_exceptions import BlockCommitException
+from lib.exceptions.qemu_exceptions import BlockCommitException, ImageCreateException, RebaseException, \
+    BackingChainException, ImageInfoException
+from lib import qcow2
 import subprocess
 import json
+import os
+import threading
 
+# single-image `qemu-img info` results keyed by file_identity(). Backing images rarely change, so a chain is
+# usually resolved without running qemu-img for anything but its top.
+_info_cache = {}
+# path: the identity currently cached for it, so superseded entries can be dropped.
+_latest_identity = {}
+_info_lock = threading.Lock()
 
-def block_commit(top, objectdef=None, image_opts=False, q=True, fmt=None, cache=None, base=None, d=False, p=False):
+
+def block_commit(top, objectdef=None, image_opts=False, q=True, fmt=None, cache=None, base=None, d=False, p=False,
+                 r=None):
     qemu_img_commit = ["qemu-img", "commit"]
     if objectdef is not None:
         qemu_img_commit.append(f"--object")
@@ -25,6 +37,9 @@ def block_commit(top, objectdef=None, image_opts=False, q=True, fmt=None, cache=
         qemu_img_commit.append("-d")
     if p is True:
         qemu_img_commit.append("-p")
+    if r is not None:
+        qemu_img_commit.append("-r")
+        qemu_img_commit.append(str(r))
     qemu_img_commit.append(top)
 
     out = subprocess.run(qemu_img_commit, capture_output=True)
@@ -58,5 +73,156 @@ def img_info(filename, objectdef=None, image_opts=False, fmt=None, backing_chain
         qemu_img_info.append("-U")
     qemu_img_info.append(filename)
     out = subprocess.run(qemu_img_info, capture_output=True)
+    if out.returncode != 0:
+        raise ImageInfoException(out.stderr)
     ret = json.loads(out.stdout)
     return ret
+
+
+def image_info(filename, force_share=False):
+    '''
+    the single image `qemu-img info` result for filename. qcow2 headers are parsed by lib.qcow2 without running
+    qemu-img; anything it can't describe exactly goes to qemu-img.
+    :param force_share: pass -U if qemu-img is run.
+    :return: dict
+    '''
+    img = qcow2.info(filename)
+    if img is None:
+        img = img_info(filename, backing_chain=False, U=force_share)
+    return img
+
+
+def create_overlay(filename, backing, backing_fmt='qcow2'):
+    '''
+    convenience function for `qemu-img create -f qcow2 -b backing -F backing_fmt filename`
+    creates an empty qcow2 image on top of backing. A relative backing path is relative to filename's directory.
+    :return: stdout, stderr
+    '''
+    qemu_img_create = ["qemu-img", "create", "-q", "-f", "qcow2", "-b", backing, "-F", backing_fmt, filename]
+    out = subprocess.run(qemu_img_create, capture_output=True)
+    if out.returncode != 0:
+        raise ImageCreateException(out.stderr)
+    return out.stdout, out.stderr
+
+
+def create_image(filename, size):
+    '''
+    convenience function for `qemu-img create -f qcow2 filename size`
+    creates an empty qcow2 image with no backing file.
+    :param size: virtual size in bytes
+    :return: stdout, stderr
+    '''
+    qemu_img_create = ["qemu-img", "create", "-q", "-f", "qcow2", filename, str(size)]
+    out = subprocess.run(qemu_img_create, capture_output=True)
+    if out.returncode != 0:
+        raise ImageCreateException(out.stderr)
+    return out.stdout, out.stderr
+
+
+def rebase(filename, backing, backing_fmt='qcow2', unsafe=False):
+    '''
+    convenience function for `qemu-img rebase`
+    In safe mode, every cluster whose content differs between the old and the new backing chain is written
+    into filename, so an empty overlay rebased onto an older copy of the same disk ends up holding only the
+    changes. Unsafe mode only rewrites the backing file name in the header.
+    :param filename: image to rebase
+    :param backing: new backing file. A relative path is relative to filename's directory.
+    :param backing_fmt: format of the new backing file
+    :param unsafe: only change the header, don't compare content.
+    :return: stdout, stderr
+    '''
+    qemu_img_rebase = ["qemu-img", "rebase", "-q", "-f", "qcow2", "-b", backing, "-F", backing_fmt]
+    if unsafe:
+        qemu_img_rebase.append("-u")
+    qemu_img_rebase.append(filename)
+    out = subprocess.run(qemu_img_rebase, capture_output=True)
+    if out.returncode != 0:
+        raise RebaseException(out.stderr)
+    return out.stdout, out.stderr
+
+
+def file_identity(path):
+    '''
+    :return: (path, inode, mtime in ns, size). Changes whenever the file is replaced or written to.
+    '''
+    st = os.stat(path)
+    return (path, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _cache_info(identity, info):
+    with _info_lock:
+        old = _latest_identity.get(identity[0])
+        if old is not None and old != identity:
+            _info_cache.pop(old, None)
+        _latest_identity[identity[0]] = identity
+        _info_cache[identity] = info
+
+
+def backing_chain(filename, force_share=False):
+    '''
+    resolves the backing chain of filename, following full-backing-filename links from the top in one pass.
+    Image metadata comes from image_info(), so qcow2 chains are read without running qemu-img, and is cached by
+    file_identity(), so only images which changed since they were last inspected are read again.
+    :param filename: top image
+    :param force_share: pass -U to qemu-img, needed to inspect images a running domain is writing to.
+    :return: BackingChain
+    '''
+    images = []
+    seen = set()
+    cur = filename
+    while cur is not None:
+        if cur in seen:
+            raise BackingChainException(filename, f"{cur} appears twice.")
+        seen.add(cur)
+        try:
+            identity = file_identity(cur)
+        except OSError as e:
+            raise BackingChainException(filename, f"missing backing file: {e}")
+        img = _info_cache.get(identity)
+        if img is None:
+            img = image_info(cur, force_share)
+            _cache_info(identity, img)
+        images.append(img)
+        cur = img.get('full-backing-filename', img.get('backing-filename'))
+    return BackingChain(images)
+
+
+class BackingChain(object):
+    '''
+    The images making up a disk, as reported by `qemu-img info`, indexed by filename.
+    images is ordered top first, the way qemu-img reports it. Sequence numbers count from the base, which is 0.
+    '''
+    def __init__(self, images):
+        self.images = images
+        self.by_filename = {img['filename']: img for img in images}
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, filename):
+        return filename in self.by_filename
+
+    def top(self):
+        return self.images[0]['filename']
+
+    def base(self):
+        return self.images[-1]['filename']
+
+    def base_first(self):
+        '''
+        :return: list of filenames, base first.
+        '''
+        return [img['filename'] for img in reversed(self.images)]
+
+    def select(self, depth):
+        '''
+        applies the depth rules described in the readme. 0 is the whole chain, positive numbers count images
+        from the top, negative numbers exclude that many images from the base.
+        :param depth: int
+        :return: list of (seq, filename) tuples, base first.
+        '''
+        if depth <= 0:
+            excl = abs(depth)
+        else:
+            excl = len(self.images) - depth
+        return [(seq, filename) for seq, filename in enumerate(self.base_first()) if seq >= excl]
@@ -1,13 +1,25 @@
 import os
 import time
 from lib.config import Config
-import multiprocessing
 import queue
-from lib.libvirt_utils import LibvirtUtils, VirtDupXML, SnapshotManager
+from lib.libvirt_utils import LibvirtUtils
+from lib.limiter import ResourceLimiter, job_resources
+from lib.worker import WorkerPool, MP_CONTEXT
+from lib.shared_backing import shared_backing_files, remove_stale_shared
+from lib.metrics import Registry, Exporter
 from croniter import croniter
 import signal
 import sys
 from lib.exceptions.libvirt_exceptions import LibvirtException
+import heapq
+import logging
+
+# seconds between checks of virt-dup.yml's mtime
+CONFIG_CHECK_INTERVAL = 2
+# longest the dispatcher blocks on job_q before checking on workers and the config file
+WORKER_CHECK_INTERVAL = 5
+# a full backup takes precedence over an incremental one due in the same slot.
+KIND_PRIORITY = {'full': 0, 'incremental': 1}
 
 
 class Scheduler(object):
@@ -15,15 +27,17 @@ class Scheduler(object):
         self.config = config
         self.config_mtime = os.path.getmtime(self.config.path)
         self.lu = LibvirtUtils(self.config)
-        self.proc_list = []
-        self.shutdown = multiprocessing.Event()
-        self.job_q = multiprocessing.Queue()
+        # the dispatcher is spawned, not forked, so it doesn't inherit self.lu's connection and event loop.
+        self.shutdown = MP_CONTEXT.Event()
+        self.job_q = MP_CONTEXT.Queue()
 
         # ignore signals before creating child processes
         signal.signal(signal.SIGTERM, signal.SIG_IGN)
         signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-        self.job_queue_manager_p = multiprocessing.Process(target=self.job_queue_manager)
+        self.job_queue_manager_p = MP_CONTEXT.Process(target=job_queue_manager,
+                                                      args=(self.config.path, self.job_q, self.shutdown),
+                                                      name='virt-dup-dispatcher')
         self.job_queue_manager_p.start()
 
         # then set callbacks before main loop.
@@ -34,94 +48,203 @@ class Scheduler(object):
         # job_monitor is our producer; it runs in the main thread.
         self.job_monitor()
 
-    def job_queue_manager(self):
-        while True:
-            try:
-                c = self.job_q.get_nowait()
-                domain = self.lu.domain_search(c['domain_uuid'])
-
-            except queue.Empty:
-                pass
-            except BrokenPipeError:
-                pass
-            except LibvirtException:
-                pass
-            else:
-                config = c['config']
-                xml = VirtDupXML(config, domain)
-                jobuuid = c['jobuuid']
-                # todo: snapshot manager needs to accept an event object to detect shutdown signals.
-                sm = SnapshotManager(config, xml, jobuuid)
-                process = multiprocessing.Process(target=sm.stage_image, name=jobuuid)
-                process.start()
-                self.proc_list.append(process)
-            time.sleep(2)
-            if self.shutdown.is_set():
-                break
-
     def shutdown_callback(self, a, b):
         self.shutdown.set()
+        # wake the dispatcher up if it's blocked on the queue.
+        self.job_q.put({'type': 'shutdown'})
         self.job_queue_manager_p.join()
-        for proc in self.proc_list:
-            proc.join()
 
     def check_for_config_change(self):
+        '''
+        :return: True if virt-dup.yml changed and was reloaded.
+        '''
         new_mtime = os.path.getmtime(self.config.path)
         if new_mtime > self.config_mtime:
             self.config_mtime = new_mtime
             self.reload_config()
-        else:
-            time.sleep(2)
+            return True
+        return False
 
     def reload_config(self):
         self.config = Config(self.config.path)
-        self.lu.shutdown_callback()
+        # open the new one first so the connection is reused if the uri and credentials didn't change.
+        old = self.lu
         self.lu = LibvirtUtils(self.config)
+        old.shutdown_callback()
 
     def job_monitor(self):
         """
         looks through configured jobs. If it's time to run a job, put it in the queue.
         handles parsing of cron strings.
-        job_monitor keeps state in the running_jobs list, which is a dict formatted as
-        {jobuuid: int}, where the int represents the number of loops left to wait before
-        considering a job within our 'past' time window to require queueing
-        when the int value reaches 0, the jobuuid is removed from the list, and any jobs
-        whose timestamp falls within the 'past' window will be started.
-        Warning: jobs should not be scheduled more frequently than past value in seconds.
+        job_monitor keeps a min-heap of (fire time, kind priority, jobuuid, kind) entries, one per schedule
+        of each job, and sleeps until the earliest one is due. When an entry fires, the job's next slot after
+        it is pushed, so every cron slot is queued exactly once no matter when the loop wakes up.
+        Job definitions come from the LibvirtUtils domain cache and are re-read whenever a libvirt event changed
+        it or virt-dup.yml changes. Every job-refresh-interval seconds the cache is rebuilt from scratch in case
+        an event was missed. A job's entries are only recomputed when its schedules change.
         :return:
         """
-        timeout = 2
-        past = 20
-        # maintain a little state for jobs that are running so we don't start them more than once
-        running_jobs = {}
-        while True:
-            self.check_for_config_change()
-            cur_time = int(time.time())
-            for domain in self.lu.conn.listAllDomains(0):
-                domuuid = domain.UUIDString()
-                xml = VirtDupXML(self.config, domain)
-                for jobuuid, info in xml.loaded_jobs.items():
-                    if jobuuid in running_jobs.keys():
-                        running_jobs[jobuuid] -= 1
-                        if running_jobs[jobuuid] <= 0:
-                            running_jobs.pop(jobuuid)
-                    else:
-                        cron = croniter(info['schedule'], cur_time)
-                        prev = int(cron.get_prev())
-                        # look a little in the past: why not?
-                        threshold = cur_time - past
-                        if prev > threshold:
-                            # wait at least one loop longer than the past value (2 because int floors the float)
-                            running_jobs[jobuuid] = int(past / timeout) + 2
-                            # can't pass C objects (e.g. from libvirt) through queue or objects containing them.
-                            # doesn't even raise an error
-                            c = {'config': self.config,
-                                 'domain_uuid': domuuid,
-                                 'jobuuid': jobuuid}
-                            self.job_q.put_nowait(c)
-            time.sleep(timeout)
-            if self.shutdown.is_set():
-                break
-
-
-
+        self.jobs = {}
+        self.heap = []
+        # LibvirtUtils has just read every domain.
+        next_refresh = time.time() + self.config.job_refresh_interval
+        generation = None
+        while not self.shutdown.is_set():
+            now = time.time()
+            reloaded = self.check_for_config_change()
+            if reloaded or now >= next_refresh:
+                self.lu.get_updated_domain_info()
+                next_refresh = now + self.config.job_refresh_interval
+            if reloaded:
+                # the new LibvirtUtils has a new cache, whose generation counts from the start again.
+                generation = None
+            if self.lu.cache.generation != generation:
+                generation = self.lu.cache.generation
+                self.refresh_jobs(now)
+            self.fire_due_jobs(time.time())
+            self.job_q.put_nowait({'type': 'monitor',
+                                   'tick_seconds': time.time() - now,
+                                   'scheduled_jobs': len(self.jobs)})
+            # wake up for the next job, the next refresh, or the next config/cache check, whichever is first.
+            wake = min(next_refresh, time.time() + CONFIG_CHECK_INTERVAL)
+            if self.heap:
+                wake = min(wake, self.heap[0][0])
+            self.shutdown.wait(max(wake - time.time(), 0))
+
+    def refresh_jobs(self, now):
+        '''
+        reads the jobs of every domain and (re)schedules those which are new or whose schedules changed.
+        Jobs which no longer exist are forgotten; their heap entries are dropped when they come up.
+        '''
+        seen = set()
+        for entry in self.lu.cache.all_entries():
+            domuuid = entry['domain'].UUIDString()
+            for jobuuid, info in entry['jobs'].items():
+                seen.add(jobuuid)
+                schedules = {'full': info['schedule']}
+                if 'incremental_schedule' in info.keys():
+                    schedules['incremental'] = info['incremental_schedule']
+                job = self.jobs.get(jobuuid)
+                if job is None or job['schedules'] != schedules or job['domain_uuid'] != domuuid:
+                    self.schedule_job(jobuuid, domuuid, schedules, now)
+        for jobuuid in list(self.jobs.keys()):
+            if jobuuid not in seen:
+                self.jobs.pop(jobuuid)
+
+    def schedule_job(self, jobuuid, domuuid, schedules, now):
+        job = {'domain_uuid': domuuid, 'schedules': schedules, 'next': {}, 'last_fired': None}
+        self.jobs[jobuuid] = job
+        for kind in schedules.keys():
+            self.push_next(jobuuid, kind, now)
+
+    def push_next(self, jobuuid, kind, after):
+        job = self.jobs[jobuuid]
+        fire_time = croniter(job['schedules'][kind], after).get_next(float)
+        job['next'][kind] = fire_time
+        heapq.heappush(self.heap, (fire_time, KIND_PRIORITY[kind], jobuuid, kind))
+
+    def fire_due_jobs(self, now):
+        while self.heap and self.heap[0][0] <= now:
+            fire_time, priority, jobuuid, kind = heapq.heappop(self.heap)
+            job = self.jobs.get(jobuuid)
+            if job is None or job['next'].get(kind) != fire_time:
+                # stale entry for a removed or rescheduled job.
+                continue
+            # slots missed while we weren't looking (e.g. host suspended) are skipped, not queued in a burst.
+            self.push_next(jobuuid, kind, max(fire_time, now))
+            if job['last_fired'] == fire_time:
+                # a full backup was already queued for this slot; full pops first because of its priority.
+                continue
+            job['last_fired'] = fire_time
+            # can't pass C objects (e.g. from libvirt) through queue or objects containing them.
+            # doesn't even raise an error. Workers read their own config.
+            c = {'type': 'job',
+                 'domain_uuid': job['domain_uuid'],
+                 'jobuuid': jobuuid,
+                 'kind': kind,
+                 'fire_time': fire_time}
+            self.job_q.put_nowait(c)
+
+
+def job_queue_manager(config_path, job_q, shutdown):
+    '''
+    consumer of job_q, running in its own spawned process. Jobs are run by a WorkerPool of long-lived processes.
+    job_q carries newly scheduled jobs from job_monitor as well as 'started'/'done' messages from workers,
+    so blocking on it wakes the dispatcher as soon as there is a job to start or a worker to start it on.
+    Queued jobs wait in a ResourceLimiter until the global, per-device and per-backend limits allow them
+    to start.
+    '''
+    config = Config(config_path)
+    config_mtime = os.path.getmtime(config_path)
+    # workers are spawned too, but start them before this process has a connection or event loop of its own all
+    # the same.
+    pool = WorkerPool(config, config.workers, job_q)
+    lu = LibvirtUtils(config)
+    limiter = ResourceLimiter(config.max_jobs)
+    registry = Registry()
+    exporter = Exporter(config, registry)
+    # fleet-wide shared backing files, rebuilt when the domain cache changes.
+    shared = {}
+    shared_generation = None
+    while not shutdown.is_set():
+        try:
+            c = job_q.get(timeout=WORKER_CHECK_INTERVAL)
+        except (queue.Empty, BrokenPipeError):
+            c = None
+        if c is None or c['type'] == 'shutdown':
+            pass
+        elif c['type'] == 'monitor':
+            registry.gauge('monitor_tick_seconds', 'Duration of the last job_monitor pass.', c['tick_seconds'])
+            registry.gauge('scheduled_jobs', 'Jobs with a schedule.', c['scheduled_jobs'])
+        elif c['type'] == 'job':
+            try:
+                entry = lu.cache.lookup(c['domain_uuid'])
+                resources = job_resources(config, entry, c['jobuuid'])
+            except LibvirtException:
+                pass
+            except (KeyError, TypeError):
+                logging.warning(f"Job {c['jobuuid']} or its domain was removed after it was queued.")
+            else:
+                limiter.add(c['jobuuid'], c, resources)
+        else:
+            pool.handle(c)
+            if c['type'] == 'started' and c['lag'] is not None:
+                registry.gauge('dispatch_lag_seconds', 'Time from the cron slot to the start of the last job.',
+                               c['lag'])
+                registry.counter('dispatch_lag_seconds_total', 'Time from cron slot to start, summed over jobs.',
+                                 c['lag'])
+                registry.counter('dispatched_jobs_total', 'Jobs started by workers.')
+            if c['type'] == 'done':
+                limiter.release(c['jobuuid'])
+                registry.record_job(c)
+                logging.info(f"Job {c['jobuuid']} ({c['kind']}) finished in {c['seconds']:.1f}s, ok: {c['ok']}")
+        for jobuuid in pool.reap():
+            limiter.release(jobuuid)
+        new_mtime = os.path.getmtime(config.path)
+        if new_mtime > config_mtime:
+            config_mtime = new_mtime
+            config = Config(config_path)
+            old = lu
+            lu = LibvirtUtils(config)
+            old.shutdown_callback()
+            # the new cache's generation counts from the start again.
+            shared_generation = None
+            limiter.max_jobs = config.max_jobs
+            pool.resize(config.workers)
+            pool.set_host_limits(config)
+        for jobuuid, c in limiter.ready(slots=pool.idle()):
+            if lu.cache.generation != shared_generation:
+                shared_generation = lu.cache.generation
+                shared = shared_backing_files(lu.cache.all_entries())
+                remove_stale_shared(config, shared)
+            c['shared'] = shared
+            pool.submit(c)
+        registry.gauge('queued_jobs', 'Jobs waiting for a worker or a resource limit.', len(limiter.pending))
+        registry.gauge('running_jobs', 'Jobs being run by workers.', len(limiter.running))
+        registry.gauge('workers', 'Worker processes.', len(pool.workers))
+        registry.gauge('idle_workers', 'Workers without a job.', pool.idle())
+        exporter.write()
+    # workers finish the job they're running before exiting.
+    pool.shutdown()
+    exporter.close()
+    lu.shutdown_callback()
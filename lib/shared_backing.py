@@ -0,0 +1,197 @@
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import logging
+from lib import qemu_utils
+from lib.copy_utils import update_checksum
+
+
+def shared_backing_files(entries):
+    '''
+    builds the fleet-wide index of backing files and returns those used by more than one domain.
+    Backing chains come from the <backingStore> elements libvirt puts in domain xml; disks without them (e.g. of
+    domains which haven't been started since libvirtd came up) are resolved with qemu-img, which is cached.
+    :param entries: DomainCache entries
+    :return: dict. {'/images/base.qcow2': [inode, mtime_ns, size]}
+    '''
+    users = {}
+    for entry in entries:
+        domuuid = entry['domain'].UUIDString()
+        for disk in entry['disks']:
+            backing = disk['backing']
+            if backing is None:
+                try:
+                    backing = qemu_utils.backing_chain(disk['path'], force_share=True).base_first()[:-1]
+                except BaseException as e:
+                    logging.warning(f"Cannot read backing chain of {disk['path']}: {e}")
+                    continue
+            for path in backing:
+                users.setdefault(path, set()).add(domuuid)
+    ret = {}
+    for path, domains in users.items():
+        if len(domains) > 1:
+            try:
+                ret[path] = list(qemu_utils.file_identity(path)[1:])
+            except OSError:
+                pass
+    return ret
+
+
+def shared_root(config):
+    return os.path.join(config.staging_path, 'shared')
+
+
+def shared_path(config, source, identity, below=None):
+    '''
+    :param below: the shared copy the copy is backed by, see stage_shared()
+    :return: where the single staged copy of source, as it is at identity, lives.
+    '''
+    key = hashlib.sha1(json.dumps([source] + list(identity) + [below]).encode()).hexdigest()
+    return os.path.join(shared_root(config), key, os.path.basename(source))
+
+
+def stage_shared(config, engine, source, shared, below=None):
+    '''
+    stages source into the shared area unless another job already has. A lock per copy makes concurrent jobs
+    wait for the one doing the copy instead of copying it again. The checksum taken while copying is kept next to
+    the copy, see shared_checksum(), and what it is a copy of in source.json, see remove_stale_shared().
+    :param config: Config
+    :param engine: CopyEngine
+    :param source: backing file to stage
+    :param shared: dict from shared_backing_files()
+    :param below: shared copy of source's backing file to point the copy's backing file name at. None keeps the
+    original backing file, for the base of a staged chain; a relative name is made absolute, since it would
+    resolve in the shared area otherwise. A shared copy can't be backed by a job's own copy.
+    :return: path of the shared copy, or None if source changed since the index was built or below is gone. The
+    caller stages it privately then.
+    '''
+    identity = shared[source]
+    try:
+        if list(qemu_utils.file_identity(source)[1:]) != identity:
+            return None
+    except OSError:
+        return None
+    if below is not None and not os.path.exists(below):
+        return None
+    pathname = shared_path(config, source, identity, below)
+    os.makedirs(shared_root(config), exist_ok=True)
+    # held shared while a copy is made or used, so remove_stale_shared() doesn't remove it.
+    with open(os.path.join(shared_root(config), '.lock'), 'w') as area_lock:
+        fcntl.flock(area_lock, fcntl.LOCK_SH)
+        os.makedirs(os.path.dirname(pathname), exist_ok=True)
+        with open(os.path.join(os.path.dirname(pathname), '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(pathname):
+                with open(os.path.join(os.path.dirname(pathname), 'source.json'), 'w') as file:
+                    json.dump({'source': source, 'identity': identity, 'below': below}, file)
+                checksum = engine.copy_files({source: pathname + '.part'})[source]['checksum']
+                if below is not None:
+                    backing = os.path.relpath(below, os.path.dirname(pathname))
+                else:
+                    info = qemu_utils.image_info(source, force_share=True)
+                    backing = info.get('backing-filename')
+                    if backing is not None and not os.path.isabs(backing):
+                        backing = os.path.abspath(info['full-backing-filename'])
+                    else:
+                        backing = None
+                if backing is not None:
+                    qemu_utils.rebase(pathname + '.part', backing, unsafe=True)
+                    if checksum is not None:
+                        # the backing file name lives in the first cluster.
+                        checksum = update_checksum(pathname + '.part', checksum, [0])
+                with open(pathname + '.checksum.json', 'w') as file:
+                    json.dump(checksum, file)
+                os.replace(pathname + '.part', pathname)
+                logging.info(f"Staged shared backing file {source} to {pathname}")
+    return pathname
+
+
+def referenced_shared(config):
+    '''
+    :return: set of shared copy directories named by some job's chain record or staging cache.
+    '''
+    root = os.path.normpath(shared_root(config))
+    ret = set()
+    for job in os.listdir(config.staging_path):
+        directory = os.path.normpath(os.path.join(config.staging_path, job))
+        if directory == root or not os.path.isdir(directory):
+            continue
+        names = []
+        try:
+            with open(os.path.join(directory, 'chain.json')) as file:
+                for chain in json.load(file).values():
+                    names += chain
+        except (OSError, ValueError):
+            pass
+        try:
+            with open(os.path.join(directory, 'staging-cache.json')) as file:
+                names += [entry['name'] for entry in json.load(file).values()]
+        except (OSError, ValueError, KeyError):
+            pass
+        for name in names:
+            pathname = os.path.normpath(os.path.join(directory, name))
+            if os.path.dirname(os.path.dirname(pathname)) == root:
+                ret.add(os.path.dirname(pathname))
+    return ret
+
+
+def remove_stale_shared(config, shared):
+    '''
+    removes shared copies which no entry of the current index refers to, e.g. of a base image which has since
+    changed. Copies still in some job's chain record or staging cache are kept, and so are the copies they are
+    backed by. Does nothing while a job is staging a shared copy.
+    :param shared: dict from shared_backing_files()
+    :return: list of the directories removed.
+    '''
+    root = os.path.normpath(shared_root(config))
+    if not os.path.isdir(root):
+        return []
+    removed = []
+    with open(os.path.join(root, '.lock'), 'w') as area_lock:
+        try:
+            fcntl.flock(area_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return []
+        sources = {}
+        for key in os.listdir(root):
+            directory = os.path.join(root, key)
+            if not os.path.isdir(directory):
+                continue
+            try:
+                with open(os.path.join(directory, 'source.json')) as file:
+                    sources[directory] = json.load(file)
+            except (OSError, ValueError):
+                # left by an interrupted copy, or from before copies recorded their source.
+                sources[directory] = None
+        keep = referenced_shared(config)
+        for directory, info in sources.items():
+            if info is not None and shared.get(info['source']) == info['identity']:
+                keep.add(directory)
+        # a kept copy's backing file has to stay too.
+        pending = list(keep)
+        while pending:
+            info = sources.get(pending.pop())
+            if info is not None and info['below'] is not None:
+                below = os.path.normpath(os.path.dirname(info['below']))
+                if below not in keep:
+                    keep.add(below)
+                    pending.append(below)
+        for directory in sources.keys():
+            if directory not in keep:
+                shutil.rmtree(directory, ignore_errors=True)
+                removed.append(directory)
+                logging.info(f"Removed stale shared backing file copy {directory}")
+    return removed
+
+
+def shared_checksum(pathname):
+    '''
+    :return: checksum of a shared copy taken when it was staged, or None if there isn't one.
+    '''
+    try:
+        with open(pathname + '.checksum.json') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
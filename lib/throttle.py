@@ -0,0 +1,279 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+
+# throttled copies are done in pieces of at most this many bytes, so the rate is smooth. IOPS limits count these
+# pieces, not the requests the kernel ends up sending to the device.
+PIECE_SIZE = 4 * 1024 * 1024
+
+
+class TokenBucket(object):
+    '''
+    Classic token bucket: rate tokens per second accrue up to burst, and consume() sleeps until enough are there.
+    A rate of 0 means unlimited. Thread safe.
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take(self, amount):
+        '''
+        :return: seconds to sleep before amount may be used. The tokens are taken either way, so waiters queue.
+        '''
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def consume(self, amount):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            delay = self._take(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SharedTokenBucket(TokenBucket):
+    '''
+    A TokenBucket whose state lives in shared memory, so every worker process draws on the same per-host limit.
+    Create it before the workers are started and pass it to them. The rate can be changed on config reload.
+    :param context: multiprocessing context the workers are started with
+    '''
+    def __init__(self, rate, burst=None, context=multiprocessing):
+        self._rate = multiprocessing.Value('d', rate, lock=False)
+        self._burst = multiprocessing.Value('d', rate if burst is None else burst, lock=False)
+        self._tokens = multiprocessing.Value('d', self._burst.value, lock=False)
+        self._stamp = multiprocessing.Value('d', time.monotonic(), lock=False)
+        self.lock = context.Lock()
+
+    rate = property(lambda self: self._rate.value, lambda self, value: setattr(self._rate, 'value', value))
+    burst = property(lambda self: self._burst.value, lambda self, value: setattr(self._burst, 'value', value))
+    tokens = property(lambda self: self._tokens.value, lambda self, value: setattr(self._tokens, 'value', value))
+    stamp = property(lambda self: self._stamp.value, lambda self, value: setattr(self._stamp, 'value', value))
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.burst = rate
+
+
+class CommitBudget(object):
+    '''
+    A host-wide bandwidth for block commits, shared by every worker process and split evenly between the disks
+    being committed at once. Block jobs are rate limited by qemu rather than by taking tokens, so a commit enters
+    the budget when it starts, leaves it when it's done, and sets its speed to share() meanwhile.
+    Create it before the workers are started and pass it to them. A rate of 0 means unlimited.
+    :param context: multiprocessing context the workers are started with
+    '''
+    def __init__(self, rate, context=multiprocessing):
+        self._rate = multiprocessing.Value('q', int(rate), lock=False)
+        self._active = multiprocessing.Value('q', 0, lock=False)
+        self.lock = context.Lock()
+
+    @property
+    def rate(self):
+        return self._rate.value
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._rate.value = int(rate)
+
+    def enter(self):
+        with self.lock:
+            self._active.value += 1
+
+    def leave(self):
+        with self.lock:
+            self._active.value = max(self._active.value - 1, 0)
+
+    def share(self):
+        '''
+        :return: bandwidth for each commit now, or 0 if unlimited.
+        '''
+        with self.lock:
+            if self._rate.value <= 0:
+                return 0
+            return max(self._rate.value // max(self._active.value, 1), 1)
+
+
+def device_name(path):
+    '''
+    :return: the /proc/diskstats name of the block device holding path, or None if there isn't one (e.g. nfs).
+    '''
+    st = os.stat(path)
+    try:
+        with open(f"/sys/dev/block/{os.major(st.st_dev)}:{os.minor(st.st_dev)}/uevent") as file:
+            for line in file:
+                if line.startswith('DEVNAME='):
+                    return line.strip().split('=', 1)[1]
+    except OSError:
+        pass
+    return None
+
+
+def read_diskstats(device):
+    '''
+    :return: (completed ios, milliseconds spent on them, ios in flight) for device, or None if it isn't listed.
+    '''
+    with open('/proc/diskstats') as file:
+        for line in file:
+            fields = line.split()
+            if fields[2] == device:
+                # reads completed, ms reading, writes completed, ms writing, ios in progress
+                return int(fields[3]) + int(fields[7]), int(fields[6]) + int(fields[10]), int(fields[11])
+    return None
+
+
+class DeviceMonitor(object):
+    '''
+    Watches a block device's average await and queue depth in /proc/diskstats, at most once per interval.
+    '''
+    def __init__(self, device, interval=1.0):
+        self.device = device
+        self.interval = interval
+        self.last = read_diskstats(device)
+        self.stamp = time.monotonic()
+        self.await_ms = 0.0
+        self.queue_depth = 0
+        self.lock = threading.Lock()
+
+    def sample(self):
+        '''
+        :return: (await in ms, ios in flight), as of the last sample at most interval seconds ago.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            if now - self.stamp >= self.interval:
+                current = read_diskstats(self.device)
+                if current is not None and self.last is not None:
+                    ios = current[0] - self.last[0]
+                    self.await_ms = (current[1] - self.last[1]) / ios if ios > 0 else 0.0
+                    self.queue_depth = current[2]
+                self.last = current
+                self.stamp = now
+            return self.await_ms, self.queue_depth
+
+
+class AdaptiveBackoff(object):
+    '''
+    Slows a copy down while the devices it touches are busy serving guests: every piece is followed by a pause
+    which doubles (up to max_delay) while any device's await or queue depth is over its threshold, and halves
+    back towards nothing once they're all below it.
+    '''
+    def __init__(self, paths, max_await_ms=20, max_queue_depth=8, interval=1.0, max_delay=1.0):
+        self.monitors = []
+        for device in {device_name(path) for path in paths}:
+            if device is not None and read_diskstats(device) is not None:
+                self.monitors.append(DeviceMonitor(device, interval))
+        self.max_await_ms = max_await_ms
+        self.max_queue_depth = max_queue_depth
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self.lock = threading.Lock()
+
+    def busy(self):
+        for monitor in self.monitors:
+            await_ms, queue_depth = monitor.sample()
+            if await_ms > self.max_await_ms or queue_depth > self.max_queue_depth:
+                return True
+        return False
+
+    def factor(self):
+        '''
+        :return: fraction of the configured rate to use now, for rates applied elsewhere (e.g. block jobs).
+        '''
+        return 1.0 - self.delay / self.max_delay
+
+    def update(self):
+        '''
+        :return: the pause to take now, in seconds.
+        '''
+        busy = self.busy()
+        with self.lock:
+            if busy:
+                self.delay = min(self.max_delay, max(0.005, self.delay * 2))
+            elif self.delay < 0.005:
+                self.delay = 0.0
+            else:
+                self.delay /= 2
+            return self.delay
+
+    def pause(self):
+        delay = self.update()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Throttle(object):
+    '''
+    Combines the bandwidth and IOPS limits a copy is subject to (the job's and the host's) with optional adaptive
+    backoff. acquire() is called before each piece of at most piece_size bytes is copied.
+    '''
+    def __init__(self, bandwidth=(), iops=(), adaptive=None, piece_size=PIECE_SIZE):
+        self.bandwidth = [bucket for bucket in bandwidth if bucket is not None]
+        self.iops = [bucket for bucket in iops if bucket is not None]
+        self.adaptive = adaptive
+        self.piece_size = piece_size
+
+    def acquire(self, nbytes):
+        for bucket in self.bandwidth:
+            bucket.consume(nbytes)
+        for bucket in self.iops:
+            bucket.consume(1)
+        if self.adaptive is not None:
+            self.adaptive.pause()
+
+
+def job_limit(config_value, job, attribute):
+    '''
+    a job's limit: virt-dup.yml's, unless the job xml sets a stricter one. 0 means unlimited.
+    '''
+    limit = int(config_value)
+    if attribute in job.keys():
+        value = int(job[attribute])
+        if value > 0:
+            limit = value if limit == 0 else min(limit, value)
+    return limit
+
+
+def adaptive_backoff(config, paths):
+    '''
+    :return: AdaptiveBackoff for the devices holding paths, or None if adaptive-throttle is off.
+    '''
+    if not config.adaptive_throttle:
+        return None
+    try:
+        return AdaptiveBackoff(paths, config.adaptive_max_await, config.adaptive_max_queue_depth)
+    except OSError as e:
+        logging.warning(f"Adaptive throttling disabled: {e}")
+        return None
+
+
+def job_throttle(config, job, paths, host=None):
+    '''
+    builds the Throttle for a job's staging copies.
+    :param job: loaded job dict
+    :param paths: files the job reads, for adaptive mode to find their devices
+    :param host: host limits shared by all workers, see worker.WorkerPool, or None
+    :return: Throttle, or None if nothing limits the job.
+    '''
+    bandwidth = job_limit(config.copy_bandwidth, job, 'copy_bandwidth')
+    iops = job_limit(config.copy_iops, job, 'copy_iops')
+    host_bandwidth, host_iops = (None, None) if host is None else host[:2]
+    if host_bandwidth is not None and host_bandwidth.rate <= 0:
+        host_bandwidth = None
+    if host_iops is not None and host_iops.rate <= 0:
+        host_iops = None
+    adaptive = adaptive_backoff(config, paths)
+    if not bandwidth and not iops and host_bandwidth is None and host_iops is None and adaptive is None:
+        return None
+    return Throttle([TokenBucket(bandwidth) if bandwidth else None, host_bandwidth],
+                    [TokenBucket(iops) if iops else None, host_iops],
+                    adaptive)
@@ -0,0 +1,157 @@
+import os
+import time
+import logging
+import traceback
+import multiprocessing
+from lib.config import Config
+from lib.libvirt_utils import LibvirtUtils, VirtDupXML, SnapshotManager
+from lib.throttle import SharedTokenBucket, CommitBudget
+
+# processes are spawned rather than forked: a forked child would inherit its parent's libvirt connections, with
+# their sockets and keepalive timers, and the state of its event loop.
+MP_CONTEXT = multiprocessing.get_context('spawn')
+
+
+def worker_main(config_path, task_q, result_q, host_limits=None):
+    '''
+    body of a pool worker. Keeps one libvirt connection for its whole life, runs jobs from task_q one at a time
+    and reports 'started' and 'done' messages to result_q. Exits when it gets None.
+    virt-dup.yml is re-read before a job if it changed since the last one.
+    :param host_limits: (bandwidth, iops, commit) limits shared by all workers, see WorkerPool.
+    '''
+    config = Config(config_path)
+    config_mtime = os.path.getmtime(config_path)
+    lu = LibvirtUtils(config)
+    pid = os.getpid()
+    while True:
+        c = task_q.get()
+        if c is None:
+            break
+        mtime = os.path.getmtime(config_path)
+        if mtime > config_mtime:
+            config_mtime = mtime
+            config = Config(config_path)
+            old = lu
+            lu = LibvirtUtils(config)
+            old.shutdown_callback()
+        start = time.time()
+        # dispatch lag: how long after its cron slot the job actually started.
+        lag = start - c['fire_time'] if 'fire_time' in c.keys() else None
+        result_q.put({'type': 'started', 'jobuuid': c['jobuuid'], 'pid': pid, 'lag': lag})
+        result = {'type': 'done', 'jobuuid': c['jobuuid'], 'pid': pid, 'kind': c['kind'], 'ok': True, 'error': None,
+                  'metrics': None}
+        sm = None
+        try:
+            domain = lu.domain_search(c['domain_uuid'])
+            if domain is None:
+                raise KeyError(f"Domain {c['domain_uuid']} not found.")
+            # todo: snapshot manager needs to accept an event object to detect shutdown signals.
+            sm = SnapshotManager(config, VirtDupXML(config, domain), c['jobuuid'], c.get('shared'), host_limits)
+            sm.run(c['kind'])
+        except BaseException as e:
+            # our libvirt exceptions derive from BaseException, so catch everything the job can raise.
+            result['ok'] = False
+            result['error'] = getattr(e, 'description', repr(e))
+            logging.warning(f"Job {c['jobuuid']} failed: {result['error']}\n{traceback.format_exc()}")
+        result['seconds'] = time.time() - start
+        if sm is not None:
+            result['metrics'] = sm.metrics.as_dict()
+        result_q.put(result)
+    lu.shutdown_callback()
+
+
+class WorkerPool(object):
+    '''
+    A fixed number of long-lived worker processes, each with a task queue of its own. Workers which die are
+    replaced. The dispatcher only hands a task to an idle worker, so a task never waits in a queue, and it always
+    knows which worker has which task, even one which dies before reporting it started.
+    '''
+    def __init__(self, config, size, result_q):
+        self.config = config
+        self.size = max(1, int(size))
+        self.result_q = result_q
+        # pid: Process
+        self.workers = {}
+        # pid: the worker's task queue
+        self.queues = {}
+        # pid: task handed to the worker and not reported done
+        self.tasks = {}
+        # pids of workers told to exit, which get no more tasks
+        self.retiring = set()
+        # host-wide copy bandwidth and iops buckets and commit budget, drawn on by every worker.
+        self.host_limits = (SharedTokenBucket(config.host_copy_bandwidth, context=MP_CONTEXT),
+                            SharedTokenBucket(config.host_copy_iops, context=MP_CONTEXT),
+                            CommitBudget(config.host_commit_bandwidth, context=MP_CONTEXT))
+        self.fill()
+
+    def fill(self):
+        while len(self.workers) - len(self.retiring) < self.size:
+            task_q = MP_CONTEXT.Queue()
+            process = MP_CONTEXT.Process(
+                target=worker_main,
+                args=(self.config.path, task_q, self.result_q, self.host_limits),
+                name='virt-dup-worker'
+            )
+            process.start()
+            self.workers[process.pid] = process
+            self.queues[process.pid] = task_q
+
+    def idle_workers(self):
+        return [pid for pid in self.workers.keys() if pid not in self.tasks and pid not in self.retiring]
+
+    def idle(self):
+        return len(self.idle_workers())
+
+    def submit(self, c):
+        pid = self.idle_workers()[0]
+        self.tasks[pid] = c
+        self.queues[pid].put(c)
+
+    def handle(self, message):
+        '''
+        keeps track of the 'done' messages workers send to the result queue.
+        '''
+        if message['type'] == 'done':
+            self.tasks.pop(message['pid'], None)
+
+    def reap(self):
+        '''
+        joins dead workers and replaces them.
+        :return: list of jobuuids whose worker died while running them, or before it got to start them.
+        '''
+        lost = []
+        for pid, process in list(self.workers.items()):
+            if not process.is_alive():
+                process.join()
+                self.workers.pop(pid)
+                self.queues.pop(pid).close()
+                self.retiring.discard(pid)
+                if pid in self.tasks:
+                    lost.append(self.tasks.pop(pid)['jobuuid'])
+                    logging.warning(f"Worker {pid} died running job {lost[-1]}.")
+        self.fill()
+        return lost
+
+    def set_host_limits(self, config):
+        self.host_limits[0].set_rate(config.host_copy_bandwidth)
+        self.host_limits[1].set_rate(config.host_copy_iops)
+        self.host_limits[2].set_rate(config.host_commit_bandwidth)
+
+    def resize(self, size):
+        size = max(1, int(size))
+        active = [pid for pid in self.workers.keys() if pid not in self.retiring]
+        # idle workers are retired first. Busy ones exit after their current job.
+        active.sort(key=lambda pid: pid in self.tasks)
+        for pid in active[:max(len(active) - size, 0)]:
+            self.retiring.add(pid)
+            self.queues[pid].put(None)
+        self.size = size
+        # exiting workers are joined and, if the pool grew, new ones started, by reap().
+
+    def shutdown(self):
+        for task_q in self.queues.values():
+            task_q.put(None)
+        for process in self.workers.values():
+            process.join()
+        self.workers = {}
+        self.queues = {}
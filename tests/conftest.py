@@ -0,0 +1,39 @@
+import os
+import yaml
+import pytest
+from lib import config as config_module
+from lib import qcow2
+
+
+@pytest.fixture
+def make_config(tmp_path, monkeypatch):
+    '''
+    :return: function writing a virt-dup.yml with the given options, staging into tmp_path, and loading it.
+    '''
+    # Config uses yaml.load without a Loader, which PyYAML 6 no longer accepts.
+    load = yaml.load
+    monkeypatch.setattr(config_module.yaml, 'load', lambda stream, Loader=yaml.SafeLoader: load(stream, Loader))
+
+    def make(**options):
+        options.setdefault('staging-path', str(tmp_path / 'staging') + '/')
+        path = tmp_path / 'virt-dup.yml'
+        path.write_text(yaml.safe_dump(options))
+        return config_module.Config(str(path))
+    return make
+
+
+def write_qcow2(pathname, size, backing=None):
+    '''
+    writes a minimal qcow2 image with no data clusters, without qemu-img: just the header, which is all
+    lib.qcow2 reads.
+    '''
+    backing_data = b'' if backing is None else backing.encode()
+    header = qcow2.HEADER.pack(qcow2.MAGIC, 3, 512 if backing else 0, len(backing_data), 16, size, 0, 0,
+                               3 * 65536, 65536, 1, 0, 0)
+    header += qcow2.HEADER_V3.pack(0, 0, 0, 4, qcow2.HEADER.size + qcow2.HEADER_V3.size)
+    data = bytearray(65536)
+    data[:len(header)] = header
+    data[512:512 + len(backing_data)] = backing_data
+    with open(pathname, 'wb') as file:
+        file.write(data)
+    return pathname
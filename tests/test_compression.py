@@ -0,0 +1,39 @@
+import os
+import pytest
+from lib import compression
+
+
+@pytest.fixture
+def image(tmp_path):
+    '''
+    a file of compressible data, a zero block and a short tail, so every kind of block is written.
+    '''
+    pathname = str(tmp_path / 'image.raw')
+    with open(pathname, 'wb') as file:
+        file.write(b'virt-dup ' * 30000)
+        file.write(bytes(65536))
+        file.write(os.urandom(1000))
+    return pathname
+
+
+@pytest.mark.parametrize('level', [-5, 0, 1, 9, 19, 22])
+def test_zlib_levels_outside_zlibs_range(image, tmp_path, level):
+    packed = str(tmp_path / 'image.vdz')
+    restored = str(tmp_path / 'restored.raw')
+    stats = compression.compress_file(image, packed, 'zlib', level, block_size=65536, threads=2)
+    assert stats['level'] == level
+    compression.decompress_file(packed, restored, threads=2)
+    with open(image, 'rb') as original, open(restored, 'rb') as result:
+        assert original.read() == result.read()
+
+
+@pytest.mark.parametrize('codec,level', [('zstd', 3), ('lz4', 1), ('lz4', 9), ('lz4', -3)])
+def test_optional_codecs_round_trip(image, tmp_path, codec, level):
+    if not compression.codec_available(codec):
+        pytest.skip(f"{codec} module not installed")
+    packed = str(tmp_path / 'image.vdz')
+    restored = str(tmp_path / 'restored.raw')
+    compression.compress_file(image, packed, codec, level, block_size=65536, threads=2)
+    compression.decompress_file(packed, restored, threads=2)
+    with open(image, 'rb') as original, open(restored, 'rb') as result:
+        assert original.read() == result.read()
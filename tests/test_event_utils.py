@@ -0,0 +1,122 @@
+import threading
+import pytest
+
+libvirt = pytest.importorskip('libvirt')
+
+from lib.event_utils import BlockJobWaiter
+
+
+class FakeDomain(object):
+    def __init__(self, uuid='4f5e6d7c-0000-0000-0000-000000000001', info=None):
+        self.uuid = uuid
+        # what blockJobInfo returns: {'cur': ..., 'end': ...}, {} when there's no job, or an exception to raise.
+        self.info = {'cur': 0, 'end': 100} if info is None else info
+
+    def UUIDString(self):
+        return self.uuid
+
+    def blockJobInfo(self, disk, flags):
+        if isinstance(self.info, Exception):
+            raise self.info
+        return self.info
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.callbacks = {}
+
+    def domainEventRegisterAny(self, dom, event_id, callback, opaque):
+        self.callbacks[event_id] = callback
+        return 1
+
+    def domainEventDeregisterAny(self, callback_id):
+        self.callbacks = {}
+
+    def emit(self, dom, disk, status):
+        '''
+        delivers a BLOCK_JOB_2 event the way libvirt's event loop thread would.
+        '''
+        self.callbacks[libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2](self, dom, disk,
+                                                                libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_ACTIVE_COMMIT,
+                                                                status, None)
+
+
+def test_registers_block_job_2_callback():
+    conn = FakeConnection()
+    waiter = BlockJobWaiter(conn)
+    assert libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2 in conn.callbacks
+    waiter.close()
+    assert conn.callbacks == {}
+
+
+def test_event_before_wait_is_kept():
+    conn = FakeConnection()
+    domain = FakeDomain()
+    waiter = BlockJobWaiter(conn, recheck=30)
+    waiter.expect(domain, 'vda')
+    conn.emit(domain, 'vda', libvirt.VIR_DOMAIN_BLOCK_JOB_READY)
+    assert waiter.wait(domain, 'vda', timeout=5) == libvirt.VIR_DOMAIN_BLOCK_JOB_READY
+    assert waiter.waiting == {}
+
+
+def test_event_from_another_thread_wakes_wait():
+    conn = FakeConnection()
+    domain = FakeDomain()
+    waiter = BlockJobWaiter(conn, recheck=30)
+    waiter.expect(domain, 'vda')
+    timer = threading.Timer(0.1, conn.emit, (domain, 'vda', libvirt.VIR_DOMAIN_BLOCK_JOB_COMPLETED))
+    timer.start()
+    try:
+        assert waiter.wait(domain, 'vda', timeout=5) == libvirt.VIR_DOMAIN_BLOCK_JOB_COMPLETED
+    finally:
+        timer.cancel()
+
+
+def test_events_for_other_disks_and_domains_are_ignored():
+    conn = FakeConnection()
+    domain = FakeDomain()
+    other = FakeDomain(uuid='4f5e6d7c-0000-0000-0000-000000000002')
+    waiter = BlockJobWaiter(conn, recheck=0.05)
+    waiter.expect(domain, 'vda')
+    conn.emit(domain, 'vdb', libvirt.VIR_DOMAIN_BLOCK_JOB_FAILED)
+    conn.emit(other, 'vda', libvirt.VIR_DOMAIN_BLOCK_JOB_FAILED)
+    assert waiter.wait(domain, 'vda', timeout=0.2) is None
+
+
+def test_missed_ready_event_falls_back_to_job_info():
+    conn = FakeConnection()
+    domain = FakeDomain(info={'cur': 100, 'end': 100})
+    waiter = BlockJobWaiter(conn, recheck=0.05)
+    waiter.expect(domain, 'vda')
+    # no event is ever emitted.
+    assert waiter.wait(domain, 'vda', timeout=5) == libvirt.VIR_DOMAIN_BLOCK_JOB_READY
+
+
+def test_job_info_catching_up_while_waiting():
+    conn = FakeConnection()
+    domain = FakeDomain(info={'cur': 10, 'end': 100})
+    waiter = BlockJobWaiter(conn, recheck=0.05)
+    waiter.expect(domain, 'vda')
+    timer = threading.Timer(0.15, lambda: setattr(domain, 'info', {'cur': 100, 'end': 100}))
+    timer.start()
+    try:
+        assert waiter.wait(domain, 'vda', timeout=5) == libvirt.VIR_DOMAIN_BLOCK_JOB_READY
+    finally:
+        timer.cancel()
+
+
+def test_vanished_job_is_failed():
+    conn = FakeConnection()
+    waiter = BlockJobWaiter(conn, recheck=0.05)
+    assert waiter.job_state(FakeDomain(info={}), 'vda') == libvirt.VIR_DOMAIN_BLOCK_JOB_FAILED
+    error = libvirt.libvirtError('no such job')
+    assert waiter.job_state(FakeDomain(info=error), 'vda') == libvirt.VIR_DOMAIN_BLOCK_JOB_FAILED
+
+
+def test_timeout_while_running():
+    conn = FakeConnection()
+    domain = FakeDomain(info={'cur': 10, 'end': 100})
+    waiter = BlockJobWaiter(conn, recheck=0.05)
+    waiter.expect(domain, 'vda')
+    assert waiter.wait(domain, 'vda', timeout=0.2) is None
+    assert waiter.waiting == {}
@@ -0,0 +1,63 @@
+import os
+import json
+import pytest
+
+libvirt = pytest.importorskip('libvirt')
+
+from lib import qemu_utils
+from lib.libvirt_utils import SnapshotManager
+from lib.copy_utils import file_checksum
+from tests.conftest import write_qcow2
+from tests.test_offline_backup import FakeDomain, FakeXML, JOBUUID, load_json
+
+SIZE = 1024 * 1024 * 1024
+
+
+@pytest.fixture
+def incremental_run(tmp_path, make_config, monkeypatch):
+    '''
+    a job with a staged full backup of vda and a SnapshotManager whose snapshot, commit and qemu-img calls are
+    replaced, so incremental_backup() runs without a domain or qemu-img. The "diff" is an empty overlay.
+    '''
+    config = make_config(checksum='sha256', **{'checksum-block-size': 65536})
+    disk = write_qcow2(str(tmp_path / 'vm01.qcow2'), SIZE)
+    sm = SnapshotManager(config, FakeXML(FakeDomain(active=True), {'vda': disk}), JOBUUID)
+    write_qcow2(os.path.join(sm.job_staging_path, 'vda-1551669947-0.qcow2'), SIZE)
+    sm.save_chain_record({'vda': ['vda-1551669947-0.qcow2']})
+    monkeypatch.setattr(sm, 'create_snapshot', lambda: None)
+    monkeypatch.setattr(sm, 'commit_snapshot', lambda: None)
+    monkeypatch.setattr(sm, 'get_snap_files', lambda: {'vda': {'base': disk, 'top': disk + '.overlay'}})
+    monkeypatch.setattr(qemu_utils, 'create_overlay', lambda filename, backing: write_qcow2(filename, SIZE, backing))
+    monkeypatch.setattr(qemu_utils, 'rebase', lambda filename, backing: write_qcow2(filename, SIZE, backing))
+    return sm, disk
+
+
+def test_incremental_run_writes_manifest(incremental_run):
+    sm, disk = incremental_run
+    sm.incremental_backup()
+    record = load_json(sm.config, 'chain.json')['vda']
+    assert record[0] == 'vda-1551669947-0.qcow2'
+    assert record[1].endswith('-inc.qcow2')
+    manifests = [name for name in os.listdir(sm.job_staging_path) if name.startswith('manifest-')]
+    assert len(manifests) == 1
+    manifest = load_json(sm.config, manifests[0])
+    assert manifest['job'] == JOBUUID
+    entries = manifest['disks']['vda']
+    assert [entry['name'] for entry in entries] == record
+    assert entries[1]['source'] == disk
+    assert entries[1]['backing'] == record[0]
+    assert entries[1]['virtual_size'] == SIZE
+    inc = os.path.join(sm.job_staging_path, record[1])
+    assert entries[1]['size'] == os.path.getsize(inc)
+    assert entries[1]['checksum'] == file_checksum(inc, 'sha256', 65536)
+    assert len(entries[1]['checksum']['blocks']) == 1
+
+
+def test_incremental_run_without_checksum(incremental_run):
+    sm, disk = incremental_run
+    sm.config.checksum = 'none'
+    sm.incremental_backup()
+    manifests = [name for name in os.listdir(sm.job_staging_path) if name.startswith('manifest-')]
+    entries = load_json(sm.config, manifests[0])['disks']['vda']
+    assert len(entries) == 2
+    assert entries[1]['checksum'] is None
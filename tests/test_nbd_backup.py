@@ -0,0 +1,81 @@
+import json
+import shutil
+import subprocess
+import pytest
+
+pytest.importorskip('nbd')
+for tool in ('qemu-img', 'qemu-io', 'qemu-nbd'):
+    if shutil.which(tool) is None:
+        pytest.skip(f"{tool} not installed", allow_module_level=True)
+
+from lib import nbd_backup
+from lib import qemu_utils
+
+MiB = 1024 * 1024
+SIZE = 16 * MiB
+
+
+def qemu_io(pathname, *commands):
+    args = ['qemu-io', '-f', 'qcow2']
+    for command in commands:
+        args += ['-c', command]
+    subprocess.run(args + [pathname], check=True, capture_output=True)
+
+
+@pytest.fixture
+def source(tmp_path):
+    '''
+    a small qcow2 image with data, a zero cluster range, data which happens to be zeros and unallocated holes:
+    0-1M 0xab, 1M-2M hole, 2M-3M zero clusters, 3M-4M hole, 4M-5M written zeros, 5M-6M hole, 6M-11M 0xcd
+    spanning a piece boundary, the rest a hole.
+    '''
+    pathname = str(tmp_path / 'source.qcow2')
+    qemu_utils.create_image(pathname, SIZE)
+    qemu_io(pathname,
+            f'write -P 0xab 0 {MiB}',
+            f'write -z {2 * MiB} {MiB}',
+            f'write -P 0 {4 * MiB} {MiB}',
+            f'write -P 0xcd {6 * MiB} {5 * MiB}')
+    return pathname
+
+
+def test_copy_export_matches_source(source, tmp_path):
+    target = str(tmp_path / 'target.qcow2')
+    with nbd_backup.serve_image(source, 4) as socket:
+        size = nbd_backup.export_size(socket, '')
+        assert size == SIZE
+        qemu_utils.create_image(target, size)
+        result = nbd_backup.copy_export(socket, '', target, workers=3)
+    subprocess.run(['qemu-img', 'compare', '-f', 'qcow2', '-F', 'qcow2', source, target], check=True,
+                   capture_output=True)
+    # only the 0xab and 0xcd data is written; the written zeros are zeroed and the zero clusters and holes skipped.
+    assert result['bytes'] == 6 * MiB
+    assert result['zeroed'] == MiB
+
+
+def test_plan_skips_holes_and_zero_clusters(source):
+    with nbd_backup.serve_image(source, 1) as socket:
+        handle = nbd_backup.connect(socket, '', [nbd_backup.ALLOCATION])
+        try:
+            pieces = nbd_backup.plan(handle)
+        finally:
+            handle.shutdown()
+    assert all(not zero for _, _, zero in pieces)
+    assert all(length <= nbd_backup.PIECE_SIZE for _, length, _ in pieces)
+    covered = sum(length for _, length, _ in pieces)
+    # the 0xab, written zero and 0xcd ranges.
+    assert covered == 7 * MiB
+    for offset, length, _ in pieces:
+        assert offset + length <= MiB or 4 * MiB <= offset < 5 * MiB or offset >= 6 * MiB
+        assert offset + length <= 11 * MiB
+
+
+def test_target_stays_sparse(source, tmp_path):
+    target = str(tmp_path / 'target.qcow2')
+    with nbd_backup.serve_image(source, 2) as socket:
+        qemu_utils.create_image(target, SIZE)
+        nbd_backup.copy_export(socket, '', target, workers=2)
+    out = subprocess.run(['qemu-img', 'map', '--output=json', '-f', 'qcow2', target], check=True,
+                         capture_output=True)
+    data = sum(extent['length'] for extent in json.loads(out.stdout) if extent['data'])
+    assert data == 6 * MiB
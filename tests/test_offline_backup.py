@@ -0,0 +1,120 @@
+import os
+import json
+import shutil
+import pytest
+
+libvirt = pytest.importorskip('libvirt')
+
+from lib.libvirt_utils import SnapshotManager
+from lib import qemu_utils
+from lib.exceptions.libvirt_exceptions import NoSnapshot
+from tests.conftest import write_qcow2
+
+JOBUUID = '7a0c2b8e-1d4f-4c7e-9a55-3f6e2d1c0b9a'
+
+
+class FakeDomain(object):
+    def __init__(self, active=False):
+        self.active = active
+
+    def name(self):
+        return 'vm01'
+
+    def UUIDString(self):
+        return '4f5e6d7c-0000-0000-0000-000000000001'
+
+    def isActive(self):
+        return self.active
+
+    def listAllSnapshots(self):
+        # a shut off domain being backed up offline has no snapshot of ours.
+        return []
+
+
+class FakeXML(object):
+    def __init__(self, domain, disks, depth=0):
+        self.domain = domain
+        self.disks = disks
+        self.loaded_jobs = {JOBUUID: {'uuid': JOBUUID, 'depth': depth}}
+
+    def disk_summary(self):
+        return [{'dev_name': dev, 'path': path, 'backup-enabled': True} for dev, path in self.disks.items()]
+
+
+def load_json(config, name):
+    with open(os.path.join(config.staging_path, JOBUUID, name)) as file:
+        return json.load(file)
+
+
+def test_offline_image_stages_shut_off_domain(tmp_path, make_config):
+    config = make_config(**{'copy-workers': 2})
+    images = tmp_path / 'images'
+    images.mkdir()
+    vda = write_qcow2(str(images / 'vm01.qcow2'), 1024 * 1024 * 1024)
+    vdb = write_qcow2(str(images / 'vm01-data.qcow2'), 64 * 1024 * 1024)
+    sm = SnapshotManager(config, FakeXML(FakeDomain(), {'vda': vda, 'vdb': vdb}), JOBUUID)
+    with pytest.raises(NoSnapshot):
+        sm.load_our_snapshot()
+
+    assert sm.offline_image() is True
+
+    staging = sm.job_staging_path
+    with open(os.path.join(staging, 'chain.json')) as file:
+        record = json.load(file)
+    assert sorted(record.keys()) == ['vda', 'vdb']
+    for dev, source in (('vda', vda), ('vdb', vdb)):
+        assert len(record[dev]) == 1
+        with open(os.path.join(staging, record[dev][0]), 'rb') as staged, open(source, 'rb') as original:
+            assert staged.read() == original.read()
+    manifests = [name for name in os.listdir(staging) if name.startswith('manifest-')]
+    assert len(manifests) == 1
+    with open(os.path.join(staging, manifests[0])) as file:
+        manifest = json.load(file)
+    assert manifest['disks']['vda'][0]['source'] == vda
+    assert manifest['disks']['vda'][0]['virtual_size'] == 1024 * 1024 * 1024
+
+
+def test_offline_image_reuses_unchanged_backing_file(tmp_path, make_config):
+    config = make_config()
+    images = tmp_path / 'images'
+    images.mkdir()
+    base = write_qcow2(str(images / 'base.qcow2'), 1024 * 1024 * 1024)
+    top = write_qcow2(str(images / 'vm01.qcow2'), 1024 * 1024 * 1024, backing='base.qcow2')
+    xml = FakeXML(FakeDomain(), {'vda': top})
+    # relinking the staged top onto the staged base runs qemu-img rebase.
+    if shutil.which('qemu-img') is None:
+        pytest.skip('qemu-img not installed')
+    assert SnapshotManager(config, xml, JOBUUID).offline_image() is True
+    first = load_json(config, 'chain.json')['vda']
+    assert SnapshotManager(config, xml, JOBUUID).offline_image() is True
+    second = load_json(config, 'chain.json')['vda']
+    # the base was staged by the first run and is referenced, not copied, by the second.
+    assert second[0] == first[0]
+    assert list(load_json(config, 'staging-cache.json').keys()) == [base]
+
+
+def test_offline_image_refuses_running_domain(tmp_path, make_config):
+    config = make_config()
+    vda = write_qcow2(str(tmp_path / 'vm01.qcow2'), 1024 * 1024)
+    sm = SnapshotManager(config, FakeXML(FakeDomain(active=True), {'vda': vda}), JOBUUID)
+    assert sm.offline_image() is False
+
+
+def test_shared_file_above_depth_keeps_its_backing_file(tmp_path, make_config):
+    if shutil.which('qemu-img') is None:
+        pytest.skip('qemu-img not installed')
+    config = make_config()
+    images = tmp_path / 'images'
+    images.mkdir()
+    base = write_qcow2(str(images / 'base.qcow2'), 1024 * 1024 * 1024)
+    mid = write_qcow2(str(images / 'mid.qcow2'), 1024 * 1024 * 1024, backing='base.qcow2')
+    top = write_qcow2(str(images / 'vm01.qcow2'), 1024 * 1024 * 1024, backing='mid.qcow2')
+    shared = {path: list(qemu_utils.file_identity(path)[1:]) for path in (base, mid)}
+    # depth 2 stages mid and top; base, though shared, is left where it is.
+    sm = SnapshotManager(config, FakeXML(FakeDomain(), {'vda': top}, depth=2), JOBUUID, shared)
+    assert sm.offline_image() is True
+    record = load_json(config, 'chain.json')['vda']
+    assert record[0].startswith('../shared/')
+    staged = [os.path.normpath(os.path.join(sm.job_staging_path, name)) for name in record]
+    chain = qemu_utils.backing_chain(staged[-1])
+    assert [os.path.normpath(filename) for filename in chain.base_first()] == [base] + staged
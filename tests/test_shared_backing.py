@@ -0,0 +1,91 @@
+import os
+import json
+import fcntl
+import shutil
+import pytest
+from lib import shared_backing
+from lib import qemu_utils
+from lib.copy_utils import CopyEngine
+from tests.conftest import write_qcow2
+
+
+@pytest.fixture
+def config(make_config):
+    return make_config()
+
+
+def identity(path):
+    return list(qemu_utils.file_identity(path)[1:])
+
+
+def test_copy_below_must_exist(tmp_path, config):
+    source = write_qcow2(str(tmp_path / 'mid.qcow2'), 1024 * 1024, backing='base.qcow2')
+    shared = {source: identity(source)}
+    missing = shared_backing.shared_path(config, str(tmp_path / 'base.qcow2'), [1, 2, 3])
+    assert shared_backing.stage_shared(config, CopyEngine(1), source, shared, below=missing) is None
+    assert not os.path.exists(shared_backing.shared_path(config, source, shared[source], missing))
+
+
+def test_shared_copy(tmp_path, config):
+    source = write_qcow2(str(tmp_path / 'base.qcow2'), 1024 * 1024)
+    shared = {source: identity(source)}
+    pathname = shared_backing.stage_shared(config, CopyEngine(1), source, shared)
+    assert pathname == shared_backing.shared_path(config, source, shared[source])
+    with open(pathname, 'rb') as copy, open(source, 'rb') as original:
+        assert copy.read() == original.read()
+    with open(os.path.join(os.path.dirname(pathname), 'source.json')) as file:
+        assert json.load(file) == {'source': source, 'identity': shared[source], 'below': None}
+    # copies backed by something else are kept apart.
+    assert os.path.dirname(shared_backing.shared_path(config, source, shared[source], '/elsewhere')) != \
+        os.path.dirname(pathname)
+
+
+def test_base_of_staged_chain_keeps_its_backing_file(tmp_path, config):
+    if shutil.which('qemu-img') is None:
+        pytest.skip('qemu-img not installed')
+    base = write_qcow2(str(tmp_path / 'base.qcow2'), 1024 * 1024)
+    source = write_qcow2(str(tmp_path / 'mid.qcow2'), 1024 * 1024, backing='base.qcow2')
+    pathname = shared_backing.stage_shared(config, CopyEngine(1), source, {source: identity(source)})
+    # the relative name would point into the shared area.
+    assert qemu_utils.image_info(pathname)['backing-filename'] == base
+
+
+def test_changed_source_is_not_shared(tmp_path, config):
+    source = write_qcow2(str(tmp_path / 'base.qcow2'), 1024 * 1024)
+    shared = {source: identity(source)}
+    with open(source, 'ab') as file:
+        file.write(b'\0' * 512)
+    assert shared_backing.stage_shared(config, CopyEngine(1), source, shared) is None
+
+
+def test_remove_stale_shared(tmp_path, config):
+    old_base = write_qcow2(str(tmp_path / 'old.qcow2'), 1024 * 1024)
+    base = write_qcow2(str(tmp_path / 'base.qcow2'), 1024 * 1024)
+    kept = write_qcow2(str(tmp_path / 'kept.qcow2'), 1024 * 1024)
+    shared = {old_base: identity(old_base), base: identity(base), kept: identity(kept)}
+    engine = CopyEngine(1)
+    stale = os.path.dirname(shared_backing.stage_shared(config, engine, old_base, shared))
+    current = os.path.dirname(shared_backing.stage_shared(config, engine, base, shared))
+    in_chain = shared_backing.stage_shared(config, engine, kept, shared)
+    # a job's chain record still names the copy of kept.
+    job = os.path.join(config.staging_path, 'job')
+    os.makedirs(job)
+    with open(os.path.join(job, 'chain.json'), 'w') as file:
+        json.dump({'vda': [os.path.relpath(in_chain, job), 'vda-1551669947-1.qcow2']}, file)
+
+    index = {base: shared[base]}
+    removed = shared_backing.remove_stale_shared(config, index)
+    assert removed == [os.path.normpath(stale)]
+    assert not os.path.exists(stale)
+    assert os.path.exists(current)
+    assert os.path.exists(in_chain)
+
+
+def test_remove_stale_shared_waits_for_staging(tmp_path, config):
+    source = write_qcow2(str(tmp_path / 'base.qcow2'), 1024 * 1024)
+    pathname = shared_backing.stage_shared(config, CopyEngine(1), source, {source: identity(source)})
+    with open(os.path.join(shared_backing.shared_root(config), '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        assert shared_backing.remove_stale_shared(config, {}) == []
+    assert os.path.exists(pathname)
+    assert shared_backing.remove_stale_shared(config, {}) == [os.path.normpath(os.path.dirname(pathname))]
@@ -10,9 +10,11 @@ import logging
 
 config_path = "/home/spencer/git-repos/virt-dup/virt-dup.yml"
 
-config = Config(config_path)
+# worker processes are spawned and import this module again, so only start the scheduler when run as a script.
+if __name__ == '__main__':
+    config = Config(config_path)
 
-Scheduler(config)
+    Scheduler(config)
 """
 lv = LibvirtUtils(config)
 